@@ -0,0 +1,167 @@
+"""Stage-by-stage throughput benchmark of the input pipeline.
+
+The pipeline of `data.source_dataset` is rebuilt one stage at a time (shard read, decode, crop/resize, augment,
+batch, contrast data and prefetch) and each prefix is timed on its own. This is run for every dataset, both
+augment configs and a sweep of CPU thread counts, and the results are written as JSON.
+
+The decode and crop stages are timed separately, so they follow the decode-once path, where every view is cropped
+from one decoded image.
+
+  python benchmark.py --data-ids cifar10 mnist --threads 1 4 16 --out out/benchmark.json
+"""
+import argparse
+import json
+import os
+import time
+from functools import partial
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from absl import logging
+
+import utils
+from data import DATA_IDS, SHUFFLE_MB, READ_CYCLE_LENGTH, add_contrast_data, shard_cache, example_bytes, \
+    shuffle_buffer_size, _read_encoded_dataset, _shuffle_and_repeat
+from data.preprocess import get_image_format, decode_image, crop_decoded_image
+
+STAGES = ['read', 'decode', 'crop', 'augment', 'batch', 'contrast', 'prefetch']
+
+
+def _decode(image_bytes, label, channels, image_format):
+    image, is_jpeg = decode_image(image_bytes, channels, image_format)
+    return image, label, tf.convert_to_tensor(is_jpeg)
+
+
+def _crop(image, label, is_jpeg, imsize, channels, augment_config, image_format):
+    is_jpeg = is_jpeg if image_format is None else image_format == 'jpeg'
+    inputs = {view_config.name: tf.ensure_shape(crop_decoded_image(image, is_jpeg, view_config.rand_crop, imsize,
+                                                                   channels), [imsize, imsize, channels])
+              for view_config in augment_config.view_configs}
+    return inputs, {'label': label}
+
+
+def _augment(inputs, targets, imsize, channels, augment_config):
+    inputs = dict(inputs)
+    for view_config in augment_config.view_configs:
+        view = view_config.augment(inputs[view_config.name])
+        inputs[view_config.name] = tf.ensure_shape(view, [imsize, imsize, channels])
+    return inputs, targets
+
+
+def stage_datasets(ds_info, data_id, split, augment_config, bsz, data_dir, shuffle_mb=SHUFFLE_MB,
+                   cycle_length=READ_CYCLE_LENGTH):
+    """Returns `{stage: (dataset, images per element)}`, where each dataset ends with that stage."""
+    imsize = ds_info.features['image'].shape[0] or 224
+    channels = ds_info.features['image'].shape[2]
+    image_format = get_image_format(ds_info)
+    input_ctx = tf.distribute.InputContext()
+
+    datasets = {}
+    ds = _read_encoded_dataset(input_ctx, data_id, split, True, data_dir, cycle_length=cycle_length)
+    buffer_size = shuffle_buffer_size(ds_info, split, input_ctx, shuffle_mb)
+    ds = _shuffle_and_repeat(ds, split, shuffle=True, repeat=True, buffer_size=buffer_size,
+                             buffer_bytes=example_bytes(ds_info, split))
+    datasets['read'] = ds, 1
+
+    ds = ds.map(partial(_decode, channels=channels, image_format=image_format), tf.data.AUTOTUNE)
+    datasets['decode'] = ds, 1
+
+    ds = ds.map(partial(_crop, imsize=imsize, channels=channels, augment_config=augment_config,
+                        image_format=image_format), tf.data.AUTOTUNE)
+    datasets['crop'] = ds, 1
+
+    ds = ds.map(partial(_augment, imsize=imsize, channels=channels, augment_config=augment_config),
+                tf.data.AUTOTUNE)
+    datasets['augment'] = ds, 1
+
+    ds = ds.batch(bsz, drop_remainder=True)
+    datasets['batch'] = ds, bsz
+
+    if len(augment_config.view_configs) > 1:
+        ds = ds.map(add_contrast_data, tf.data.AUTOTUNE)
+    datasets['contrast'] = ds, bsz
+
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+    datasets['prefetch'] = ds, bsz
+
+    return datasets
+
+
+def time_dataset(ds, images_per_element, num_threads, num_elements, num_warmup):
+    options = tf.data.Options()
+    options.experimental_threading.private_threadpool_size = num_threads
+    ds = ds.with_options(options)
+
+    # The first element waits for the shuffle buffer to fill
+    start = time.time()
+    ds_iter = iter(ds)
+    next(ds_iter)
+    first_element_sec = time.time() - start
+
+    for _ in range(num_warmup):
+        next(ds_iter)
+
+    start = time.time()
+    for _ in range(num_elements):
+        next(ds_iter)
+    elapsed = time.time() - start
+
+    return {'images_per_sec': num_elements * images_per_element / elapsed,
+            'ms_per_element': 1000 * elapsed / num_elements, 'first_element_sec': first_element_sec}
+
+
+def run(cmd_args):
+    train_augment_config, val_augment_config = utils.load_augment_configs(cmd_args)
+    augment_configs = {'train': train_augment_config, 'val': val_augment_config}
+
+    results = []
+    for data_id in cmd_args.data_ids:
+        _, ds_info = tfds.load(data_id, try_gcs=shard_cache.is_remote(cmd_args.data_dir),
+                               data_dir=cmd_args.data_dir, with_info=True)
+        for config_name, augment_config in augment_configs.items():
+            datasets = stage_datasets(ds_info, data_id, cmd_args.split, augment_config, cmd_args.bsz,
+                                      cmd_args.data_dir, cmd_args.shuffle_mb, cmd_args.read_cycle_length)
+            buffer_size = shuffle_buffer_size(ds_info, cmd_args.split, tf.distribute.InputContext(),
+                                              cmd_args.shuffle_mb)
+            shuffle_buffer_mb = buffer_size * example_bytes(ds_info, cmd_args.split) / 1e6
+            for num_threads in cmd_args.threads:
+                for stage in STAGES:
+                    ds, images_per_element = datasets[stage]
+                    # Batched stages run fewer elements, so that every stage sees about the same number of images
+                    num_elements = max(cmd_args.num_images // images_per_element, 1)
+                    num_warmup = max(cmd_args.num_warmup // images_per_element, 1)
+                    result = {'data_id': data_id, 'augment_config': config_name, 'threads': num_threads,
+                              'stage': stage, 'autoaugment': cmd_args.autoaugment,
+                              'shuffle_buffer_size': buffer_size, 'shuffle_buffer_mb': shuffle_buffer_mb,
+                              **time_dataset(ds, images_per_element, num_threads, num_elements, num_warmup)}
+                    logging.info(f"{data_id}, {config_name}, {num_threads} threads, {stage}: "
+                                 f"{result['images_per_sec']:.1f} images/sec, "
+                                 f"{result['ms_per_element']:.3f} ms/element, "
+                                 f"{result['first_element_sec']:.2f}s to first element")
+                    results.append(result)
+
+    output = json.dumps(results, indent=2)
+    if cmd_args.out:
+        with tf.io.gfile.GFile(cmd_args.out, 'w') as f:
+            f.write(output)
+        logging.info(f"benchmark results saved to '{cmd_args.out}'")
+    else:
+        print(output)
+    return results
+
+
+# The data and augment flags are the training flags, so the benchmark runs the same input pipeline configurations
+parser = argparse.ArgumentParser(description='stage-by-stage input pipeline throughput benchmark',
+                                 parents=[utils.parser], add_help=False)
+parser.set_defaults(bsz=32)
+parser.add_argument('--data-ids', choices=DATA_IDS, nargs='+', default=DATA_IDS)
+parser.add_argument('--split', type=str, default='train')
+parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, 2, 4, 8, os.cpu_count()}),
+                    help='sizes of the private tf.data threadpool')
+parser.add_argument('--num-images', type=int, default=2048, help='images timed per stage')
+parser.add_argument('--num-warmup', type=int, default=512, help='images read before timing each stage')
+parser.add_argument('--out', type=str, help='JSON output file. prints to stdout by default')
+
+if __name__ == '__main__':
+    logging.set_verbosity('INFO')
+    run(parser.parse_args())
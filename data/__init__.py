@@ -1,11 +1,30 @@
+import os
 from functools import partial
 
 import tensorflow as tf
 import tensorflow_datasets as tfds
 from absl import logging
 
-from data import augmentations
-from data.preprocess import process_encoded_example
+from data import augmentations, class_sampler, epochs, pixel_store, service, shard_cache, val_cache, view_bank
+from data.preprocess import process_encoded_example, process_encoded_example_once, process_decoded_example, \
+    get_image_format, decode_and_resize, CROP_PADDING
+
+DATA_IDS = ['imagenet2012', 'tf_flowers', 'cifar10', 'cifar100', 'mnist']
+CACHE_TIERS = ['encoded', 'decoded', 'decoded-disk', 'snapshot']
+DECODED_CACHE_TIERS = ['decoded', 'decoded-disk', 'snapshot']
+
+# Number of snapshot shards read in parallel
+SNAPSHOT_READERS = 8
+
+# Default memory budget of the shuffle buffers and number of shards read in parallel
+SHUFFLE_MB = 1024
+READ_CYCLE_LENGTH = 16
+
+# Shuffle buffers are never smaller than this, no matter how large the examples are
+MIN_SHUFFLE_BUFFER = 1000
+
+# Assumed ratio of decoded to encoded bytes of full resolution JPEGs
+JPEG_COMPRESSION_RATIO = 10
 
 
 def get_val_split_name(ds_info):
@@ -19,50 +38,281 @@ def add_contrast_data(inputs, targets):
     return inputs, targets
 
 
-def source_dataset(input_ctx, ds_info, data_id, split, cache, shuffle, repeat, augment_config, global_bsz):
-    # Load image bytes and labels
+def augment_batch(inputs, targets, augment_config):
+    inputs = dict(inputs)
+    for view_config in augment_config.view_configs:
+        inputs[view_config.name] = view_config.batch_augment(inputs[view_config.name])
+    return inputs, targets
+
+
+def _without_augment(augment_config):
+    view_configs = [augmentations.ViewConfig(view_config.name, view_config.rand_crop)
+                    for view_config in augment_config.view_configs]
+    return augmentations.AugmentConfig(view_configs)
+
+
+def _read_encoded_dataset(input_ctx, data_id, split, shuffle_files, data_dir, seed=None,
+                          cycle_length=READ_CYCLE_LENGTH):
+    # Load image bytes and labels. Every input pipeline reads its own subset of the shard files, `cycle_length` of
+    # them at a time. With a seed, the files are read in the same seeded order every epoch, so that every epoch's
+    # order only depends on the seed (see `epochs`)
     decoder_args = {'image': tfds.decode.SkipDecoding()}
-    read_config = tfds.ReadConfig(input_context=input_ctx)
-    ds = tfds.load(data_id, as_supervised=True, read_config=read_config, split=split, shuffle_files=shuffle,
-                   decoders=decoder_args, try_gcs=True, data_dir='gs://aigagror/datasets')
-    imsize = ds_info.features['image'].shape[0] or 224
-    channels = ds_info.features['image'].shape[2]
+    read_config = tfds.ReadConfig(input_context=input_ctx, shuffle_seed=seed, interleave_cycle_length=cycle_length,
+                                  shuffle_reshuffle_each_iteration=seed is None)
+    ds = tfds.load(data_id, as_supervised=True, read_config=read_config, split=split, shuffle_files=shuffle_files,
+                   decoders=decoder_args, try_gcs=shard_cache.is_remote(data_dir), data_dir=data_dir)
+    return ds
+
 
-    # Cache?
-    if cache:
-        ds = ds.cache()
-        logging.info(f'caching {split} dataset')
+def shard_num_examples(ds_info, split, input_ctx):
+    """Number of examples of the shard files an input pipeline reads in one epoch."""
+    split_info = ds_info.splits[split]
+    if input_ctx.num_input_pipelines == 1:
+        return split_info.num_examples
+    return sum(split_info.shard_lengths[input_ctx.input_pipeline_id::input_ctx.num_input_pipelines])
 
+
+def example_bytes(ds_info, split, decoded=False, shrink=False):
+    """Average size of one example in bytes, either encoded or decoded by `decode_and_resize`."""
+    image_shape = ds_info.features['image'].shape
+    split_info = ds_info.splits[split]
+    encoded_bytes = max(split_info.num_bytes // max(split_info.num_examples, 1), 1)
+    if decoded:
+        if None not in image_shape:
+            return image_shape[0] * image_shape[1] * image_shape[2]
+        if shrink:
+            # JPEGs are shrunk to a shorter side of `imsize + CROP_PADDING`. We assume a 4:3 aspect ratio
+            min_size = (image_shape[0] or 224) + CROP_PADDING
+            return min_size * min_size * 4 // 3 * image_shape[2]
+        # Full resolution JPEGs
+        return encoded_bytes * JPEG_COMPRESSION_RATIO
+
+    return encoded_bytes
+
+
+def shuffle_buffer_size(ds_info, split, input_ctx, shuffle_mb, decoded=False, shrink=False):
+    """Number of examples of an input pipeline's shuffle buffer that fit in `shuffle_mb` megabytes."""
+    buffer_size = int(shuffle_mb * 1e6) // example_bytes(ds_info, split, decoded, shrink)
+
+    # No need to hold more than the input pipeline's whole share of the split
+    num_examples = -(-ds_info.splits[split].num_examples // input_ctx.num_input_pipelines)
+    return min(max(buffer_size, MIN_SHUFFLE_BUFFER), num_examples)
+
+
+def _shuffle_and_repeat(ds, split, shuffle, repeat, seed=None, skip=0, buffer_size=10000, buffer_bytes=None,
+                        epoch_size=None):
     # Shuffle?
+    shuffle_fn = lambda ds, seed: ds
     if shuffle:
-        ds = ds.shuffle(10000)
-        logging.info(f'shuffling {split} dataset with buffer size 10000')
+        shuffle_fn = lambda ds, seed: ds.shuffle(buffer_size, seed=seed)
+        memory = '' if buffer_bytes is None else f' (~{buffer_size * buffer_bytes / 1e6:.1f} MB)'
+        logging.info(f'shuffling {split} dataset with buffer size {buffer_size}{memory}')
+
+    # Repeat infinitely with a seeded order per epoch? Then a resumed run only skips what the previous run already
+    # consumed of the current epoch. This happens before any decoding
+    if repeat and seed is not None and epoch_size is not None:
+        logging.info(f'repeat {split} dataset with a seeded order per epoch')
+        return epochs.repeat_epochs(ds, epoch_size, shuffle_fn, seed, skip)
 
-    # Repeat infinitely?
+    ds = shuffle_fn(ds, seed)
     if repeat:
         ds = ds.repeat()
         logging.info(f'repeat {split} dataset')
+    if skip > 0:
+        ds = ds.skip(skip)
+        logging.info(f'skipping the first {skip} examples of the {split} dataset')
+
+    return ds
+
+
+def _cache_decoded(ds, tier, path):
+    if tier == 'decoded':
+        return ds.cache()
 
-    # Preprocess
-    preprocess_fn = partial(process_encoded_example, imsize=imsize, channels=channels, augment_config=augment_config)
+    if tier == 'decoded-disk':
+        if not tf.io.gfile.exists(path):
+            tf.data.experimental.save(ds, path + '.incomplete', compression='GZIP')
+            tf.io.gfile.rename(path + '.incomplete', path)
+        return tf.data.experimental.load(path, ds.element_spec, compression='GZIP')
+
+    assert tier == 'snapshot', tier
+    reader_fn = lambda datasets: datasets.interleave(lambda x: x, cycle_length=SNAPSHOT_READERS,
+                                                     num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.apply(tf.data.experimental.snapshot(path, compression='AUTO', reader_func=reader_fn))
+
+
+def source_dataset(input_ctx, ds_info, data_id, split, cache, shuffle, repeat, augment_config, global_bsz,
+                   decode_once=False, pixel_store_dir=None, batch_augment=False, data_dir='gs://aigagror/datasets',
+                   cache_dir=None, seed=None, skip=0, data_service=None, shuffle_mb=SHUFFLE_MB,
+                   cycle_length=READ_CYCLE_LENGTH, imsize=None, class_balanced=None, view_bank_dir=None,
+                   shrink_decoded=False):
+    if data_service is not None and (pixel_store_dir is not None or view_bank_dir is not None):
+        raise ValueError('the pixel store is read with numpy, which cannot run on tf.data service workers')
+    if view_bank_dir is not None and class_balanced:
+        raise ValueError('the view bank cannot be sampled class balanced')
+    if pixel_store_dir is None and class_balanced:
+        raise ValueError('only the pixel store can be sampled class balanced')
+
+    # Every tf.data service worker runs the whole pipeline, so every worker draws its own random order. A seeded
+    # order would be the same on all workers and feed the trainer every example once per worker. The interleaved
+    # worker streams cannot be replayed, so resumed runs do not skip anything either
+    if data_service is not None:
+        if skip > 0:
+            logging.warning(f'the data order of the tf.data service cannot be replayed. not skipping {skip} examples')
+        seed, skip = None, 0
+
+    # Decoded caches always hold full resolution images. Only the views are cropped at `imsize`
+    full_imsize = ds_info.features['image'].shape[0] or 224
+    imsize = imsize or full_imsize
+    channels = ds_info.features['image'].shape[2]
+
+    # Augment batches instead of examples?
+    example_augment_config = _without_augment(augment_config) if batch_augment else augment_config
+
+    if view_bank_dir is not None:
+        # Sample distinct pre-augmented views of every example from the view bank
+        view_names = [view_config.name for view_config in augment_config.view_configs]
+        ds = view_bank.load_split(view_bank_dir, input_ctx, len(view_names), shuffle, repeat, seed, skip)
+
+        # Only split the views up
+        def preprocess_fn(views, label):
+            if imsize != full_imsize:
+                views = tf.saturate_cast(tf.round(tf.image.resize(views, [imsize, imsize])), tf.uint8)
+            return {name: views[i] for i, name in enumerate(view_names)}, {'label': label}
+    elif pixel_store_dir is not None:
+        # Load decoded images and labels from the memory-mapped pixel store
+        if class_balanced:
+            num_classes = ds_info.features['label'].num_classes
+            ds = class_sampler.load_split(pixel_store_dir, data_id, split, num_classes, input_ctx, global_bsz,
+                                          class_balanced, seed, skip)
+        else:
+            ds = pixel_store.load_split(pixel_store_dir, data_id, split, input_ctx, shuffle, repeat, seed, skip)
+        logging.info(f"reading {split} dataset from pixel store '{pixel_store_dir}'")
+
+        # Preprocess
+        preprocess_fn = partial(process_decoded_example, imsize=imsize, channels=channels,
+                                augment_config=example_augment_config)
+    elif cache in DECODED_CACHE_TIERS:
+        # Decode (and optionally shrink) the images once and cache them. Shards are read in a fixed order so that
+        # disk caches can be reused across runs
+        ds = _read_encoded_dataset(input_ctx, data_id, split, shuffle and cache == 'decoded', data_dir, seed,
+                                   cycle_length)
+        image_format = get_image_format(ds_info)
+        decode_fn = partial(decode_and_resize, imsize=full_imsize, channels=channels, image_format=image_format,
+                            shrink=shrink_decoded)
+        ds = ds.map(decode_fn, tf.data.AUTOTUNE)
+
+        # Shrunk and full resolution caches are kept apart
+        tag = '-shrunk' if shrink_decoded else ''
+        cache_path = os.path.join(cache_dir, cache, data_id,
+                                  f'{split}-{input_ctx.input_pipeline_id}-of-{input_ctx.num_input_pipelines}{tag}')
+        ds = _cache_decoded(ds, cache, cache_path)
+        logging.info(f'caching decoded {split} dataset ({cache})')
+
+        buffer_bytes = example_bytes(ds_info, split, decoded=True, shrink=shrink_decoded)
+        buffer_size = shuffle_buffer_size(ds_info, split, input_ctx, shuffle_mb, decoded=True, shrink=shrink_decoded)
+        ds = _shuffle_and_repeat(ds, split, shuffle, repeat, seed, skip, buffer_size, buffer_bytes,
+                                 shard_num_examples(ds_info, split, input_ctx))
+
+        # Preprocess
+        def preprocess_fn(image, label, is_jpeg):
+            is_jpeg = is_jpeg if image_format is None else image_format == 'jpeg'
+            return process_decoded_example(image, label, imsize, channels, example_augment_config, is_jpeg)
+    else:
+        ds = _read_encoded_dataset(input_ctx, data_id, split, shuffle, data_dir, seed, cycle_length)
+
+        # Cache?
+        if cache:
+            ds = ds.cache()
+            logging.info(f'caching {split} dataset')
+
+        buffer_bytes = example_bytes(ds_info, split)
+        buffer_size = shuffle_buffer_size(ds_info, split, input_ctx, shuffle_mb)
+        ds = _shuffle_and_repeat(ds, split, shuffle, repeat, seed, skip, buffer_size, buffer_bytes,
+                                 shard_num_examples(ds_info, split, input_ctx))
+
+        # Preprocess
+        if decode_once:
+            image_format = get_image_format(ds_info)
+            preprocess_fn = partial(process_encoded_example_once, imsize=imsize, channels=channels,
+                                    augment_config=example_augment_config, image_format=image_format)
+            logging.info(f'decoding each {split} example once for all views '
+                         f'(image format: {image_format or "mixed"})')
+        else:
+            preprocess_fn = partial(process_encoded_example, imsize=imsize, channels=channels,
+                                    augment_config=example_augment_config)
     ds = ds.map(preprocess_fn, tf.data.AUTOTUNE)
 
     # Batch
     per_replica_bsz = input_ctx.get_per_replica_batch_size(global_bsz)
     ds = ds.batch(per_replica_bsz, drop_remainder=True)
 
+    if batch_augment:
+        ds = ds.map(partial(augment_batch, augment_config=augment_config), tf.data.AUTOTUNE)
+        logging.info(f'augmenting {split} dataset in batches')
+
     if len(augment_config.view_configs) > 1:
         ds = ds.map(add_contrast_data, tf.data.AUTOTUNE)
 
+    # Preprocess on the tf.data service workers?
+    if data_service is not None:
+        ds = service.distribute(ds, data_service)
+        logging.info(f'preprocessing {split} dataset on tf.data service {data_service}')
+
     # Prefetch
     ds = ds.prefetch(tf.data.AUTOTUNE)
 
     return ds
 
 
-def load_distributed_datasets(args, strategy, ds_info, split, augment_config, shuffle=False):
-    ds_fn = partial(source_dataset, ds_info=ds_info, data_id=args.data_id, split=split, cache=args.cache,
-                    augment_config=augment_config, shuffle=shuffle, repeat=True, global_bsz=args.bsz)
+def load_distributed_datasets(args, strategy, ds_info, split, augment_config, shuffle=False, skip_steps=0,
+                              materialized=None, imsize=None, class_balanced=None, view_bank_dir=None, seed=None):
+    seed = args.data_seed if seed is None else seed
+
+    def ds_fn(input_ctx):
+        # Materialized examples?
+        if materialized is not None:
+            ds = val_cache.materialized_dataset(materialized, input_ctx, augment_config, args.bsz)
+            if len(augment_config.view_configs) > 1:
+                ds = ds.map(add_contrast_data, tf.data.AUTOTUNE)
+            return ds.prefetch(tf.data.AUTOTUNE)
+
+        # Every input pipeline consumes its share of each global batch
+        skip = skip_steps * args.bsz // input_ctx.num_input_pipelines
+        return source_dataset(input_ctx, ds_info=ds_info, data_id=args.data_id, split=split, cache=args.cache,
+                              augment_config=augment_config, shuffle=shuffle, repeat=True, global_bsz=args.bsz,
+                              decode_once=args.decode_once, pixel_store_dir=args.pixel_store,
+                              batch_augment=args.batch_augment, data_dir=args.data_dir, cache_dir=args.cache_dir,
+                              seed=seed, skip=skip, data_service=args.data_service,
+                              shuffle_mb=args.shuffle_mb, cycle_length=args.read_cycle_length, imsize=imsize,
+                              class_balanced=class_balanced, view_bank_dir=view_bank_dir,
+                              shrink_decoded=args.shrink_decoded)
 
     ds = strategy.distribute_datasets_from_function(ds_fn)
     return ds
+
+
+def export_view_bank(args, ds_info, augment_config):
+    """Exports the view bank of the training split if `--view-bank` is set and returns its directory."""
+    if args.view_bank is None:
+        return None
+    # The host only center crops under --device-augment, so all K views would be the same
+    if args.device_augment:
+        raise ValueError('the view bank holds host augmented views and does not work with --device-augment')
+    # The bank has its own seed, so that runs with different data orders share it
+    tag = '-autoaugment' if args.autoaugment else ''
+    out_dir = view_bank.bank_dir(args.cache_dir, args.data_id, 'train', args.view_bank, args.view_bank_seed, tag)
+    return view_bank.ensure_exported(ds_info, args.data_id, 'train', augment_config.view_configs[0],
+                                     args.view_bank, out_dir, args.view_bank_seed, args.data_dir)
+
+
+def materialize_val_dataset(args, ds_info, split, augment_config):
+    """Materializes the validation split if `--val-cache` is set, otherwise returns None."""
+    if args.val_cache is None:
+        return None
+    out_dir = None
+    if args.val_cache == 'disk':
+        tag = '-autoaugment' if args.autoaugment else ''
+        out_dir = val_cache.cache_dir_for(args.cache_dir, args.data_id, split, args.val_seed, tag)
+    return val_cache.materialize(ds_info, args.data_id, split, augment_config, args.val_seed, out_dir,
+                                 args.data_dir)
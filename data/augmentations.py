@@ -27,8 +27,11 @@ import math
 from typing import Any, Dict, List, Optional, Text, Tuple
 
 import tensorflow as tf
+from tensorflow.python.eager import context
 from tensorflow.python.keras.layers.preprocessing import image_preprocessing as image_ops
 
+from ops.color_ops import degenerate_gray, per_image, batch_brightness, batch_color, batch_contrast, batch_sharpness
+
 # This signifies the max integer that the controller RNN could predict for the
 # augmentation scheme.
 _MAX_LEVEL = 10.
@@ -307,7 +310,7 @@ def cutout(image: tf.Tensor, pad_size: int, replace: int = 0) -> tf.Tensor:
         padding_dims,
         constant_values=1)
     mask = tf.expand_dims(mask, -1)
-    mask = tf.tile(mask, [1, 1, 3])
+    mask = tf.tile(mask, [1, 1, tf.shape(image)[-1]])
     image = tf.where(
         tf.equal(mask, 0),
         tf.ones_like(image, dtype=image.dtype) * replace, image)
@@ -335,24 +338,19 @@ def solarize_add(image: tf.Tensor,
 
 def color(image: tf.Tensor, factor: float) -> tf.Tensor:
     """Equivalent of PIL Color."""
-    degenerate = tf.image.grayscale_to_rgb(tf.image.rgb_to_grayscale(image))
+    degenerate = degenerate_gray(image)
     return blend(degenerate, image, factor)
 
 
 def contrast(image: tf.Tensor, factor: float) -> tf.Tensor:
     """Equivalent of PIL Contrast."""
-    degenerate = tf.image.rgb_to_grayscale(image)
-    # Cast before calling tf.histogram.
-    degenerate = tf.cast(degenerate, tf.int32)
-
-    # Compute the grayscale histogram, then compute the mean pixel value,
-    # and create a constant image size of that value.  Use that as the
-    # blending degenerate target of the original image.
-    hist = tf.histogram_fixed_width(degenerate, [0, 255], nbins=256)
-    mean = tf.reduce_sum(tf.cast(hist, tf.float32)) / 256.0
-    degenerate = tf.ones_like(degenerate, dtype=tf.float32) * mean
-    degenerate = tf.clip_by_value(degenerate, 0.0, 255.0)
-    degenerate = tf.image.grayscale_to_rgb(tf.cast(degenerate, tf.uint8))
+    # The mean pixel value is the sum of the grayscale histogram divided by 256,
+    # i.e. the number of pixels divided by 256. Create a constant image of that value
+    # and use it as the blending degenerate target of the original image.
+    shape = tf.shape(image)
+    mean = tf.cast(shape[0] * shape[1], tf.float32) / 256.0
+    mean = tf.cast(tf.clip_by_value(mean, 0.0, 255.0), tf.uint8)
+    degenerate = tf.fill(shape, mean)
     return blend(degenerate, image, factor)
 
 
@@ -411,6 +409,8 @@ def shear_y(image: tf.Tensor, level: float, replace: int) -> tf.Tensor:
 def autocontrast(image: tf.Tensor) -> tf.Tensor:
     """Implements Autocontrast function from PIL using TF ops.
 
+    Scales every channel independently, for any number of channels.
+
     Args:
       image: A 3D uint8 tensor.
 
@@ -418,33 +418,7 @@ def autocontrast(image: tf.Tensor) -> tf.Tensor:
       The image after it has had autocontrast applied to it and will be of type
       uint8.
     """
-
-    def scale_channel(image: tf.Tensor) -> tf.Tensor:
-        """Scale the 2D image using the autocontrast rule."""
-        # A possibly cheaper version can be done using cumsum/unique_with_counts
-        # over the histogram values, rather than iterating over the entire image.
-        # to compute mins and maxes.
-        lo = tf.cast(tf.reduce_min(image), tf.float32)
-        hi = tf.cast(tf.reduce_max(image), tf.float32)
-
-        # Scale the image, making the lowest value 0 and the highest value 255.
-        def scale_values(im):
-            scale = 255.0 / (hi - lo)
-            offset = -lo * scale
-            im = tf.cast(im, tf.float32) * scale + offset
-            im = tf.clip_by_value(im, 0.0, 255.0)
-            return tf.cast(im, tf.uint8)
-
-        result = tf.cond(hi > lo, lambda: scale_values(image), lambda: image)
-        return result
-
-    # Assumes RGB for now.  Scales each channel independently
-    # and then stacks the result.
-    s1 = scale_channel(image[:, :, 0])
-    s2 = scale_channel(image[:, :, 1])
-    s3 = scale_channel(image[:, :, 2])
-    image = tf.stack([s1, s2, s3], 2)
-    return image
+    return batch_autocontrast(image[None])[0]
 
 
 def sharpness(image: tf.Tensor, factor: float) -> tf.Tensor:
@@ -458,7 +432,7 @@ def sharpness(image: tf.Tensor, factor: float) -> tf.Tensor:
                          dtype=tf.float32,
                          shape=[3, 3, 1, 1]) / 13.
     # Tile across channel dimension.
-    kernel = tf.tile(kernel, [1, 1, 3, 1])
+    kernel = tf.tile(kernel, [1, 1, orig_image.shape[-1], 1])
     strides = [1, 1, 1, 1]
     degenerate = tf.nn.depthwise_conv2d(
         image, kernel, strides, padding='VALID', dilations=[1, 1])
@@ -477,44 +451,11 @@ def sharpness(image: tf.Tensor, factor: float) -> tf.Tensor:
 
 
 def equalize(image: tf.Tensor) -> tf.Tensor:
-    """Implements Equalize function from PIL using TF ops."""
-
-    def scale_channel(im, c):
-        """Scale the data in the channel to implement equalize."""
-        im = tf.cast(im[:, :, c], tf.int32)
-        # Compute the histogram of the image channel.
-        histo = tf.histogram_fixed_width(im, [0, 255], nbins=256)
-
-        # For the purposes of computing the step, filter out the nonzeros.
-        nonzero = tf.where(tf.not_equal(histo, 0))
-        nonzero_histo = tf.reshape(tf.gather(histo, nonzero), [-1])
-        step = (tf.reduce_sum(nonzero_histo) - nonzero_histo[-1]) // 255
-
-        def build_lut(histo, step):
-            # Compute the cumulative sum, shifting by step // 2
-            # and then normalization by step.
-            lut = (tf.cumsum(histo) + (step // 2)) // step
-            # Shift lut, prepending with 0.
-            lut = tf.concat([[0], lut[:-1]], 0)
-            # Clip the counts to be in range.  This is done
-            # in the C code for image.point.
-            return tf.clip_by_value(lut, 0, 255)
-
-        # If step is zero, return the original image.  Otherwise, build
-        # lut from the full histogram and step and then index from it.
-        result = tf.cond(
-            tf.equal(step, 0), lambda: im,
-            lambda: tf.gather(build_lut(histo, step), im))
-
-        return tf.cast(result, tf.uint8)
-
-    # Assumes RGB for now.  Scales each channel independently
-    # and then stacks the result.
-    s1 = scale_channel(image, 0)
-    s2 = scale_channel(image, 1)
-    s3 = scale_channel(image, 2)
-    image = tf.stack([s1, s2, s3], 2)
-    return image
+    """Implements Equalize function from PIL using TF ops.
+
+    Equalizes every channel independently, for any number of channels.
+    """
+    return batch_equalize(image[None])[0]
 
 
 def invert(image: tf.Tensor) -> tf.Tensor:
@@ -535,7 +476,7 @@ def unwrap(image: tf.Tensor, replace: int) -> tf.Tensor:
     """Unwraps an image produced by wrap.
 
     Where there is a 0 in the last channel for every spatial position,
-    the rest of the three channels in that spatial dimension are grayed
+    the rest of the channels in that spatial dimension are grayed
     (set to 128).  Operations like translate and shear on a wrapped
     Tensor will leave 0s in empty locations.  Some transformations look
     at the intensity of values to do preprocessing, and we want these
@@ -543,19 +484,22 @@ def unwrap(image: tf.Tensor, replace: int) -> tf.Tensor:
 
 
     Args:
-      image: A 3D Image Tensor with 4 channels.
-      replace: A one or three value 1D tensor to fill empty pixels.
+      image: A 3D Image Tensor with C + 1 channels.
+      replace: A one or C value 1D tensor to fill empty pixels.
 
     Returns:
-      image: A 3D image Tensor with 3 channels.
+      image: A 3D image Tensor with C channels.
     """
     image_shape = tf.shape(image)
+    num_channels = image_shape[2] - 1
     # Flatten the spatial dimensions.
     flattened_image = tf.reshape(image, [-1, image_shape[2]])
 
     # Find all pixels where the last channel is zero.
-    alpha_channel = tf.expand_dims(flattened_image[:, 3], axis=-1)
+    alpha_channel = flattened_image[:, -1:]
 
+    replace = tf.reshape(tf.cast(replace, image.dtype), [-1])[:num_channels]
+    replace = tf.broadcast_to(replace, [num_channels])
     replace = tf.concat([replace, tf.ones([1], image.dtype)], 0)
 
     # Where they are zero, fill them in with 'replace'.
@@ -565,7 +509,7 @@ def unwrap(image: tf.Tensor, replace: int) -> tf.Tensor:
         flattened_image)
 
     image = tf.reshape(flattened_image, image_shape)
-    image = tf.slice(image, [0, 0, 0], [image_shape[0], image_shape[1], 3])
+    image = tf.slice(image, [0, 0, 0], [image_shape[0], image_shape[1], num_channels])
     return image
 
 
@@ -625,9 +569,12 @@ def _apply_func_with_prob(func: Any, image: tf.Tensor, args: Any, prob: float):
     return augmented_image
 
 
-def select_and_apply_random_policy(policies: Any, image: tf.Tensor):
+def select_and_apply_random_policy(policies: Any, image: tf.Tensor, telemetry: Any = None):
     """Select a random policy from `policies` and apply it to `image`."""
     policy_to_select = tf.random.uniform([], maxval=len(policies), dtype=tf.int32)
+    if telemetry is not None:
+        with tf.control_dependencies([telemetry.count_policy(policy_to_select)]):
+            policy_to_select = tf.identity(policy_to_select)
     # Note that using tf.case instead of tf.conds would result in significantly
     # larger graphs and would even break export for some larger policies.
     for (i, policy) in enumerate(policies):
@@ -638,6 +585,136 @@ def select_and_apply_random_policy(policies: Any, image: tf.Tensor):
     return image
 
 
+# Ops that are a single projective transform of the wrapped image
+GEOMETRIC_OPS = frozenset({'Rotate', 'ShearX', 'ShearY', 'TranslateX', 'TranslateY'})
+
+
+def _to_matrix(transforms: tf.Tensor) -> tf.Tensor:
+    """Projective transform of shape [8] -> 3x3 matrix."""
+    transforms = tf.reshape(tf.cast(transforms, tf.float32), [8])
+    return tf.reshape(tf.concat([transforms, [1.]], 0), [3, 3])
+
+
+def geometric_matrix(name: Text, image: tf.Tensor, arg: Any) -> tf.Tensor:
+    """The 3x3 matrix that maps output to input pixel coordinates of geometric op `name`."""
+    if name == 'Rotate':
+        radians = tf.cast(arg, tf.float32) * (math.pi / 180.0)
+        height, width = tf.cast(tf.shape(image)[0], tf.float32), tf.cast(tf.shape(image)[1], tf.float32)
+        transforms = _convert_angles_to_transform(radians, image_width=width, image_height=height)
+    elif name == 'TranslateX':
+        transforms = _convert_translation_to_transform([-arg, 0])
+    elif name == 'TranslateY':
+        transforms = _convert_translation_to_transform([0, -arg])
+    elif name == 'ShearX':
+        transforms = tf.stack([1., arg, 0., 0., 1., 0., 0., 0.])
+    elif name == 'ShearY':
+        transforms = tf.stack([1., 0., 0., arg, 1., 0., 0., 0.])
+    else:
+        raise ValueError(f'{name} is not a geometric op')
+    return _to_matrix(transforms)
+
+
+def fused_transform(image: tf.Tensor, matrix: tf.Tensor, replace: Any) -> tf.Tensor:
+    """Applies a composed 3x3 matrix with a single wrap, resample and unwrap."""
+    transforms = tf.reshape(matrix / matrix[2, 2], [9])[:8]
+    return unwrap(transform(wrap(image), transforms), replace)
+
+
+def _apply_sub_policy(image: tf.Tensor, sub_policy: Any, replace_value: Any, cutout_const: float,
+                      translate_const: float, fuse_geometric: bool, telemetry: Any = None) -> tf.Tensor:
+    """Applies the ops of a sub-policy in order, each with its probability.
+
+    With `fuse_geometric`, runs of consecutive geometric ops are composed into one matrix and resampled once.
+    Op A followed by op B samples the input at M_A @ M_B, since each matrix maps output to input coordinates.
+    Fused ops are only counted by the `telemetry`, not timed.
+    """
+    matrix, any_applied = None, None
+
+    def flush(image_):
+        if matrix is None:
+            return image_
+        return tf.cond(any_applied, lambda: fused_transform(image_, matrix, replace_value), lambda: image_)
+
+    for name, prob, level in sub_policy:
+        func, prob, args = _parse_policy_info(name, prob, level, replace_value, cutout_const, translate_const)
+        if not (fuse_geometric and name in GEOMETRIC_OPS):
+            image = flush(image)
+            matrix, any_applied = None, None
+            if telemetry is not None:
+                func = telemetry.instrument(name, func)
+            image = _apply_func_with_prob(func, image, args, prob)
+            continue
+
+        # Compose instead of applying
+        should_apply_op = tf.cast(tf.floor(tf.random.uniform([], dtype=tf.float32) + prob), tf.bool)
+        op_matrix = tf.where(should_apply_op, geometric_matrix(name, image, args[0]), tf.eye(3))
+        if telemetry is not None:
+            with tf.control_dependencies([telemetry.count(name, should_apply_op)]):
+                op_matrix = tf.identity(op_matrix)
+        if matrix is None:
+            matrix, any_applied = op_matrix, should_apply_op
+        else:
+            matrix, any_applied = tf.matmul(matrix, op_matrix), any_applied | should_apply_op
+
+    return flush(image)
+
+
+def _policy_key(policies: Any) -> Tuple:
+    return tuple(tuple(tuple(policy_info) for policy_info in policy) for policy in policies)
+
+
+def graph_seed() -> Optional[int]:
+    """Returns the graph-level seed that a `tf.function` traced here takes its random ops' seeds from.
+
+    A `tf.function` keeps the seeds of its first trace. Cached functions must be cached per graph seed, so that
+    `tf.random.set_seed` still seeds them, e.g. in a seeded `tf.data` map function.
+    """
+    if tf.executing_eagerly():
+        return context.global_seed()
+    return tf.compat.v1.get_default_graph().seed
+
+
+# Compiled policy executors shared by all AutoAugment instances
+_COMPILED_POLICIES = {}
+
+
+def compile_policies(policies: Any, dtype: tf.DType, shape: tf.TensorShape, cutout_const: float,
+                     translate_const: float, fuse_geometric: bool = False, telemetry: Any = None):
+    """Compiles a policy table into a `tf.function` that applies one random sub-policy to an image.
+
+    The sub-policies are the branches of a single `switch_case`, instead of one `tf.cond` per sub-policy. The
+    compiled function is cached per (policy, dtype, shape, graph seed), so it is only traced once, whether it is
+    called eagerly or from within other graphs. With `fuse_geometric`, consecutive geometric ops are resampled once.
+    With `telemetry`, the sub-policies and ops are counted and timed by it.
+    """
+    shape = tf.TensorShape(shape)
+    key = (_policy_key(policies), tf.as_dtype(dtype), tuple(shape.as_list()), cutout_const, translate_const,
+           fuse_geometric, telemetry, graph_seed())
+    if key in _COMPILED_POLICIES:
+        return _COMPILED_POLICIES[key]
+
+    replace_value = [128] * (shape[-1] or 3)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape, dtype)])
+    def apply_policy(image):
+        if image.dtype != tf.uint8:
+            image = tf.cast(tf.clip_by_value(image, 0.0, 255.0), tf.uint8)
+
+        def make_branch(sub_policy):
+            return lambda: _apply_sub_policy(image, sub_policy, replace_value, cutout_const, translate_const,
+                                             fuse_geometric, telemetry)
+
+        policy_to_select = tf.random.uniform([], maxval=len(policies), dtype=tf.int32)
+        if telemetry is not None:
+            with tf.control_dependencies([telemetry.count_policy(policy_to_select)]):
+                policy_to_select = tf.identity(policy_to_select)
+        augmented = tf.switch_case(policy_to_select, [make_branch(sub_policy) for sub_policy in policies])
+        return tf.cast(augmented, dtype)
+
+    _COMPILED_POLICIES[key] = apply_policy
+    return apply_policy
+
+
 NAME_TO_FUNC = {
     'AutoContrast': autocontrast,
     'Equalize': equalize,
@@ -738,7 +815,10 @@ class AutoAugment(ImageAugment):
                  augmentation_name: Text = 'v0',
                  policies: Optional[Dict[Text, Any]] = None,
                  cutout_const: float = 100,
-                 translate_const: float = 250):
+                 translate_const: float = 250,
+                 compiled: bool = True,
+                 fuse_geometric: bool = False,
+                 telemetry: Optional[Any] = None):
         """Applies the AutoAugment policy to images.
 
         Args:
@@ -755,6 +835,11 @@ class AutoAugment(ImageAugment):
             argument for `func`.
           cutout_const: multiplier for applying cutout.
           translate_const: multiplier for applying translation.
+          compiled: apply the policy with the cached executor of `compile_policies`.
+          fuse_geometric: resample consecutive geometric ops of a sub-policy once.
+            Only used if `compiled`.
+          telemetry: optional `telemetry.AugmentTelemetry` that counts and times
+            the applied sub-policies and ops.
         """
         super(AutoAugment, self).__init__()
 
@@ -774,6 +859,9 @@ class AutoAugment(ImageAugment):
         self.policies = self.available_policies[augmentation_name]
         self.cutout_const = float(cutout_const)
         self.translate_const = float(translate_const)
+        self.compiled = compiled
+        self.fuse_geometric = fuse_geometric
+        self.telemetry = telemetry
 
     def distort(self, image: tf.Tensor) -> tf.Tensor:
         """Applies the AutoAugment policy to `image`.
@@ -787,13 +875,19 @@ class AutoAugment(ImageAugment):
           A version of image that now has data augmentation applied to it based on
           the `policies` pass into the function.
         """
+        if self.compiled:
+            image = tf.convert_to_tensor(image)
+            apply_policy = compile_policies(self.policies, image.dtype, image.shape, self.cutout_const,
+                                            self.translate_const, self.fuse_geometric, self.telemetry)
+            return apply_policy(image)
+
         input_image_type = image.dtype
 
         if input_image_type != tf.uint8:
             image = tf.clip_by_value(image, 0.0, 255.0)
             image = tf.cast(image, dtype=tf.uint8)
 
-        replace_value = [128] * 3
+        replace_value = [128] * (image.shape[-1] or 3)
 
         # func is the string name of the augmentation function, prob is the
         # probability of applying the operation and level is the parameter
@@ -810,7 +904,10 @@ class AutoAugment(ImageAugment):
                 policy_info = list(policy_info) + [
                     replace_value, self.cutout_const, self.translate_const
                 ]
-                tf_policy.append(_parse_policy_info(*policy_info))
+                func, prob, args = _parse_policy_info(*policy_info)
+                if self.telemetry is not None:
+                    func = self.telemetry.instrument(policy_info[0], func)
+                tf_policy.append((func, prob, args))
 
             # Now build the tf policy that will apply the augmentation procedue
             # on image.
@@ -825,7 +922,7 @@ class AutoAugment(ImageAugment):
 
             tf_policies.append(make_final_policy(tf_policy))
 
-        image = select_and_apply_random_policy(tf_policies, image)
+        image = select_and_apply_random_policy(tf_policies, image, self.telemetry)
         image = tf.cast(image, dtype=input_image_type)
         return image
 
@@ -924,7 +1021,8 @@ class RandAugment(ImageAugment):
                  num_layers: int = 2,
                  magnitude: float = 10.,
                  cutout_const: float = 40.,
-                 translate_const: float = 100.):
+                 translate_const: float = 100.,
+                 telemetry: Optional[Any] = None):
         """Applies the RandAugment policy to images.
 
         Args:
@@ -936,8 +1034,11 @@ class RandAugment(ImageAugment):
             [5, 10].
           cutout_const: multiplier for applying cutout.
           translate_const: multiplier for applying translation.
+          telemetry: optional `telemetry.AugmentTelemetry` that counts and times
+            the applied ops.
         """
         super(RandAugment, self).__init__()
+        self.telemetry = telemetry
 
         self.num_layers = num_layers
         self.magnitude = float(magnitude)
@@ -964,7 +1065,7 @@ class RandAugment(ImageAugment):
             image = tf.clip_by_value(image, 0.0, 255.0)
             image = tf.cast(image, dtype=tf.uint8)
 
-        replace_value = [128] * 3
+        replace_value = [128] * (image.shape[-1] or 3)
         min_prob, max_prob = 0.2, 0.8
 
         for _ in range(self.num_layers):
@@ -981,6 +1082,8 @@ class RandAugment(ImageAugment):
                 func, _, args = _parse_policy_info(op_name, prob, self.magnitude,
                                                    replace_value, self.cutout_const,
                                                    self.translate_const)
+                if self.telemetry is not None:
+                    func = self.telemetry.instrument(op_name, func)
                 branch_fns.append((
                     i,
                     # pylint:disable=g-long-lambda
@@ -997,13 +1100,322 @@ class RandAugment(ImageAugment):
         return image
 
 
+def batch_cutout(images: tf.Tensor, pad_sizes: tf.Tensor, replace: int = 0) -> tf.Tensor:
+    """Same as `cutout`, but over a batch of images with one pad size per image."""
+    shape = tf.shape(images)
+    pad_sizes = tf.cast(pad_sizes, tf.int32)[:, None]
+
+    # Sample the center location in each image where the zero mask will be applied.
+    center_height = tf.random.uniform([shape[0], 1], maxval=shape[1], dtype=tf.int32)
+    center_width = tf.random.uniform([shape[0], 1], maxval=shape[2], dtype=tf.int32)
+
+    rows, cols = tf.range(shape[1])[None], tf.range(shape[2])[None]
+    in_rows = (rows >= center_height - pad_sizes) & (rows < center_height + pad_sizes)
+    in_cols = (cols >= center_width - pad_sizes) & (cols < center_width + pad_sizes)
+    mask = in_rows[:, :, None, None] & in_cols[:, None, :, None]
+    return tf.where(mask, tf.cast(replace, images.dtype), images)
+
+
+def batch_solarize(images: tf.Tensor, thresholds: tf.Tensor) -> tf.Tensor:
+    """Same as `solarize`, but over a batch of images with one threshold per image."""
+    below = tf.cast(images, tf.int32) < per_image(thresholds, tf.int32)
+    return tf.where(below, images, 255 - images)
+
+
+def batch_solarize_add(images: tf.Tensor, additions: tf.Tensor, threshold: int = 128) -> tf.Tensor:
+    """Same as `solarize_add`, but over a batch of images with one addition per image."""
+    added_images = tf.cast(images, tf.int64) + per_image(additions, tf.int64)
+    added_images = tf.cast(tf.clip_by_value(added_images, 0, 255), tf.uint8)
+    return tf.where(images < threshold, added_images, images)
+
+
+def batch_posterize(images: tf.Tensor, bits: tf.Tensor) -> tf.Tensor:
+    shift = tf.broadcast_to(per_image(8 - bits, tf.uint8), tf.shape(images))
+    return tf.bitwise.left_shift(tf.bitwise.right_shift(images, shift), shift)
+
+
+def batch_autocontrast(images: tf.Tensor) -> tf.Tensor:
+    """Same as `autocontrast`, but over every channel of a batch of images at once."""
+    lo = tf.cast(tf.reduce_min(images, axis=[1, 2], keepdims=True), tf.float32)
+    hi = tf.cast(tf.reduce_max(images, axis=[1, 2], keepdims=True), tf.float32)
+
+    # Scale the images, making the lowest value 0 and the highest value 255.
+    scale = tf.math.divide_no_nan(255.0, hi - lo)
+    offset = -lo * scale
+    scaled = tf.cast(images, tf.float32) * scale + offset
+    scaled = tf.cast(tf.clip_by_value(scaled, 0.0, 255.0), tf.uint8)
+    return tf.where(hi > lo, scaled, images)
+
+
+def batch_equalize(images: tf.Tensor) -> tf.Tensor:
+    """Same as `equalize`, but over every channel of a batch of images at once.
+
+    The histograms of all (image, channel) pairs are computed with a single bincount by offsetting the pixel
+    values of each pair into its own range of 256 bins.
+    """
+    shape = tf.shape(images)
+    num_pairs = shape[0] * shape[3]
+    offsets = tf.reshape(tf.range(num_pairs) * 256, [shape[0], 1, 1, shape[3]])
+    values = tf.cast(images, tf.int32) + offsets
+
+    histo = tf.math.bincount(tf.reshape(values, [-1]), minlength=num_pairs * 256, maxlength=num_pairs * 256)
+    histo = tf.reshape(histo, [shape[0], shape[3], 256])
+
+    # For the purposes of computing the step, filter out the nonzeros.
+    last_nonzero = tf.reduce_max(tf.where(histo != 0, tf.range(256), 0), axis=-1)
+    last_nonzero_histo = tf.gather(histo, last_nonzero, batch_dims=2)
+    step = (tf.reduce_sum(histo, axis=-1) - last_nonzero_histo) // 255
+
+    # Compute the cumulative sum, shifting by step // 2
+    # and then normalization by step.
+    safe_step = tf.maximum(step, 1)[..., None]
+    lut = (tf.cumsum(histo, axis=-1) + (safe_step // 2)) // safe_step
+    # Shift lut, prepending with 0.
+    lut = tf.pad(lut[..., :-1], [[0, 0], [0, 0], [1, 0]])
+    lut = tf.clip_by_value(lut, 0, 255)
+
+    # If step is zero, keep the original channel. Otherwise index from the lut.
+    result = tf.cast(tf.gather(tf.reshape(lut, [-1]), values), tf.uint8)
+    keep = tf.reshape(tf.equal(step, 0), [shape[0], 1, 1, shape[3]])
+    return tf.where(keep, images, result)
+
+
+def batch_invert(images: tf.Tensor) -> tf.Tensor:
+    return 255 - images
+
+
+def batch_wrap(images: tf.Tensor) -> tf.Tensor:
+    """Returns `images` with an extra channel set to all 1s."""
+    return tf.concat([images, tf.ones_like(images[..., :1])], axis=3)
+
+
+def batch_unwrap(images: tf.Tensor, replace: int) -> tf.Tensor:
+    """Unwraps images produced by `batch_wrap` and fills the empty pixels with `replace`."""
+    alpha_channel = images[..., -1:]
+    images = images[..., :-1]
+    return tf.where(tf.equal(alpha_channel, 0), tf.cast(replace, images.dtype), images)
+
+
+def batch_transform(images: tf.Tensor, transforms: tf.Tensor, replace: int) -> tf.Tensor:
+    """Applies one projective transform of shape [8] per image, filling empty pixels with `replace`."""
+    images = image_ops.transform(images=batch_wrap(images), transforms=transforms, interpolation='nearest')
+    return batch_unwrap(images, replace)
+
+
+def batch_rotate(images: tf.Tensor, degrees: tf.Tensor, replace: int) -> tf.Tensor:
+    radians = tf.cast(degrees, tf.float32) * (math.pi / 180.0)
+    image_height = tf.cast(tf.shape(images)[1], tf.float32)
+    image_width = tf.cast(tf.shape(images)[2], tf.float32)
+    transforms = _convert_angles_to_transform(angles=radians, image_width=image_width, image_height=image_height)
+    return batch_transform(images, transforms, replace)
+
+
+def batch_translate_x(images: tf.Tensor, pixels: tf.Tensor, replace: int) -> tf.Tensor:
+    pixels = tf.cast(pixels, tf.float32)
+    transforms = _convert_translation_to_transform(tf.stack([-pixels, tf.zeros_like(pixels)], axis=1))
+    return batch_transform(images, transforms, replace)
+
+
+def batch_translate_y(images: tf.Tensor, pixels: tf.Tensor, replace: int) -> tf.Tensor:
+    pixels = tf.cast(pixels, tf.float32)
+    transforms = _convert_translation_to_transform(tf.stack([tf.zeros_like(pixels), -pixels], axis=1))
+    return batch_transform(images, transforms, replace)
+
+
+def batch_shear_x(images: tf.Tensor, levels: tf.Tensor, replace: int) -> tf.Tensor:
+    levels = tf.cast(levels, tf.float32)
+    ones, zeros = tf.ones_like(levels), tf.zeros_like(levels)
+    transforms = tf.stack([ones, levels, zeros, zeros, ones, zeros, zeros, zeros], axis=1)
+    return batch_transform(images, transforms, replace)
+
+
+def batch_shear_y(images: tf.Tensor, levels: tf.Tensor, replace: int) -> tf.Tensor:
+    levels = tf.cast(levels, tf.float32)
+    ones, zeros = tf.ones_like(levels), tf.zeros_like(levels)
+    transforms = tf.stack([ones, zeros, zeros, levels, ones, zeros, zeros, zeros], axis=1)
+    return batch_transform(images, transforms, replace)
+
+
+BATCH_NAME_TO_FUNC = {
+    'AutoContrast': batch_autocontrast,
+    'Equalize': batch_equalize,
+    'Invert': batch_invert,
+    'Rotate': batch_rotate,
+    'Posterize': batch_posterize,
+    'Solarize': batch_solarize,
+    'SolarizeAdd': batch_solarize_add,
+    'Color': batch_color,
+    'Contrast': batch_contrast,
+    'Brightness': batch_brightness,
+    'Sharpness': batch_sharpness,
+    'ShearX': batch_shear_x,
+    'ShearY': batch_shear_y,
+    'TranslateX': batch_translate_x,
+    'TranslateY': batch_translate_y,
+    'Cutout': batch_cutout,
+}
+
+
+def _random_signs(levels: tf.Tensor) -> tf.Tensor:
+    """Flips each level to negative with 50% chance."""
+    return tf.where(tf.random.uniform(tf.shape(levels)) < 0.5, -levels, levels)
+
+
+def batch_level_to_arg(cutout_const: float, translate_const: float):
+    """Same as `level_to_arg`, but maps per image levels of shape [N] to per image arguments."""
+
+    no_arg = lambda levels: ()
+    mult_arg = lambda multiplier: lambda levels: (tf.cast((levels / _MAX_LEVEL) * multiplier, tf.int32),)
+    enhance_arg = lambda levels: ((levels / _MAX_LEVEL) * 1.8 + 0.1,)
+    rotate_arg = lambda levels: (_random_signs((levels / _MAX_LEVEL) * 30.),)
+    shear_arg = lambda levels: (_random_signs((levels / _MAX_LEVEL) * 0.3),)
+    translate_arg = lambda levels: (_random_signs((levels / _MAX_LEVEL) * float(translate_const)),)
+
+    args = {
+        'AutoContrast': no_arg,
+        'Equalize': no_arg,
+        'Invert': no_arg,
+        'Rotate': rotate_arg,
+        'Posterize': mult_arg(4),
+        'Solarize': mult_arg(256),
+        'SolarizeAdd': mult_arg(110),
+        'Color': enhance_arg,
+        'Contrast': enhance_arg,
+        'Brightness': enhance_arg,
+        'Sharpness': enhance_arg,
+        'ShearX': shear_arg,
+        'ShearY': shear_arg,
+        'Cutout': mult_arg(cutout_const),
+        'TranslateX': translate_arg,
+        'TranslateY': translate_arg,
+    }
+    return args
+
+
+def _apply_batch_func(name: Text, images: tf.Tensor, selected: tf.Tensor, levels: tf.Tensor,
+                      replace_value: int, cutout_const: float, translate_const: float) -> tf.Tensor:
+    """Applies the batched op `name` to the images where `selected` is True.
+
+    The selected images and their levels are gathered into a smaller batch, augmented together and scattered
+    back, so there is no per image control flow.
+    """
+    func = BATCH_NAME_TO_FUNC[name]
+    indices = tf.where(selected)
+
+    def apply_op():
+        args = batch_level_to_arg(cutout_const, translate_const)[name](tf.gather_nd(levels, indices))
+        if name in REPLACE_FUNCS:
+            args = tuple(list(args) + [replace_value])
+        augmented = func(tf.gather_nd(images, indices), *args)
+        return tf.tensor_scatter_nd_update(images, indices, augmented)
+
+    return tf.cond(tf.size(indices) > 0, apply_op, lambda: images)
+
+
+class BatchAutoAugment(AutoAugment):
+    """Applies the AutoAugment policy to a batch of images of shape [N, H, W, C].
+
+    A sub-policy is sampled for every image. Then, position by position within the sub-policies, each op is
+    applied once to all the images whose sub-policy uses it there.
+    """
+
+    def distort(self, images: tf.Tensor) -> tf.Tensor:
+        input_image_type = images.dtype
+
+        if input_image_type != tf.uint8:
+            images = tf.clip_by_value(images, 0.0, 255.0)
+            images = tf.cast(images, dtype=tf.uint8)
+
+        replace_value = 128
+        batch_size = tf.shape(images)[0]
+        policy_to_select = tf.random.uniform([batch_size], maxval=len(self.policies), dtype=tf.int32)
+
+        for pos in range(max(len(policy) for policy in self.policies)):
+            should_apply_op = None
+            op_names = sorted({policy[pos][0] for policy in self.policies if pos < len(policy)})
+            for name in op_names:
+                # Per policy probability and level of this op at this position
+                probs, levels = [], []
+                for policy in self.policies:
+                    uses_op = pos < len(policy) and policy[pos][0] == name
+                    probs.append(float(policy[pos][1]) if uses_op else 0.)
+                    levels.append(float(policy[pos][2]) if uses_op else 0.)
+                prob = tf.gather(tf.constant(probs, tf.float32), policy_to_select)
+                level = tf.gather(tf.constant(levels, tf.float32), policy_to_select)
+
+                # Each image uses at most one op per position, so one random draw per position is enough
+                if should_apply_op is None:
+                    should_apply_op = tf.random.uniform([batch_size], dtype=tf.float32)
+                selected = should_apply_op < prob
+
+                images = _apply_batch_func(name, images, selected, level, replace_value, self.cutout_const,
+                                           self.translate_const)
+
+        images = tf.cast(images, dtype=input_image_type)
+        return images
+
+
+class BatchRandAugment(RandAugment):
+    """Applies the RandAugment policy to a batch of images of shape [N, H, W, C].
+
+    An op and a magnitude are sampled for every image and layer. Each op is then applied once to all the
+    images that selected it.
+    """
+
+    def __init__(self,
+                 num_layers: int = 2,
+                 magnitude: float = 10.,
+                 cutout_const: float = 40.,
+                 translate_const: float = 100.,
+                 magnitude_std: float = 0.):
+        """Applies the RandAugment policy to batches of images.
+
+        Args:
+          num_layers: same as `RandAugment`.
+          magnitude: same as `RandAugment`.
+          cutout_const: multiplier for applying cutout.
+          translate_const: multiplier for applying translation.
+          magnitude_std: standard deviation of the per image magnitude around
+            `magnitude`. Zero uses the same magnitude for all images.
+        """
+        super(BatchRandAugment, self).__init__(num_layers, magnitude, cutout_const, translate_const)
+        self.magnitude_std = float(magnitude_std)
+
+    def distort(self, images: tf.Tensor) -> tf.Tensor:
+        input_image_type = images.dtype
+
+        if input_image_type != tf.uint8:
+            images = tf.clip_by_value(images, 0.0, 255.0)
+            images = tf.cast(images, dtype=tf.uint8)
+
+        replace_value = 128
+        batch_size = tf.shape(images)[0]
+
+        for _ in range(self.num_layers):
+            # The last index is the identity
+            op_to_select = tf.random.uniform([batch_size], maxval=len(self.available_ops) + 1, dtype=tf.int32)
+            levels = tf.fill([batch_size], self.magnitude)
+            if self.magnitude_std > 0:
+                levels += tf.random.normal([batch_size], stddev=self.magnitude_std)
+                levels = tf.clip_by_value(levels, 0., _MAX_LEVEL)
+
+            for (i, op_name) in enumerate(self.available_ops):
+                images = _apply_batch_func(op_name, images, tf.equal(op_to_select, i), levels, replace_value,
+                                           self.cutout_const, self.translate_const)
+
+        images = tf.cast(images, dtype=input_image_type)
+        return images
+
+
 class ViewConfig():
-    def __init__(self, name='image', rand_crop=False, augment_fn=None):
+    def __init__(self, name='image', rand_crop=False, augment_fn=None, batch_augment_fn=None):
         self.name = name
         self.rand_crop = rand_crop
         self.augment = augment_fn or (lambda x: x)
+        self.batch_augment = batch_augment_fn or (lambda x: x)
 
 
 class AugmentConfig():
-    def __init__(self, view_configs=None):
+    def __init__(self, view_configs=None, telemetry=None):
         self.view_configs = view_configs or ViewConfig()
+        self.telemetry = telemetry
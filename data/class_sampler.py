@@ -0,0 +1,91 @@
+"""Class-balanced P x K batches for the supervised contrastive losses.
+
+Every global batch holds P classes with K examples each, so every anchor has at least K - 1 class positives besides
+its own other view. All input pipelines shuffle the classes with the same seed and every pipeline takes its own slice of
+each step's P classes, so the classes are distinct across the whole global batch and a class's K examples never get
+split across replicas.
+
+The examples of each class are indexed once in the pixel store and sampled directly. The shuffled streams of the other
+readers cannot keep the classes of a batch distinct, so only the pixel store can be sampled class balanced.
+"""
+import numpy as np
+import tensorflow as tf
+from absl import logging
+
+from data import pixel_store
+
+
+def classes_per_replica(global_bsz, input_ctx, k):
+    per_replica_bsz = input_ctx.get_per_replica_batch_size(global_bsz)
+    if per_replica_bsz % k != 0:
+        raise ValueError(f'per replica batch size {per_replica_bsz} is not a multiple of {k} examples per class')
+    return per_replica_bsz // k
+
+
+def class_index(labels, num_classes):
+    """Returns the example indices sorted by class, and the start and number of each class's examples in them."""
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=num_classes)
+    starts = np.cumsum(counts) - counts
+    return order, starts, counts
+
+
+def sample_indices(labels, num_classes, input_ctx, classes_per_batch, k, seed=None):
+    """Infinite dataset of example indices in groups of `k` examples of the same class.
+
+    Every input pipeline samples `classes_per_batch` classes per step, disjoint from the classes of the other pipelines
+    in the same step, so `seed` must be the same on all of them. The `k` examples of a class are drawn without
+    replacement. Classes with fewer than `k` examples repeat them as evenly as possible.
+    """
+    num_pipelines, pipeline_id = input_ctx.num_input_pipelines, input_ctx.input_pipeline_id
+    if num_pipelines > 1 and seed is None:
+        raise ValueError('the input pipelines need a shared seed to sample disjoint classes')
+    order, starts, counts = class_index(labels, num_classes)
+    present = np.flatnonzero(counts)
+    global_classes = classes_per_batch * num_pipelines
+    if len(present) < global_classes:
+        raise ValueError(f'only {len(present)} classes to sample {global_classes} classes per global batch from')
+
+    sorted_indices = tf.constant(order, tf.int64)
+    max_count = max(int(counts.max()), k)
+    starts, counts = tf.constant(starts, tf.int64), tf.constant(counts, tf.int64)
+
+    def sample_fn(classes):
+        # This pipeline's slice of the step's classes
+        classes = classes[pipeline_id * classes_per_batch:(pipeline_id + 1) * classes_per_batch]
+
+        # The first k of a random permutation of each class's examples. Slots past a class's count sort last
+        class_counts = tf.gather(counts, classes)[:, None]
+        noise = tf.random.uniform([classes_per_batch, max_count], seed=seed)
+        noise = tf.where(tf.range(max_count, dtype=tf.int64) < class_counts, noise, 2.0)
+        offsets = tf.cast(tf.argsort(noise)[:, :k], tf.int64) % class_counts
+        indices = tf.gather(sorted_indices, tf.gather(starts, classes)[:, None] + offsets)
+        return tf.reshape(indices, [-1])
+
+    ds = tf.data.Dataset.from_tensor_slices(present.astype(np.int64))
+    # Batched within every pass over the classes, so that no batch holds a class twice across the pass boundary
+    ds = ds.shuffle(len(present), seed=seed)
+    ds = ds.batch(global_classes, drop_remainder=True).repeat()
+    ds = ds.map(sample_fn, tf.data.AUTOTUNE)
+    ds = ds.unbatch()
+    return ds
+
+
+def load_split(store_dir, data_id, split, num_classes, input_ctx, global_bsz, k, seed=None, skip=0):
+    """Class-balanced dataset of decoded `(image, label)` pairs from the pixel store."""
+    arrays = pixel_store.load_arrays(pixel_store.split_dir(store_dir, data_id, split))
+    classes_per_batch = classes_per_replica(global_bsz, input_ctx, k)
+    ds = sample_indices(np.asarray(arrays['label']), num_classes, input_ctx, classes_per_batch, k, seed)
+    if skip > 0:
+        ds = ds.skip(skip)
+    ds = pixel_store.gather_rows(ds, arrays)
+    ds = ds.map(lambda x: (x['image'], x['label']), tf.data.AUTOTUNE)
+    logging.info(f'sampling {classes_per_batch} classes x {k} examples per replica batch')
+    return ds
+
+
+def positives_per_anchor(labels):
+    """Average number of other examples of the same class in the batch."""
+    labels = tf.reshape(labels, [-1, 1])
+    same_class = tf.cast(labels == tf.transpose(labels), tf.float32)
+    return tf.reduce_mean(tf.reduce_sum(same_class, axis=1) - 1)
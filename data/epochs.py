@@ -0,0 +1,33 @@
+"""Seeded per-epoch data order for resumable input pipelines.
+
+Every data epoch of an input pipeline is shuffled with a seed derived from the run's data seed and the epoch number,
+so the order of an epoch does not depend on where the stream was started. A resumed run starts at the epoch of its
+first unseen example and only skips the examples of that epoch that were already consumed.
+"""
+import tensorflow as tf
+from absl import logging
+
+# Odd multiplier that keeps the epoch seeds of nearby data seeds apart
+EPOCH_SEED_STRIDE = 1000003
+
+# Stands in for infinitely many epochs
+MAX_EPOCHS = 2 ** 62
+
+
+def epoch_seed(seed, epoch):
+    return tf.cast(seed, tf.int64) * EPOCH_SEED_STRIDE + tf.cast(epoch, tf.int64)
+
+
+def repeat_epochs(ds, epoch_size, shuffle_fn, seed, skip=0):
+    """Repeats `ds` infinitely and shuffles data epoch `e` with `shuffle_fn(ds, epoch_seed(seed, e))`.
+
+    `epoch_size` is the number of examples of one pass over `ds`. The stream starts at example `skip`, which only
+    skips examples within its epoch.
+    """
+    start_epoch, skip = divmod(skip, epoch_size)
+    epochs = tf.data.Dataset.range(start_epoch, MAX_EPOCHS)
+    repeated = epochs.flat_map(lambda epoch: shuffle_fn(ds, epoch_seed(seed, epoch)))
+    if start_epoch > 0 or skip > 0:
+        repeated = repeated.skip(skip)
+        logging.info(f'resuming at data epoch {start_epoch}, skipping its first {skip} examples')
+    return repeated
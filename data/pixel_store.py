@@ -0,0 +1,173 @@
+"""Pre-decoded, memory-mapped pixel store for small datasets.
+
+Each split is exported once as a fixed-shape uint8 image array and a label array in `.npy` format, so later
+runs can memory-map them and slice out examples without decoding any PNG bytes.
+"""
+import argparse
+import os
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from absl import logging
+
+from data import epochs, shard_cache
+
+SUPPORTED_DATA_IDS = ['mnist', 'cifar10', 'cifar100']
+
+# Number of indices gathered from the memory-mapped arrays per call into numpy
+GATHER_SIZE = 256
+
+
+def split_dir(store_dir, data_id, split):
+    return os.path.join(store_dir, data_id, split)
+
+
+def is_exported(store_dir, data_id, split, names=('image', 'label')):
+    return all(os.path.exists(os.path.join(split_dir(store_dir, data_id, split), f'{name}.npy')) for name in names)
+
+
+def open_arrays(out_dir, specs):
+    """Creates a writable memory-mapped `.npy` file for every `name: (dtype, shape)` in `specs`."""
+    os.makedirs(out_dir, exist_ok=True)
+    arrays = {}
+    for name, (dtype, shape) in specs.items():
+        arrays[name] = np.lib.format.open_memmap(os.path.join(out_dir, f'{name}.npy'), mode='w+', dtype=dtype,
+                                                 shape=tuple(shape))
+    return arrays
+
+
+def load_arrays(in_dir, names=('image', 'label')):
+    """Memory-maps the `.npy` files of `names` in read-only mode."""
+    return {name: np.load(os.path.join(in_dir, f'{name}.npy'), mmap_mode='r') for name in names}
+
+
+def seeded_fn(fn, seed):
+    """Wraps a `tf.data` map function so that its random ops are seeded with `seed`.
+
+    `tf.random.set_seed` in a traced function only seeds the graph of that function, so the global random state of
+    the run is left alone.
+    """
+    def wrapped_fn(*args):
+        tf.random.set_seed(seed)
+        return fn(*args)
+
+    return wrapped_fn
+
+
+def export_split(data_id, split, store_dir, data_dir='gs://aigagror/datasets'):
+    """Decodes a split once and writes it to the pixel store.
+
+    The split is written to a `.incomplete` directory that is renamed when done, so an interrupted export is never
+    mistaken for an exported split.
+    """
+    ds, ds_info = tfds.load(data_id, split=split, as_supervised=True, with_info=True,
+                            try_gcs=shard_cache.is_remote(data_dir), data_dir=data_dir)
+    num_examples = ds_info.splits[split].num_examples
+    image_shape = ds_info.features['image'].shape
+    if None in image_shape:
+        raise ValueError(f'{data_id} does not have a fixed image shape {image_shape}')
+
+    out_dir = split_dir(store_dir, data_id, split)
+    tmp_dir = out_dir + '.incomplete'
+    arrays = open_arrays(tmp_dir, {'image': (np.uint8, [num_examples, *image_shape]),
+                                   'label': (np.int64, [num_examples])})
+    start = 0
+    for images, labels in tfds.as_numpy(ds.batch(1024)):
+        end = start + len(images)
+        arrays['image'][start:end] = images
+        arrays['label'][start:end] = labels
+        start = end
+    assert start == num_examples, f'exported {start} out of {num_examples} examples'
+
+    # Only complete splits get the final name
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    os.rename(tmp_dir, out_dir)
+    logging.info(f"exported {num_examples} {data_id} {split} examples to '{out_dir}'")
+
+
+def ensure_exported(store_dir, data_id, splits, data_dir='gs://aigagror/datasets'):
+    if data_id not in SUPPORTED_DATA_IDS:
+        raise ValueError(f'pixel store only supports {SUPPORTED_DATA_IDS}, not {data_id}')
+    for split in splits:
+        if not is_exported(store_dir, data_id, split):
+            export_split(data_id, split, store_dir, data_dir)
+
+
+def gather_rows(ds, arrays):
+    """Maps a dataset of indices to `{name: row}` elements read from the memory-mapped `arrays`.
+
+    The rows are sliced out of the memory-mapped arrays in chunks of `GATHER_SIZE`.
+    """
+    names = sorted(arrays)
+    dtypes = [tf.as_dtype(arrays[name].dtype) for name in names]
+
+    def gather(indices):
+        # Sorted indices read the memory map sequentially
+        order = np.argsort(indices)
+        inverse = np.argsort(order)
+        return [arrays[name][indices[order]][inverse] for name in names]
+
+    def gather_fn(indices):
+        rows = tf.numpy_function(gather, [indices], dtypes)
+        for name, row in zip(names, rows):
+            row.set_shape([None, *arrays[name].shape[1:]])
+        return dict(zip(names, rows))
+
+    ds = ds.batch(GATHER_SIZE)
+    ds = ds.map(gather_fn, tf.data.AUTOTUNE)
+    ds = ds.unbatch()
+    return ds
+
+
+def shuffled_indices(num_examples, input_ctx, shuffle, repeat, seed=None, skip=0):
+    """Dataset of the example indices of an input pipeline's shard.
+
+    Shuffling indices is cheap, so we shuffle over the whole shard. With a seed, every epoch is shuffled with its
+    own seed and a resumed run only skips within its epoch (see `epochs`).
+    """
+    ds = tf.data.Dataset.range(num_examples)
+    ds = ds.shard(input_ctx.num_input_pipelines, input_ctx.input_pipeline_id)
+    shard_size = len(range(input_ctx.input_pipeline_id, num_examples, input_ctx.num_input_pipelines))
+    shuffle_fn = lambda ds, seed: ds.shuffle(shard_size, seed=seed) if shuffle else ds
+    if repeat and seed is not None:
+        return epochs.repeat_epochs(ds, shard_size, shuffle_fn, seed, skip)
+
+    ds = shuffle_fn(ds, seed)
+    if repeat:
+        ds = ds.repeat()
+    if skip > 0:
+        ds = ds.skip(skip)
+    return ds
+
+
+def gather_dataset(arrays, input_ctx, shuffle, repeat, seed=None, skip=0):
+    """Dataset of `{name: row}` elements read from the memory-mapped `arrays`.
+
+    Only the indices are sharded, shuffled, repeated and skipped.
+    """
+    num_examples = len(next(iter(arrays.values())))
+    ds = shuffled_indices(num_examples, input_ctx, shuffle, repeat, seed, skip)
+    return gather_rows(ds, arrays)
+
+
+def load_split(store_dir, data_id, split, input_ctx, shuffle, repeat, seed=None, skip=0):
+    """Dataset of decoded `(image, label)` pairs from the pixel store."""
+    arrays = load_arrays(split_dir(store_dir, data_id, split))
+    ds = gather_dataset(arrays, input_ctx, shuffle, repeat, seed, skip)
+    ds = ds.map(lambda x: (x['image'], x['label']), tf.data.AUTOTUNE)
+    return ds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export datasets to the memory-mapped pixel store')
+    parser.add_argument('--data-id', choices=SUPPORTED_DATA_IDS, required=True)
+    parser.add_argument('--splits', nargs='+', default=['train', 'test'])
+    parser.add_argument('--data-dir', type=str, default='gs://aigagror/datasets')
+    parser.add_argument('--out', type=str, required=True)
+    cmd_args = parser.parse_args()
+
+    logging.set_verbosity('INFO')
+    ensure_exported(cmd_args.out, cmd_args.data_id, cmd_args.splits, cmd_args.data_dir)
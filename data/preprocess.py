@@ -82,9 +82,8 @@ def _decode_and_random_crop_jpg(image_bytes, image_size, channels):
     return image
 
 
-def _decode_and_center_crop_jpg(image_bytes, image_size, channels):
-    """Crops to center of image with padding then scales image_size."""
-    shape = tf.image.extract_jpeg_shape(image_bytes)
+def _center_crop_window(shape, image_size):
+    """Returns the `[offset_height, offset_width, size, size]` window of a padded center crop."""
     image_height = shape[0]
     image_width = shape[1]
 
@@ -97,6 +96,13 @@ def _decode_and_center_crop_jpg(image_bytes, image_size, channels):
     offset_width = ((image_width - padded_center_crop_size) + 1) // 2
     crop_window = tf.stack([offset_height, offset_width,
                             padded_center_crop_size, padded_center_crop_size])
+    return crop_window
+
+
+def _decode_and_center_crop_jpg(image_bytes, image_size, channels):
+    """Crops to center of image with padding then scales image_size."""
+    shape = tf.image.extract_jpeg_shape(image_bytes)
+    crop_window = _center_crop_window(shape, image_size)
     image = tf.image.decode_and_crop_jpeg(image_bytes, crop_window, channels)
     image = tf.image.resize([image], [image_size, image_size], method='bicubic')[0]
 
@@ -112,23 +118,158 @@ def _decode_and_crop_jpg(image_bytes, rand_crop, imsize, channels):
     return image
 
 
+def _pad_and_crop(image, imsize, channels, rand_crop):
+    if rand_crop:
+        # Random translation of up to 4 pixels
+        height, width = tf.shape(image)[0], tf.shape(image)[1]
+        image = tf.image.pad_to_bounding_box(image, 4, 4, height + 8, width + 8)
+        image = tf.image.random_crop(image, [height, width, channels])
+
+        # Resize only if the image is not already at the target resolution (e.g. progressive resizing)
+        image = tf.cond(tf.reduce_all(tf.shape(image)[:2] == imsize),
+                        lambda: image,
+                        lambda: tf.saturate_cast(tf.image.resize(image, [imsize, imsize]), image.dtype))
+    else:
+        image = tf.image.resize(image, [imsize, imsize])
+    image = tf.cast(image, tf.uint8)
+    return image
+
+
 def _decode_png_and_crop(image_bytes, imsize, channels, rand_crop):
     image = tf.image.decode_png(image_bytes, channels)
+    return _pad_and_crop(image, imsize, channels, rand_crop)
+
+
+def _random_crop(image, image_size):
+    """Same as `_decode_and_random_crop_jpg`, but on an already decoded image."""
+    shape = tf.shape(image)
+    bbox = tf.constant([0.0, 0.0, 1.0, 1.0], dtype=tf.float32, shape=[1, 1, 4])
+    bbox_begin, bbox_size, _ = tf.image.sample_distorted_bounding_box(
+        shape,
+        bounding_boxes=bbox,
+        min_object_covered=0.1,
+        aspect_ratio_range=(3. / 4, 4. / 3.),
+        area_range=(0.08, 1.0),
+        max_attempts=10,
+        use_image_if_no_bounding_boxes=True)
+    cropped = tf.slice(image, bbox_begin, bbox_size)
+    bad = _at_least_x_are_equal(shape, tf.shape(cropped), 3)
+
+    image = tf.cond(
+        bad,
+        lambda: _center_crop(image, image_size),
+        lambda: tf.image.resize(cropped, [image_size, image_size], method='bicubic'))
+
+    return image
+
+
+def _center_crop(image, image_size):
+    """Same as `_decode_and_center_crop_jpg`, but on an already decoded image."""
+    offset_height, offset_width, crop_size, _ = tf.unstack(_center_crop_window(tf.shape(image), image_size))
+    image = tf.image.crop_to_bounding_box(image, offset_height, offset_width, crop_size, crop_size)
+    image = tf.image.resize([image], [image_size, image_size], method='bicubic')[0]
+
+    return image
+
+
+def _crop_jpg(image, rand_crop, imsize):
     if rand_crop:
-        image = tf.image.pad_to_bounding_box(image, 4, 4, imsize + 8, imsize + 8)
-        image = tf.image.random_crop(image, [imsize, imsize, channels])
+        image = _random_crop(image, imsize)
     else:
-        image = tf.image.resize(image, [imsize, imsize])
+        image = _center_crop(image, imsize)
     image = tf.cast(image, tf.uint8)
     return image
 
 
+def get_image_format(ds_info):
+    """Returns 'jpeg' or 'png' if all images of the dataset share that encoding, otherwise None."""
+    return getattr(ds_info.features['image'], 'encoding_format', None)
+
+
+def decode_image(image_bytes, channels, image_format=None):
+    """Decodes the full image once.
+
+    Returns the decoded uint8 image and whether it was a JPEG. If `image_format` is known, the latter is a Python
+    bool and no per example format detection is done.
+    """
+    if image_format == 'jpeg':
+        return tf.image.decode_jpeg(image_bytes, channels), True
+    if image_format == 'png':
+        return tf.image.decode_png(image_bytes, channels), False
+
+    is_jpeg = tf.image.is_jpeg(image_bytes)
+    image = tf.cond(is_jpeg,
+                    lambda: tf.image.decode_jpeg(image_bytes, channels),
+                    lambda: tf.image.decode_png(image_bytes, channels))
+    return image, is_jpeg
+
+
+def _shrink(image, min_size):
+    """Resizes the image so that its shorter side is at most `min_size`, keeping the aspect ratio."""
+    shape = tf.cast(tf.shape(image)[:2], tf.float32)
+    scale = tf.minimum(tf.cast(min_size, tf.float32) / tf.reduce_min(shape), 1.0)
+    new_shape = tf.cast(tf.round(shape * scale), tf.int32)
+    image = tf.image.resize(image, new_shape, method='bicubic')
+    return tf.saturate_cast(image, tf.uint8)
+
+
+def decode_and_resize(image_bytes, label, imsize, channels, image_format=None, shrink=False):
+    """Decodes the image and, with `shrink`, shrinks JPEGs to a shorter side of `imsize + CROP_PADDING`.
+
+    A shrunk image is the smallest one that a center crop can still be taken from at native resolution, which keeps
+    decoded caches compact. Random resized crops cover as little as 8% of the image though, so their pixels are then
+    upsampled from a much smaller region than at full resolution. Without `shrink` the images are kept as decoded.
+    Returns `(image, label, is_jpeg)`.
+    """
+    image, is_jpeg = decode_image(image_bytes, channels, image_format)
+    if not shrink:
+        return image, label, tf.convert_to_tensor(is_jpeg)
+    shrink_fn = lambda: _shrink(image, imsize + CROP_PADDING)
+    if isinstance(is_jpeg, bool):
+        image = shrink_fn() if is_jpeg else image
+        is_jpeg = tf.constant(is_jpeg)
+    else:
+        image = tf.cond(is_jpeg, shrink_fn, lambda: image)
+    return image, label, is_jpeg
+
+
+def crop_decoded_image(image, is_jpeg, rand_crop, imsize, channels):
+    jpg_crop_fn = lambda: _crop_jpg(image, rand_crop, imsize)
+    png_crop_fn = lambda: _pad_and_crop(image, imsize, channels, rand_crop)
+    if isinstance(is_jpeg, bool):
+        return jpg_crop_fn() if is_jpeg else png_crop_fn()
+    return tf.cond(is_jpeg, jpg_crop_fn, png_crop_fn)
+
+
+def process_decoded_example(image, label, imsize, channels, augment_config, is_jpeg=False):
+    inputs, targets = {}, {'label': label}
+    for view_config in augment_config.view_configs:
+        view = crop_decoded_image(image, is_jpeg, view_config.rand_crop, imsize, channels)
+        view = tf.ensure_shape(view, [imsize, imsize, channels])
+
+        # Augment
+        view = view_config.augment(view)
+
+        view = tf.ensure_shape(view, [imsize, imsize, channels])
+
+        inputs[view_config.name] = view
+
+    return inputs, targets
+
+
+def process_encoded_example_once(image_bytes, label, imsize, channels, augment_config, image_format=None):
+    """Decodes the image once and crops every view from the shared decoded image."""
+    image, is_jpeg = decode_image(image_bytes, channels, image_format)
+    return process_decoded_example(image, label, imsize, channels, augment_config, is_jpeg)
+
+
 def process_encoded_example(image_bytes, label, imsize, channels, augment_config):
     inputs, targets = {}, {'label': label}
     for view_config in augment_config.view_configs:
         image = tf.cond(tf.image.is_jpeg(image_bytes),
                         lambda: _decode_and_crop_jpg(image_bytes, view_config.rand_crop, imsize, channels),
                         lambda: _decode_png_and_crop(image_bytes, imsize, channels, view_config.rand_crop))
+        image = tf.ensure_shape(image, [imsize, imsize, channels])
 
         # Augment
         image = view_config.augment(image)
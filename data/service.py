@@ -0,0 +1,130 @@
+"""Preprocessing offloaded to tf.data service workers.
+
+The decoding and augmentation of the input pipeline run in separate worker processes, and the trainer only reads
+finished batches from them. The dispatcher and the workers can all run on the trainer's host, or workers on other
+hosts can join the same dispatcher by its address.
+
+  # Dispatcher and 8 workers on this host
+  python -m data.service --port 5050 --workers 8
+
+  # 8 more workers on another host. they advertise this host's name to the trainer unless --worker-address is given
+  python -m data.service --dispatcher-address <dispatcher host>:5050 --workers 8
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+
+import tensorflow as tf
+from absl import logging
+
+PROTOCOL = 'grpc'
+
+# Servers of this process. They stop once they are garbage collected
+_servers = []
+
+
+def _address(target):
+    """'grpc://host:port' -> 'host:port'"""
+    return target.split('://')[-1]
+
+
+def worker_address(dispatcher_address, host=None):
+    """Returns the address a worker registers with the dispatcher, which hands it to the trainer to read from.
+
+    Without `host`, workers of a dispatcher on this host advertise 'localhost', and workers of a dispatcher on
+    another host advertise this host's name.
+    """
+    if host is None:
+        dispatcher_host = _address(dispatcher_address).rsplit(':', 1)[0]
+        host = 'localhost' if dispatcher_host in ('localhost', '127.0.0.1') else socket.gethostname()
+    # The worker fills in its port
+    return f'{host}:%port%'
+
+
+def worker_config(dispatcher_address, port=0, host=None):
+    return tf.data.experimental.service.WorkerConfig(dispatcher_address=_address(dispatcher_address), port=port,
+                                                     worker_address=worker_address(dispatcher_address, host),
+                                                     protocol=PROTOCOL)
+
+
+def _run_worker(dispatcher_address, port, host):
+    worker = tf.data.experimental.service.WorkerServer(worker_config(dispatcher_address, port, host))
+    worker.join()
+
+
+def start_workers(dispatcher_address, num_workers, host=None):
+    """Starts `num_workers` worker processes that register with the dispatcher at `dispatcher_address`.
+
+    The workers advertise `host` to the trainer. See `worker_address`.
+    """
+    # Workers only preprocess on the CPU, so we hide the accelerators from them
+    ctx = multiprocessing.get_context('spawn')
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    try:
+        workers = [ctx.Process(target=_run_worker, args=(dispatcher_address, 0, host), daemon=True)
+                   for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+    finally:
+        if visible_devices is None:
+            del os.environ['CUDA_VISIBLE_DEVICES']
+        else:
+            os.environ['CUDA_VISIBLE_DEVICES'] = visible_devices
+    _servers.extend(workers)
+    logging.info(f'started {num_workers} tf.data service workers for dispatcher {dispatcher_address}')
+    return workers
+
+
+def start_dispatcher(port=0):
+    """Starts a dispatcher in this process and returns its target, e.g. 'grpc://localhost:5050'."""
+    dispatcher_config = tf.data.experimental.service.DispatcherConfig(port=port, protocol=PROTOCOL)
+    dispatcher = tf.data.experimental.service.DispatchServer(dispatcher_config)
+    _servers.append(dispatcher)
+    logging.info(f'started tf.data service dispatcher at {dispatcher.target}')
+    return dispatcher.target
+
+
+def setup_service(dispatcher_address=None, num_workers=None, worker_host=None):
+    """Returns the dispatcher target for the input pipeline.
+
+    Without `dispatcher_address`, a dispatcher is started in this process. With `num_workers`, that many local
+    worker processes are started and registered with the dispatcher under `worker_host`.
+    """
+    if dispatcher_address is None:
+        target = start_dispatcher()
+    elif '://' in dispatcher_address:
+        target = dispatcher_address
+    else:
+        target = f'{PROTOCOL}://{dispatcher_address}'
+
+    if num_workers:
+        start_workers(target, num_workers, worker_host)
+    return target
+
+
+def distribute(ds, service):
+    """Runs the preprocessing of `ds` up to here on the service workers.
+
+    Every worker produces whole epochs of `ds`, so `ds` must not be seeded for the workers to produce different
+    orders.
+    """
+    return ds.apply(tf.data.experimental.service.distribute('parallel_epochs', service))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run tf.data service servers for the input pipeline')
+    parser.add_argument('--dispatcher-address', type=str,
+                        help="'host:port' of an existing dispatcher. starts a new dispatcher if not specified")
+    parser.add_argument('--port', type=int, default=5050, help='port of the new dispatcher')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--worker-address', type=str,
+                        help="host name or IP of this host that the trainer reaches the workers at. "
+                             "defaults to 'localhost' for a local dispatcher and to the host name otherwise")
+    cmd_args = parser.parse_args()
+
+    logging.set_verbosity('INFO')
+    dispatcher_target = cmd_args.dispatcher_address or start_dispatcher(cmd_args.port)
+    for process in start_workers(dispatcher_target, cmd_args.workers, cmd_args.worker_address):
+        process.join()
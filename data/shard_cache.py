@@ -0,0 +1,143 @@
+"""Local on-disk cache of TFDS shards.
+
+The files of a dataset version are copied once from the (usually remote) data root to a local directory,
+which can be on disk or tmpfs. A manifest of the copied files and their sizes is written last, so later runs
+can check the local copy and read from it without touching remote storage at all.
+"""
+import json
+import os
+import time
+from concurrent import futures
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from absl import logging
+
+MANIFEST_NAME = 'shard-cache-manifest.json'
+
+
+def is_remote(data_dir):
+    return data_dir.startswith('gs://')
+
+
+def _manifest_path(local_dir, data_id):
+    return os.path.join(local_dir, data_id, MANIFEST_NAME)
+
+
+def _read_manifest(local_dir, data_id):
+    path = _manifest_path(local_dir, data_id)
+    if not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path) as f:
+        return json.load(f)
+
+
+def _verify(local_dir, manifest):
+    version_dir = os.path.join(local_dir, manifest['version_dir'])
+    for name, size in manifest['files'].items():
+        path = os.path.join(version_dir, name)
+        if not tf.io.gfile.exists(path) or tf.io.gfile.stat(path).length != size:
+            logging.warning(f"local shard '{path}' is missing or incomplete")
+            return False
+    return True
+
+
+def _version_dir(builder):
+    """Path of the dataset version relative to the TFDS data root, e.g. 'mnist/3.0.1'."""
+    parts = [builder.name]
+    if builder.builder_config is not None:
+        parts.append(builder.builder_config.name)
+    parts.append(str(builder.version))
+    return os.path.join(*parts)
+
+
+def _copy(src, dst, size):
+    tmp = dst + '.incomplete'
+    tf.io.gfile.copy(src, tmp, overwrite=True)
+    if tf.io.gfile.stat(tmp).length != size:
+        raise IOError(f"copied '{src}' to '{tmp}' but the sizes do not match")
+    tf.io.gfile.rename(tmp, dst, overwrite=True)
+
+
+def sync_dataset(data_id, data_dir, local_dir, num_threads=16, metadata_only=False):
+    """Makes sure `local_dir` holds a checked copy of `data_id` from `data_dir`.
+
+    Args:
+      data_id: name of the TFDS dataset.
+      data_dir: the TFDS data root to copy from.
+      local_dir: the local TFDS data root to copy to.
+      num_threads: number of files copied in parallel.
+      metadata_only: only copy the dataset info files and skip the shards.
+
+    Returns:
+      `local_dir`, to be used as the TFDS data root.
+    """
+    start = time.time()
+
+    # Warm start. A metadata only copy does not do for a full sync, but a full copy does for a metadata only sync
+    manifest = _read_manifest(local_dir, data_id)
+    if manifest is not None and (not manifest['metadata_only'] or metadata_only) and _verify(local_dir, manifest):
+        logging.info(f"warm start: verified {len(manifest['files'])} local {data_id} files in '{local_dir}' "
+                     f'in {time.time() - start:.2f}s')
+        return local_dir
+
+    # Cold start
+    builder = tfds.builder(data_id, data_dir=data_dir, try_gcs=is_remote(data_dir))
+    version_dir = _version_dir(builder)
+    remote_version_dir, local_version_dir = builder.data_dir, os.path.join(local_dir, version_dir)
+    tf.io.gfile.makedirs(local_version_dir)
+
+    files = {}
+    for name in tf.io.gfile.listdir(remote_version_dir):
+        if metadata_only and '.tfrecord' in name:
+            continue
+        files[name] = tf.io.gfile.stat(os.path.join(remote_version_dir, name)).length
+
+    with futures.ThreadPoolExecutor(num_threads) as executor:
+        copies = [executor.submit(_copy, os.path.join(remote_version_dir, name), os.path.join(local_version_dir, name),
+                                  size)
+                  for name, size in files.items()]
+        for copy in copies:
+            copy.result()
+
+    # The manifest is written last, so it only exists for a complete copy
+    manifest = {'version_dir': version_dir, 'files': files, 'metadata_only': metadata_only}
+    with tf.io.gfile.GFile(_manifest_path(local_dir, data_id), 'w') as f:
+        json.dump(manifest, f)
+
+    elapsed = time.time() - start
+    num_mb = sum(files.values()) / 1e6
+    logging.info(f"cold start: copied {len(files)} {data_id} files ({num_mb:.1f} MB) from '{data_dir}' to "
+                 f"'{local_dir}' in {elapsed:.2f}s ({num_mb / elapsed:.1f} MB/s)")
+    return local_dir
+
+
+def load_info(data_id, data_dir, metadata_dir=None):
+    """Returns the `DatasetInfo` of `data_id` without building a dataset.
+
+    With `metadata_dir`, the info files of a remote `data_dir` are copied there once and read locally afterwards.
+    """
+    if metadata_dir is not None and is_remote(data_dir):
+        data_dir = sync_dataset(data_id, data_dir, metadata_dir, metadata_only=True)
+    builder = tfds.builder(data_id, data_dir=data_dir, try_gcs=is_remote(data_dir))
+    return builder.info
+
+
+def measure_read_throughput(data_id, data_dir, split='train', num_examples=10000):
+    """Reads the encoded examples of a split and logs the examples/sec and MB/sec."""
+    decoder_args = {'image': tfds.decode.SkipDecoding()}
+    ds = tfds.load(data_id, split=split, as_supervised=True, decoders=decoder_args, data_dir=data_dir,
+                   try_gcs=is_remote(data_dir))
+    ds = ds.take(num_examples).map(lambda image, label: tf.strings.length(image), tf.data.AUTOTUNE)
+
+    start = time.time()
+    count, num_bytes = 0, 0
+    for length in ds.batch(1024).as_numpy_iterator():
+        count += len(length)
+        num_bytes += int(length.sum())
+    elapsed = time.time() - start
+
+    examples_per_sec, mb_per_sec = count / elapsed, num_bytes / 1e6 / elapsed
+    logging.info(f"read {count} {data_id} {split} examples from '{data_dir}' at {examples_per_sec:.1f} examples/sec "
+                 f'({mb_per_sec:.1f} MB/sec)')
+    return examples_per_sec, mb_per_sec
@@ -0,0 +1,106 @@
+"""Per-op telemetry of the AutoAugment and RandAugment policies.
+
+Counts how often every op and sub-policy is applied, and times a random sample of the op applications with
+`tf.timestamp`. The counters are CPU variables updated from within the input pipeline, so they only see the
+augmentations of this process (not those of tf.data service workers).
+"""
+import json
+import os
+
+import tensorflow as tf
+from absl import logging
+
+# Default fraction of op applications that are timed
+SAMPLE_RATE = 0.01
+
+
+class AugmentTelemetry(object):
+    def __init__(self, op_names, num_policies=0, sample_rate=SAMPLE_RATE):
+        self.op_names = list(op_names)
+        self.num_policies = num_policies
+        self.sample_rate = sample_rate
+        with tf.device('CPU:0'):
+            self.op_counts = tf.Variable(tf.zeros([len(self.op_names)], tf.int64), trainable=False)
+            self.op_timed = tf.Variable(tf.zeros([len(self.op_names)], tf.int64), trainable=False)
+            self.op_seconds = tf.Variable(tf.zeros([len(self.op_names)], tf.float64), trainable=False)
+            self.policy_counts = tf.Variable(tf.zeros([num_policies], tf.int64), trainable=False)
+
+    def count(self, name, applied=True):
+        """Counts one application of op `name` if `applied`."""
+        index = self.op_names.index(name)
+        return self.op_counts.scatter_nd_add([[index]], tf.reshape(tf.cast(applied, tf.int64), [1]))
+
+    def count_policy(self, policy_index):
+        return self.policy_counts.scatter_nd_add(tf.reshape(policy_index, [1, 1]), tf.ones([1], tf.int64))
+
+    def instrument(self, name, func):
+        """Wraps op `func` so that every call is counted and a sample of the calls is timed."""
+        index = self.op_names.index(name)
+
+        def instrumented_func(image, *args):
+            def timed_fn():
+                # The image is captured from the outer graph, which cannot be a control dependency of the branch
+                with tf.control_dependencies([tf.identity(image)]):
+                    start = tf.timestamp()
+                with tf.control_dependencies([start]):
+                    output = tf.identity(func(image, *args))
+                with tf.control_dependencies([output]):
+                    elapsed = tf.timestamp() - start
+                updates = [self.op_seconds.scatter_nd_add([[index]], tf.reshape(elapsed, [1])),
+                           self.op_timed.scatter_nd_add([[index]], tf.ones([1], tf.int64))]
+                with tf.control_dependencies(updates):
+                    return tf.identity(output)
+
+            with tf.control_dependencies([self.count(name)]):
+                should_time = tf.random.uniform([]) < self.sample_rate
+                return tf.cond(should_time, timed_fn, lambda: func(image, *args))
+
+        return instrumented_func
+
+    def summary(self):
+        """Counts and sampled costs of every op, sorted by their estimated total time."""
+        ops = {}
+        for name, count, timed, seconds in zip(self.op_names, self.op_counts.numpy(), self.op_timed.numpy(),
+                                               self.op_seconds.numpy()):
+            mean_sec = seconds / timed if timed > 0 else None
+            ops[name] = {'count': int(count), 'timed': int(timed),
+                         'mean_ms': None if mean_sec is None else 1000 * mean_sec,
+                         'est_total_sec': None if mean_sec is None else mean_sec * int(count)}
+        ops = dict(sorted(ops.items(), key=lambda item: -(item[1]['est_total_sec'] or 0)))
+        return {'sample_rate': self.sample_rate, 'ops': ops,
+                'sub_policy_counts': [int(count) for count in self.policy_counts.numpy()]}
+
+    def write_json(self, path):
+        with tf.io.gfile.GFile(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_scalars(self, step):
+        """Writes the summary as scalars to the default summary writer."""
+        summary = self.summary()
+        for name, op in summary['ops'].items():
+            tf.summary.scalar(f'augment/{name}/count', op['count'], step)
+            if op['mean_ms'] is not None:
+                tf.summary.scalar(f'augment/{name}/mean_ms', op['mean_ms'], step)
+                tf.summary.scalar(f'augment/{name}/est_total_sec', op['est_total_sec'], step)
+        for i, count in enumerate(summary['sub_policy_counts']):
+            tf.summary.scalar(f'augment/sub_policy_{i}/count', count, step)
+
+
+class TelemetryCallback(tf.keras.callbacks.Callback):
+    """Exports the augmentation telemetry as TensorBoard scalars and JSON at the end of every epoch."""
+
+    def __init__(self, telemetry, log_dir):
+        super().__init__()
+        self.telemetry = telemetry
+        self.log_dir = log_dir
+        self.writer = tf.summary.create_file_writer(os.path.join(log_dir, 'augment'))
+
+    def on_epoch_end(self, epoch, logs=None):
+        with self.writer.as_default():
+            self.telemetry.write_scalars(epoch)
+        self.writer.flush()
+        self.telemetry.write_json(os.path.join(self.log_dir, 'augment-telemetry.json'))
+
+        costly = [f"{name} ({op['est_total_sec']:.1f}s)" for name, op in self.telemetry.summary()['ops'].items()
+                  if op['est_total_sec'] is not None][:3]
+        logging.info(f"most costly augmentations: {', '.join(costly) or 'none timed yet'}")
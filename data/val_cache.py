@@ -0,0 +1,98 @@
+"""Materialized validation set.
+
+The views of every validation example are cropped and augmented once with a fixed seed and kept as uint8 arrays,
+either in memory or memory-mapped from disk in the pixel store format. Validation passes then only gather the same
+tensors every epoch instead of decoding and augmenting them again.
+"""
+import os
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from absl import logging
+
+from data import pixel_store, shard_cache
+from data.preprocess import get_image_format, decode_image, process_decoded_example
+
+MODES = ['memory', 'disk']
+
+
+def cache_dir_for(cache_dir, data_id, split, seed, tag=''):
+    return os.path.join(cache_dir, 'val', data_id, f'{split}-seed{seed}{tag}')
+
+
+def _allocate(specs, out_dir=None):
+    if out_dir is None:
+        return {name: np.empty(shape, dtype) for name, (dtype, shape) in specs.items()}
+    return pixel_store.open_arrays(out_dir, specs)
+
+
+def materialize(ds_info, data_id, split, augment_config, seed=0, out_dir=None, data_dir='gs://aigagror/datasets'):
+    """Returns `{view name: images, 'label': labels}` for the whole split.
+
+    Without `out_dir` the arrays are kept in memory. Otherwise they are written to `out_dir` once and
+    memory-mapped.
+    """
+    names = [view_config.name for view_config in augment_config.view_configs] + ['label']
+    if out_dir is not None and all(os.path.exists(os.path.join(out_dir, f'{name}.npy')) for name in names):
+        logging.info(f"loading materialized {data_id} {split} dataset from '{out_dir}'")
+        return pixel_store.load_arrays(out_dir, names)
+
+    imsize = ds_info.features['image'].shape[0] or 224
+    channels = ds_info.features['image'].shape[2]
+    image_format = get_image_format(ds_info)
+    num_examples = ds_info.splits[split].num_examples
+
+    # Decode in parallel, but crop and augment sequentially so that the seeded random ops run in a fixed order
+    decoder_args = {'image': tfds.decode.SkipDecoding()}
+    ds = tfds.load(data_id, split=split, as_supervised=True, decoders=decoder_args,
+                   try_gcs=shard_cache.is_remote(data_dir), data_dir=data_dir)
+
+    def decode_fn(image_bytes, label):
+        image, is_jpeg = decode_image(image_bytes, channels, image_format)
+        return image, label, tf.convert_to_tensor(is_jpeg)
+
+    def preprocess_fn(image, label, is_jpeg):
+        is_jpeg = is_jpeg if image_format is None else image_format == 'jpeg'
+        inputs, targets = process_decoded_example(image, label, imsize, channels, augment_config, is_jpeg)
+        return {**inputs, **targets}
+
+    ds = ds.map(decode_fn, tf.data.AUTOTUNE)
+    ds = ds.map(pixel_store.seeded_fn(preprocess_fn, seed))
+    ds = ds.batch(pixel_store.GATHER_SIZE).prefetch(tf.data.AUTOTUNE)
+
+    specs = {name: (np.uint8, [num_examples, imsize, imsize, channels]) for name in names[:-1]}
+    specs['label'] = (np.int64, [num_examples])
+    tmp_dir = None if out_dir is None else out_dir + '.incomplete'
+    arrays = _allocate(specs, tmp_dir)
+    start = 0
+    for batch in tfds.as_numpy(ds):
+        end = start + len(batch['label'])
+        for name in names:
+            arrays[name][start:end] = batch[name]
+        start = end
+    assert start == num_examples, f'materialized {start} out of {num_examples} examples'
+
+    num_mb = sum(array.nbytes for array in arrays.values()) / 1e6
+    if out_dir is None:
+        logging.info(f'materialized {num_examples} {data_id} {split} examples in memory ({num_mb:.1f} MB)')
+        return arrays
+
+    # Only complete caches get the final name
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    os.rename(tmp_dir, out_dir)
+    logging.info(f"materialized {num_examples} {data_id} {split} examples to '{out_dir}' ({num_mb:.1f} MB)")
+    return pixel_store.load_arrays(out_dir, names)
+
+
+def materialized_dataset(arrays, input_ctx, augment_config, global_bsz):
+    """Batched `(inputs, targets)` dataset of the materialized arrays in a fixed order."""
+    view_names = [view_config.name for view_config in augment_config.view_configs]
+    ds = pixel_store.gather_dataset(arrays, input_ctx, shuffle=False, repeat=True)
+    ds = ds.map(lambda x: ({name: x[name] for name in view_names}, {'label': x['label']}), tf.data.AUTOTUNE)
+
+    per_replica_bsz = input_ctx.get_per_replica_batch_size(global_bsz)
+    ds = ds.batch(per_replica_bsz, drop_remainder=True)
+    return ds
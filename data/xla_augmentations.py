@@ -0,0 +1,290 @@
+"""Static shape variants of the ops in `data.augmentations` that compile with XLA.
+
+The ops of `data.augmentations` use dynamic shapes (`to_4d`, `cutout`, `unwrap`) and ops without XLA kernels
+(`image_ops.transform`, `bincount`). Here all shapes come from the static shape of the image, so every op and the
+`AutoAugment` and `RandAugment` policies can be `jit_compile`d for a fixed `imsize`:
+
+  * Geometric ops gather the input pixel of every output pixel instead of calling `image_ops.transform`.
+  * Equalize builds its histograms with `unsorted_segment_sum` over a fixed number of bins.
+  * Cutout selects pixels with a mask instead of padding a dynamically shaped patch.
+
+The ops take the same arguments as the ops of the same names in `data.augmentations` and return the same images.
+"""
+import math
+from typing import Any, Text
+
+import tensorflow as tf
+
+from data import augmentations
+
+# Same as the default fill mode of `image_ops.transform`
+FILL_MODE = 'reflect'
+
+
+def _static_shape(image: tf.Tensor):
+    if not image.shape.is_fully_defined():
+        raise ValueError(f'XLA augmentations need a fixed image shape, not {image.shape}')
+    return image.shape.as_list()
+
+
+def _round(coords: tf.Tensor) -> tf.Tensor:
+    """Rounds half away from zero, like `std::round`."""
+    return tf.sign(coords) * tf.floor(tf.abs(coords) + 0.5)
+
+
+def _map_coordinates(coords: tf.Tensor, size: int, fill_mode: Text) -> tf.Tensor:
+    """Maps input coordinates outside of [0, size - 1] into the image like the kernel of `image_ops.transform`."""
+    if fill_mode == 'constant':
+        return coords
+    if fill_mode == 'nearest' or size <= 1:
+        return tf.clip_by_value(coords, 0., size - 1.)
+
+    assert fill_mode == 'reflect', fill_mode
+    # Reflect [abcd] to [dcba|abcd|dcba]
+    size2 = 2. * size
+    below = size2 * tf.floor(-coords / size2) + coords
+    below = tf.where(below < -size, below + size2, -below - 1)
+    above = coords - size2 * tf.floor(coords / size2)
+    above = tf.where(above >= size, size2 - above - 1, above)
+    coords = tf.where(coords < 0, below, tf.where(coords > size - 1, above, coords))
+    return tf.clip_by_value(coords, 0., size - 1.)
+
+
+def transform(image: tf.Tensor, transforms: Any, fill_mode: Text = FILL_MODE) -> tf.Tensor:
+    """Nearest neighbor projective transform of a [H, W, C] image.
+
+    Same as `augmentations.transform`, but every output pixel gathers its input pixel from the flattened image.
+    """
+    height, width, channels = _static_shape(image)
+    transforms = tf.reshape(tf.cast(transforms, tf.float32), [8])
+
+    y, x = tf.meshgrid(tf.range(height, dtype=tf.float32), tf.range(width, dtype=tf.float32), indexing='ij')
+    projection = transforms[6] * x + transforms[7] * y + 1.
+    safe_projection = tf.where(projection == 0, tf.ones_like(projection), projection)
+    in_x = (transforms[0] * x + transforms[1] * y + transforms[2]) / safe_projection
+    in_y = (transforms[3] * x + transforms[4] * y + transforms[5]) / safe_projection
+    in_x = _round(_map_coordinates(in_x, width, fill_mode))
+    in_y = _round(_map_coordinates(in_y, height, fill_mode))
+
+    # Pixels outside of the image are filled with zeros
+    valid = (projection != 0) & (in_x >= 0) & (in_x <= width - 1) & (in_y >= 0) & (in_y <= height - 1)
+    in_x = tf.cast(tf.clip_by_value(in_x, 0., width - 1.), tf.int32)
+    in_y = tf.cast(tf.clip_by_value(in_y, 0., height - 1.), tf.int32)
+    pixels = tf.gather(tf.reshape(image, [height * width, channels]), in_y * width + in_x)
+    return tf.where(valid[..., None], pixels, tf.zeros_like(pixels))
+
+
+def wrap(image: tf.Tensor) -> tf.Tensor:
+    """Returns 'image' with an extra channel set to all 1s."""
+    return tf.concat([image, tf.ones_like(image[..., :1])], axis=-1)
+
+
+def unwrap(image: tf.Tensor, replace: Any) -> tf.Tensor:
+    """Unwraps an image produced by wrap and fills the empty pixels with `replace`."""
+    num_channels = image.shape[-1] - 1
+    replace = tf.reshape(tf.cast(replace, image.dtype), [-1])[:num_channels]
+    alpha_channel = image[..., -1:]
+    return tf.where(tf.equal(alpha_channel, 0), tf.broadcast_to(replace, [num_channels]), image[..., :-1])
+
+
+def wrapped_rotate(image: tf.Tensor, degrees: float, replace: Any) -> tf.Tensor:
+    height, width, _ = _static_shape(image)
+    radians = tf.cast(degrees, tf.float32) * (math.pi / 180.0)
+    transforms = augmentations._convert_angles_to_transform(radians, image_width=float(width),
+                                                           image_height=float(height))
+    return unwrap(transform(wrap(image), transforms), replace)
+
+
+def translate_x(image: tf.Tensor, pixels: int, replace: Any) -> tf.Tensor:
+    transforms = augmentations._convert_translation_to_transform([-pixels, 0])
+    return unwrap(transform(wrap(image), transforms), replace)
+
+
+def translate_y(image: tf.Tensor, pixels: int, replace: Any) -> tf.Tensor:
+    transforms = augmentations._convert_translation_to_transform([0, -pixels])
+    return unwrap(transform(wrap(image), transforms), replace)
+
+
+def shear_x(image: tf.Tensor, level: float, replace: Any) -> tf.Tensor:
+    transforms = tf.stack([1., level, 0., 0., 1., 0., 0., 0.])
+    return unwrap(transform(wrap(image), transforms), replace)
+
+
+def shear_y(image: tf.Tensor, level: float, replace: Any) -> tf.Tensor:
+    transforms = tf.stack([1., 0., 0., level, 1., 0., 0., 0.])
+    return unwrap(transform(wrap(image), transforms), replace)
+
+
+def cutout(image: tf.Tensor, pad_size: int, replace: Any = 0) -> tf.Tensor:
+    """Same as `augmentations.cutout`, but masks the patch instead of padding it to the image size."""
+    height, width, _ = _static_shape(image)
+    center_height = tf.random.uniform([], maxval=height, dtype=tf.int32)
+    center_width = tf.random.uniform([], maxval=width, dtype=tf.int32)
+    return cutout_at(image, center_height, center_width, pad_size, replace)
+
+
+def cutout_at(image: tf.Tensor, center_height: tf.Tensor, center_width: tf.Tensor, pad_size: int,
+              replace: Any = 0) -> tf.Tensor:
+    height, width, channels = _static_shape(image)
+    rows, cols = tf.range(height)[:, None], tf.range(width)[None]
+    in_rows = (rows >= center_height - pad_size) & (rows < center_height + pad_size)
+    in_cols = (cols >= center_width - pad_size) & (cols < center_width + pad_size)
+    replace = tf.broadcast_to(tf.reshape(tf.cast(replace, image.dtype), [-1])[:channels], [channels])
+    return tf.where((in_rows & in_cols)[..., None], replace, image)
+
+
+def contrast(image: tf.Tensor, factor: float) -> tf.Tensor:
+    """Equivalent of PIL Contrast."""
+    # Same constant degenerate image as `augmentations.contrast`
+    height, width, _ = _static_shape(image)
+    mean = tf.cast(min(height * width / 256.0, 255.0), tf.uint8)
+    return augmentations.blend(tf.fill(image.shape, mean), image, factor)
+
+
+def equalize(image: tf.Tensor) -> tf.Tensor:
+    """Same as `augmentations.equalize`.
+
+    The 256 bin histograms of all channels are summed into one fixed size array of `channels * 256` bins.
+    """
+    _, _, channels = _static_shape(image)
+    values = tf.cast(image, tf.int32) + tf.range(channels) * 256
+    histo = tf.math.unsorted_segment_sum(tf.ones_like(values), values, channels * 256)
+    histo = tf.reshape(histo, [channels, 256])
+
+    # For the purposes of computing the step, filter out the nonzeros.
+    bins = tf.range(256)
+    last_nonzero = tf.reduce_max(tf.where(histo != 0, bins, 0), axis=-1, keepdims=True)
+    last_nonzero_histo = tf.reduce_sum(tf.where(tf.equal(bins, last_nonzero), histo, 0), axis=-1)
+    step = (tf.reduce_sum(histo, axis=-1) - last_nonzero_histo) // 255
+
+    # Compute the cumulative sum, shifting by step // 2
+    # and then normalization by step.
+    safe_step = tf.maximum(step, 1)[:, None]
+    lut = (tf.cumsum(histo, axis=-1) + (safe_step // 2)) // safe_step
+    # Shift lut, prepending with 0.
+    lut = tf.pad(lut[:, :-1], [[0, 0], [1, 0]])
+    lut = tf.clip_by_value(lut, 0, 255)
+
+    # If step is zero, keep the original channel. Otherwise index from the lut.
+    result = tf.cast(tf.gather(tf.reshape(lut, [-1]), values), tf.uint8)
+    return tf.where(tf.equal(step, 0), image, result)
+
+
+def autocontrast(image: tf.Tensor) -> tf.Tensor:
+    return augmentations.batch_autocontrast(image[None])[0]
+
+
+NAME_TO_FUNC = {
+    **augmentations.NAME_TO_FUNC,
+    'AutoContrast': autocontrast,
+    'Equalize': equalize,
+    'Rotate': wrapped_rotate,
+    'Contrast': contrast,
+    'ShearX': shear_x,
+    'ShearY': shear_y,
+    'TranslateX': translate_x,
+    'TranslateY': translate_y,
+    'Cutout': cutout,
+}
+
+
+def _parse_policy_info(name: Text, level: float, replace_value: Any, cutout_const: float,
+                       translate_const: float):
+    args = augmentations.level_to_arg(cutout_const, translate_const)[name](level)
+    if name in augmentations.REPLACE_FUNCS:
+        args = tuple(list(args) + [replace_value])
+    return NAME_TO_FUNC[name], args
+
+
+# Compiled policies shared by all instances
+_COMPILED = {}
+
+
+def _compile(key, policy_fn, dtype: tf.DType, shape: tf.TensorShape, jit_compile: bool):
+    """Wraps `policy_fn` of a uint8 image into a cached `tf.function` for images of `dtype` and `shape`.
+
+    Cached per graph seed like `augmentations.compile_policies`.
+    """
+    key = (key, tf.as_dtype(dtype), tuple(shape.as_list()), jit_compile, augmentations.graph_seed())
+    if key in _COMPILED:
+        return _COMPILED[key]
+
+    @tf.function(input_signature=[tf.TensorSpec(shape, dtype)], jit_compile=jit_compile)
+    def apply_policy(image):
+        if image.dtype != tf.uint8:
+            image = tf.cast(tf.clip_by_value(image, 0.0, 255.0), tf.uint8)
+        return tf.cast(policy_fn(image), dtype)
+
+    _COMPILED[key] = apply_policy
+    return apply_policy
+
+
+class AutoAugment(augmentations.AutoAugment):
+    """`augmentations.AutoAugment` with the static shape ops, compiled for every fixed image shape."""
+
+    def __init__(self,
+                 augmentation_name: Text = 'v0',
+                 cutout_const: float = 100,
+                 translate_const: float = 250,
+                 jit_compile: bool = True):
+        super(AutoAugment, self).__init__(augmentation_name, cutout_const=cutout_const,
+                                          translate_const=translate_const, compiled=False)
+        self.jit_compile = jit_compile
+
+    def _policy_fn(self, image: tf.Tensor) -> tf.Tensor:
+        replace_value = [128] * image.shape[-1]
+
+        def make_branch(sub_policy):
+            def branch():
+                image_ = image
+                for name, prob, level in sub_policy:
+                    func, args = _parse_policy_info(name, level, replace_value, self.cutout_const,
+                                                    self.translate_const)
+                    image_ = augmentations._apply_func_with_prob(func, image_, args, prob)
+                return image_
+
+            return branch
+
+        policy_to_select = tf.random.uniform([], maxval=len(self.policies), dtype=tf.int32)
+        return tf.switch_case(policy_to_select, [make_branch(sub_policy) for sub_policy in self.policies])
+
+    def distort(self, image: tf.Tensor) -> tf.Tensor:
+        image = tf.convert_to_tensor(image)
+        _static_shape(image)
+        key = ('autoaugment', augmentations._policy_key(self.policies), self.cutout_const, self.translate_const)
+        return _compile(key, self._policy_fn, image.dtype, image.shape, self.jit_compile)(image)
+
+
+class RandAugment(augmentations.RandAugment):
+    """`augmentations.RandAugment` with the static shape ops, compiled for every fixed image shape."""
+
+    def __init__(self,
+                 num_layers: int = 2,
+                 magnitude: float = 10.,
+                 cutout_const: float = 40.,
+                 translate_const: float = 100.,
+                 jit_compile: bool = True):
+        super(RandAugment, self).__init__(num_layers, magnitude, cutout_const, translate_const)
+        self.jit_compile = jit_compile
+
+    def _policy_fn(self, image: tf.Tensor) -> tf.Tensor:
+        replace_value = [128] * image.shape[-1]
+        for _ in range(self.num_layers):
+            # The last index is the identity
+            op_to_select = tf.random.uniform([], maxval=len(self.available_ops) + 1, dtype=tf.int32)
+
+            branch_fns = []
+            for op_name in self.available_ops:
+                func, args = _parse_policy_info(op_name, self.magnitude, replace_value, self.cutout_const,
+                                                self.translate_const)
+                branch_fns.append(lambda selected_func=func, selected_args=args, image_=image:
+                                  selected_func(image_, *selected_args))
+            branch_fns.append(lambda image_=image: tf.identity(image_))
+            image = tf.switch_case(op_to_select, branch_fns)
+        return image
+
+    def distort(self, image: tf.Tensor) -> tf.Tensor:
+        image = tf.convert_to_tensor(image)
+        _static_shape(image)
+        key = ('randaugment', self.num_layers, self.magnitude, self.cutout_const, self.translate_const)
+        return _compile(key, self._policy_fn, image.dtype, image.shape, self.jit_compile)(image)
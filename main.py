@@ -1,29 +1,41 @@
 import os
+import time
 
 import tensorflow as tf
-import tensorflow_datasets as tfds
 from absl import logging
 from tensorflow import keras
 
 import models
-import plots
 import training
 import utils
-from data import load_distributed_datasets, get_val_split_name
+from data import load_distributed_datasets, materialize_val_dataset, export_view_bank, get_val_split_name
+from data import pixel_store, service, shard_cache
 from training import train
 
 
 def run(args):
+    startup_timer = utils.StartupTimer(time.time())
+
     # Setup
     strategy = utils.setup(args)
+    startup_timer.lap('setup')
 
     # Data
-    _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+    if args.local_data_dir:
+        args.data_dir = shard_cache.sync_dataset(args.data_id, args.data_dir, args.local_data_dir)
+    ds_info = shard_cache.load_info(args.data_id, args.data_dir, os.path.join(args.cache_dir, 'metadata'))
+    startup_timer.lap('dataset info')
     train_augconfig, val_augconfig = utils.load_augment_configs(args)
     val_split_name = get_val_split_name(ds_info)
+    if args.pixel_store:
+        pixel_store.ensure_exported(args.pixel_store, args.data_id, ['train', val_split_name], args.data_dir)
+    data_state_restored = training.load_data_state(args)
+    view_bank_dir = export_view_bank(args, ds_info, train_augconfig)
+    if args.data_service or args.data_service_workers:
+        args.data_service = service.setup_service(args.data_service, args.data_service_workers,
+                                                  args.data_service_worker_address)
 
-    ds_train = load_distributed_datasets(args, strategy, ds_info, 'train', train_augconfig, shuffle=True)
-    ds_val = load_distributed_datasets(args, strategy, ds_info, val_split_name, val_augconfig)
+    startup_timer.lap('data setup')
 
     # Set training and validation steps
     utils.set_epoch_steps(args, ds_info)
@@ -32,8 +44,14 @@ def run(args):
     with strategy.scope():
         # Model
         if args.load:
+            custom_objects = utils.all_custom_objects
+            training.load_optimizer_state(args)
+            if not args.recompile and args.optimizer == 'lamb':
+                # The optimizer of the checkpoint is saved under the registered Addons name
+                tfa = training.import_addons()
+                custom_objects = {**custom_objects, 'Addons>LAMB': tfa.optimizers.LAMB}
             model = keras.models.load_model(os.path.join(args.out, 'model'), compile=(not args.recompile),
-                                            custom_objects=utils.all_custom_objects)
+                                            custom_objects=custom_objects)
             logging.info('loaded model')
         else:
             model = models.make_model(args, ds_info.features['label'].num_classes, ds_info.features['image'].shape)
@@ -45,18 +63,48 @@ def run(args):
             training.compile_model(args, model)
 
         logging.info(f'{len(model.losses)} regularization losses in this model')
+    startup_timer.lap('model')
+
+    # Datasets. A resumed run skips the training examples the loaded model has already seen
+    skip_steps = training.get_resume_step(args, model, data_state_restored)
+    full_imsize = ds_info.features['image'].shape[0] or 224
+
+    def make_ds_train(res_scale, start_epoch):
+        # Every phase of progressive resizing starts a data order of its own. Only the phase a resumed run starts in
+        # skips what the previous run already consumed of it
+        imsize = None if res_scale is None else round(full_imsize * res_scale)
+        phase = sum(res_epoch <= start_epoch for res_epoch in args.res_epochs or [])
+        phase_start_epoch = ([0] + (args.res_epochs or []))[phase]
+        phase_skip_steps = 0
+        if start_epoch <= args.init_epoch:
+            phase_skip_steps = max(skip_steps - phase_start_epoch * args.train_steps, 0)
+        return load_distributed_datasets(args, strategy, ds_info, 'train', train_augconfig, shuffle=True,
+                                         skip_steps=phase_skip_steps, imsize=imsize,
+                                         class_balanced=args.class_balanced, view_bank_dir=view_bank_dir,
+                                         seed=args.data_seed + phase)
+
+    val_materialized = materialize_val_dataset(args, ds_info, val_split_name, val_augconfig)
+    ds_val = load_distributed_datasets(args, strategy, ds_info, val_split_name, val_augconfig,
+                                       materialized=val_materialized)
+    startup_timer.lap('datasets')
 
     # Print model information
-    keras.utils.plot_model(model, 'out/model.png')
-    logging.info("model graph saved to 'out/model.png'")
+    if args.plot_model:
+        keras.utils.plot_model(model, 'out/model.png')
+        logging.info("model graph saved to 'out/model.png'")
     model.summary()
+    startup_timer.log()
 
     # Train
-    train(args, model, ds_train, ds_val)
+    train(args, model, make_ds_train, ds_val, train_augconfig.telemetry)
 
     # Plot
+    start = time.time()
+    import plots
+    logging.info(f'imported plots in {time.time() - start:.2f}s')
     local_strategy = tf.distribute.get_strategy()
-    local_ds_val = load_distributed_datasets(args, local_strategy, ds_info, val_split_name, val_augconfig)
+    local_ds_val = load_distributed_datasets(args, local_strategy, ds_info, val_split_name, val_augconfig,
+                                             materialized=val_materialized)
     plots.plot_hist_sims(args, strategy, model, ds_val)
     if args.tsne:
         plots.plot_instance_tsne(args, model, local_ds_val)
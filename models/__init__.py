@@ -52,6 +52,11 @@ def make_model(args, nclass, input_shape):
         regularizer = None
         logging.info('adding weight decay via the LAMB optimizer instead of Keras regularization')
 
+    # Resolution polymorphic inputs for progressive resizing?
+    full_imsize = input_shape[0]
+    if args.res_scales:
+        input_shape = [None, None, input_shape[2]]
+
     # Inputs
     input = keras.Input(input_shape, name='image')
     input2 = keras.Input(input_shape, name='image2')
@@ -77,11 +82,20 @@ def make_model(args, nclass, input_shape):
     # Add weight decay to backbone
     backbone = add_regularization_with_reset(backbone, regularizer)
 
+    # Augment on device?
+    if args.device_augment:
+        # Small images get random translations like in the host pipeline, larger ones random resized crops
+        small_image = full_imsize is not None and full_imsize < 64
+        device_augment = custom_layers.DeviceAugment(crop='pad' if small_image else 'resized', name='augment')
+        aug_input, aug_input2 = device_augment(input), device_augment(input2)
+    else:
+        aug_input, aug_input2 = input, input2
+
     # Standardize input
     stand_img = custom_layers.StandardizeImage()
 
     # Features
-    raw_feats, raw_feats2 = backbone(stand_img(input)), backbone(stand_img(input2))
+    raw_feats, raw_feats2 = backbone(stand_img(aug_input)), backbone(stand_img(aug_input2))
 
     # Normalize features?
     feats, feats2 = optional_normalize(args.feat_norm, raw_feats, raw_feats2)
@@ -1,12 +1,16 @@
+import math
+
 import tensorflow as tf
 from tensorflow.keras import layers
 from typeguard import typechecked
 
+from ops import checks, color_ops
+
 
 class StandardizeImage(layers.Layer):
 
     def call(self, inputs, **kwargs):
-        tf.debugging.assert_rank(inputs, 4)
+        checks.check(tf.debugging.assert_rank, inputs, 4)
 
         MEAN_RGB = [0.485 * 255, 0.456 * 255, 0.406 * 255]
         STDDEV_RGB = [0.229 * 255, 0.224 * 255, 0.225 * 255]
@@ -16,6 +20,86 @@ class StandardizeImage(layers.Layer):
         return inputs
 
 
+class DeviceAugment(layers.Layer):
+    """Random crop, flip and color augmentation of uint8 image batches inside the model.
+
+    Every image gets its own random crop box, flip and color factors, and all ops keep static shapes, so they run
+    on any accelerator. Only active in training.
+
+    Args:
+      crop: 'resized' for Inception style random resized crops, 'pad' for random translations of up to 4 pixels
+        (like the host pipeline does for small PNG datasets), or None.
+      flip: random horizontal flips.
+      color_strength: color, contrast, brightness and sharpness factors are drawn from
+        [1 - color_strength, 1 + color_strength]. Each op is applied with probability 0.5.
+    """
+
+    def __init__(self, crop='resized', flip=True, color_strength=0.4, **kwargs):
+        super().__init__(**kwargs)
+        self.crop = crop
+        self.flip = flip
+        self.color_strength = color_strength
+
+    def _crop_boxes(self, batch_size, height, width):
+        if self.crop == 'resized':
+            # Area of 8% to 100% of the image with an aspect ratio of 3/4 to 4/3
+            area = tf.random.uniform([batch_size], 0.08, 1.0)
+            log_ratio = tf.random.uniform([batch_size], math.log(3 / 4), math.log(4 / 3))
+            ratio = tf.exp(log_ratio) * tf.cast(height, tf.float32) / tf.cast(width, tf.float32)
+            box_height = tf.minimum(tf.sqrt(area / ratio), 1.0)
+            box_width = tf.minimum(tf.sqrt(area * ratio), 1.0)
+            y1 = tf.random.uniform([batch_size]) * (1 - box_height)
+            x1 = tf.random.uniform([batch_size]) * (1 - box_width)
+            return tf.stack([y1, x1, y1 + box_height, x1 + box_width], axis=1)
+
+        assert self.crop == 'pad', self.crop
+        # Windows of the original size in the image padded by 4 pixels, sampled at exactly the pixel centers
+        offsets = tf.cast(tf.random.uniform([batch_size, 2], maxval=9, dtype=tf.int32), tf.float32)
+        padded = tf.cast(tf.stack([height + 7, width + 7]), tf.float32)
+        size = tf.cast(tf.stack([height - 1, width - 1]), tf.float32)
+        return tf.concat([offsets / padded, (offsets + size) / padded], axis=1)
+
+    def augment(self, images):
+        shape = tf.shape(images)
+        batch_size, height, width = shape[0], shape[1], shape[2]
+
+        # Crop
+        if self.crop is not None:
+            boxes = self._crop_boxes(batch_size, height, width)
+            padded = tf.cast(images, tf.float32)
+            if self.crop == 'pad':
+                padded = tf.pad(padded, [[0, 0], [4, 4], [4, 4], [0, 0]])
+            images = tf.image.crop_and_resize(padded, boxes, tf.range(batch_size), tf.stack([height, width]))
+            images = tf.saturate_cast(tf.round(images), tf.uint8)
+
+        # Flip
+        if self.flip:
+            should_flip = tf.random.uniform([batch_size, 1, 1, 1]) < 0.5
+            images = tf.where(should_flip, tf.reverse(images, axis=[2]), images)
+
+        # Color
+        if self.color_strength > 0:
+            for batch_fn in [color_ops.batch_color, color_ops.batch_contrast,
+                             color_ops.batch_brightness, color_ops.batch_sharpness]:
+                factors = tf.random.uniform([batch_size], 1 - self.color_strength, 1 + self.color_strength)
+                should_apply = tf.random.uniform([batch_size, 1, 1, 1]) < 0.5
+                images = tf.where(should_apply, batch_fn(images, factors), images)
+
+        return images
+
+    def call(self, inputs, training=None):
+        def augment_fn():
+            images = tf.saturate_cast(inputs, tf.uint8)
+            return tf.cast(self.augment(images), inputs.dtype)
+
+        return tf.keras.backend.in_train_phase(augment_fn, inputs, training=training)
+
+    def get_config(self):
+        config = {'crop': self.crop, 'flip': self.flip, 'color_strength': self.color_strength}
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+
 class FeatViews(layers.Layer):
     def call(self, inputs, **kwargs):
         feats1, feats2 = inputs
@@ -51,7 +135,7 @@ class L2Normalize(layers.Layer):
 class MeasureNorm(layers.Layer):
     def call(self, inputs, **kwargs):
         norms = tf.linalg.norm(inputs, axis=1)
-        tf.debugging.assert_rank(norms, 1)
+        checks.check(tf.debugging.assert_rank, norms, 1)
         mean, var = tf.nn.moments(norms, axes=[0])
         self.add_metric(tf.cast(mean, tf.float32), f'{self.name}_mean')
         self.add_metric(tf.cast(var, tf.float32), f'{self.name}_var')
@@ -195,6 +279,7 @@ class Identity(layers.Activation):
 
 custom_objects = {
     'StandardizeImage': StandardizeImage,
+    'DeviceAugment': DeviceAugment,
     'FeatViews': FeatViews,
     'GlobalBatchSims': GlobalBatchSims,
     'L2Normalize': L2Normalize,
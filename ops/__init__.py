@@ -0,0 +1 @@
+"""TensorFlow-only helpers shared by `data`, `models` and `training`."""
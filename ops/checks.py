@@ -0,0 +1,73 @@
+"""Global runtime checks mode of the losses and layers.
+
+The `tf.debugging` assertions serialize execution and block XLA fusion, so they can be turned off or sampled:
+
+  checked: every assertion runs (default)
+  sampled: the assertions of a call run with probability 1 / `every`
+  fast: no assertion ops are added to the graph
+
+The sampled assertions inside a `call_scope` share one draw, so the assertions of a loss or layer call run or are
+skipped together. Outside of a scope, every assertion is sampled on its own.
+
+The mode is read when the losses and layers are traced, so `utils.setup` sets it from `--checks` and `--check-every`
+before the model is built or compiled.
+"""
+import contextlib
+
+import tensorflow as tf
+
+MODES = ['checked', 'sampled', 'fast']
+
+# Default number of calls per sampled check
+CHECK_EVERY = 100
+
+_mode = 'checked'
+_every = CHECK_EVERY
+
+# Whether the sampled checks of the current call run
+_call_sample = None
+
+
+def set_mode(mode, every=CHECK_EVERY):
+    global _mode, _every
+    if mode not in MODES:
+        raise ValueError(f'unknown runtime checks mode {mode}. must be one of {MODES}')
+    if every < 1:
+        raise ValueError(f'checks must be sampled at least every call, not every {every}')
+    _mode, _every = mode, every
+
+
+def get_mode():
+    return _mode
+
+
+@contextlib.contextmanager
+def call_scope():
+    """Draws one sample for all the sampled checks of a loss or layer call. Nested calls share the outer sample."""
+    global _call_sample
+    if _mode != 'sampled' or _call_sample is not None:
+        yield
+        return
+    _call_sample = tf.random.uniform([]) < 1 / _every
+    try:
+        yield
+    finally:
+        _call_sample = None
+
+
+def check(assert_fn, *args, **kwargs):
+    """Runs `assert_fn(*args, **kwargs)` according to the runtime checks mode."""
+    if _mode == 'fast':
+        return
+    if _mode == 'checked':
+        assert_fn(*args, **kwargs)
+        return
+
+    def checked_fn():
+        # Static checks return no op
+        assert_op = assert_fn(*args, **kwargs)
+        with tf.control_dependencies([] if assert_op is None else [assert_op]):
+            return tf.constant(True)
+
+    should_check = _call_sample if _call_sample is not None else tf.random.uniform([]) < 1 / _every
+    tf.cond(should_check, checked_fn, lambda: tf.constant(False))
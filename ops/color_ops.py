@@ -0,0 +1,64 @@
+"""Batch color ops shared by the input pipeline and the on device augmentation layer.
+
+They are the batched equivalents of the PIL ops in `data.augmentations`, with one factor per image. The module only
+depends on TensorFlow, so that the models do not import the input pipeline.
+"""
+import tensorflow as tf
+
+
+def degenerate_gray(image: tf.Tensor) -> tf.Tensor:
+    """The grayscale version of RGB images in the same number of channels. Other images are already gray."""
+    if image.shape[-1] != 3:
+        return image
+    return tf.image.grayscale_to_rgb(tf.image.rgb_to_grayscale(image))
+
+
+def per_image(values: tf.Tensor, dtype=tf.float32) -> tf.Tensor:
+    """Reshapes per image values of shape [N] to [N, 1, 1, 1] to broadcast against a batch."""
+    return tf.reshape(tf.cast(values, dtype), [-1, 1, 1, 1])
+
+
+def batch_blend(images1: tf.Tensor, images2: tf.Tensor, factors: tf.Tensor) -> tf.Tensor:
+    """Same as `blend`, but over batches of images with one factor per image."""
+    images1 = tf.cast(images1, tf.float32)
+    images2 = tf.cast(images2, tf.float32)
+    temp = images1 + per_image(factors) * (images2 - images1)
+    return tf.cast(tf.clip_by_value(temp, 0.0, 255.0), tf.uint8)
+
+
+def batch_color(images: tf.Tensor, factors: tf.Tensor) -> tf.Tensor:
+    degenerate = degenerate_gray(images)
+    return batch_blend(degenerate, images, factors)
+
+
+def batch_contrast(images: tf.Tensor, factors: tf.Tensor) -> tf.Tensor:
+    # Like `contrast`, the mean is the sum of the grayscale histogram of an image divided by 256.
+    shape = tf.shape(images)
+    mean = tf.cast(shape[1] * shape[2], tf.float32) / 256.0
+    mean = tf.cast(tf.clip_by_value(mean, 0.0, 255.0), tf.uint8)
+    degenerate = tf.fill(shape, mean)
+    return batch_blend(degenerate, images, factors)
+
+
+def batch_brightness(images: tf.Tensor, factors: tf.Tensor) -> tf.Tensor:
+    return batch_blend(tf.zeros_like(images), images, factors)
+
+
+def batch_sharpness(images: tf.Tensor, factors: tf.Tensor) -> tf.Tensor:
+    """Same as `sharpness`, but over a batch of images with one factor per image."""
+    channels = images.shape[-1]
+    kernel = tf.constant([[1, 1, 1], [1, 5, 1], [1, 1, 1]],
+                         dtype=tf.float32,
+                         shape=[3, 3, 1, 1]) / 13.
+    kernel = tf.tile(kernel, [1, 1, channels, 1])
+    degenerate = tf.nn.depthwise_conv2d(
+        tf.cast(images, tf.float32), kernel, [1, 1, 1, 1], padding='VALID', dilations=[1, 1])
+    degenerate = tf.cast(tf.clip_by_value(degenerate, 0.0, 255.0), tf.uint8)
+
+    # For the borders of the resulting images, fill in the values of the
+    # original images.
+    padded_degenerate = tf.pad(degenerate, [[0, 0], [1, 1], [1, 1], [0, 0]])
+    padded_mask = tf.pad(tf.ones_like(degenerate, tf.bool), [[0, 0], [1, 1], [1, 1], [0, 0]])
+    result = tf.where(padded_mask, padded_degenerate, images)
+
+    return batch_blend(result, images, factors)
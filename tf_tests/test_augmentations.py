@@ -0,0 +1,303 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import tensorflow as tf
+from absl import logging
+
+import utils
+from data import augmentations, telemetry, xla_augmentations
+
+
+def reference_autocontrast(image):
+    """The RGB only, per channel `autocontrast` from the TF models repo."""
+
+    def scale_channel(image):
+        lo = tf.cast(tf.reduce_min(image), tf.float32)
+        hi = tf.cast(tf.reduce_max(image), tf.float32)
+
+        def scale_values(im):
+            scale = 255.0 / (hi - lo)
+            offset = -lo * scale
+            im = tf.cast(im, tf.float32) * scale + offset
+            im = tf.clip_by_value(im, 0.0, 255.0)
+            return tf.cast(im, tf.uint8)
+
+        return tf.cond(hi > lo, lambda: scale_values(image), lambda: image)
+
+    return tf.stack([scale_channel(image[:, :, c]) for c in range(3)], 2)
+
+
+def reference_equalize(image):
+    """The RGB only, per channel `equalize` from the TF models repo."""
+
+    def scale_channel(im, c):
+        im = tf.cast(im[:, :, c], tf.int32)
+        histo = tf.histogram_fixed_width(im, [0, 255], nbins=256)
+
+        nonzero = tf.where(tf.not_equal(histo, 0))
+        nonzero_histo = tf.reshape(tf.gather(histo, nonzero), [-1])
+        step = (tf.reduce_sum(nonzero_histo) - nonzero_histo[-1]) // 255
+
+        def build_lut(histo, step):
+            lut = (tf.cumsum(histo) + (step // 2)) // step
+            lut = tf.concat([[0], lut[:-1]], 0)
+            return tf.clip_by_value(lut, 0, 255)
+
+        result = tf.cond(tf.equal(step, 0), lambda: im, lambda: tf.gather(build_lut(histo, step), im))
+        return tf.cast(result, tf.uint8)
+
+    return tf.stack([scale_channel(image, c) for c in range(3)], 2)
+
+
+class TestAugmentations(unittest.TestCase):
+
+    def rand_images(self, n, imsize=32, channels=3):
+        return tf.random.uniform([n, imsize, imsize, channels], maxval=256, dtype=tf.int32)
+
+    def test_batch_ops_match_single_image_ops(self):
+        images = tf.cast(self.rand_images(4), tf.uint8)
+        factors = tf.constant([0.0, 0.5, 1.0, 1.9])
+        ints = tf.constant([0, 64, 128, 200])
+        bits = tf.constant([1, 2, 4, 8])
+
+        for batch_fn, single_fn, args in [
+            (augmentations.batch_autocontrast, augmentations.autocontrast, None),
+            (augmentations.batch_equalize, augmentations.equalize, None),
+            (augmentations.batch_invert, augmentations.invert, None),
+            (augmentations.batch_color, augmentations.color, factors),
+            (augmentations.batch_contrast, augmentations.contrast, factors),
+            (augmentations.batch_brightness, augmentations.brightness, factors),
+            (augmentations.batch_sharpness, augmentations.sharpness, factors),
+            (augmentations.batch_solarize, augmentations.solarize, ints),
+            (augmentations.batch_solarize_add, augmentations.solarize_add, ints),
+            (augmentations.batch_posterize, augmentations.posterize, bits),
+        ]:
+            if args is None:
+                batch_out = batch_fn(images)
+                single_out = tf.stack([single_fn(image) for image in images])
+            else:
+                batch_out = batch_fn(images, args)
+                single_out = tf.stack([single_fn(image, arg.numpy().item()) for image, arg in zip(images, args)])
+            tf.debugging.assert_equal(batch_out, single_out, message=f'{batch_fn.__name__}')
+
+    def test_equalize_autocontrast_match_reference(self):
+        images = tf.cast(self.rand_images(8), tf.uint8)
+        # Low contrast, constant and single valued channels
+        images = tf.concat([images, images // 16 + 100, tf.zeros_like(images[:2]),
+                            tf.concat([images[:2, ..., :2], tf.fill([2, 32, 32, 1], tf.constant(7, tf.uint8))], -1)],
+                           axis=0)
+
+        for new_fn, reference_fn in [(augmentations.equalize, reference_equalize),
+                                     (augmentations.autocontrast, reference_autocontrast)]:
+            for image in images:
+                tf.debugging.assert_equal(new_fn(image), reference_fn(image), message=new_fn.__name__)
+
+            # Speed
+            for fn in [new_fn, reference_fn]:
+                fn_on_batch = tf.function(lambda x: tf.map_fn(fn, x))
+                fn_on_batch(images)
+                start = time.time()
+                for _ in range(10):
+                    fn_on_batch(images)
+                logging.info(f'{fn.__name__}: {10 * len(images) / (time.time() - start):.1f} images/sec')
+
+    def test_any_channels(self):
+        for channels in [1, 3]:
+            image = tf.cast(self.rand_images(1, channels=channels)[0], tf.uint8)
+            for fn, args in [(augmentations.equalize, []), (augmentations.autocontrast, []),
+                             (augmentations.color, [0.5]), (augmentations.contrast, [0.5]),
+                             (augmentations.sharpness, [0.5]), (augmentations.cutout, [4, 128]),
+                             (augmentations.wrapped_rotate, [30, [128] * 3])]:
+                out = fn(image, *args)
+                tf.debugging.assert_shapes([(out, [32, 32, channels])], message=fn.__name__)
+
+            images = tf.cast(self.rand_images(4, channels=channels), tf.uint8)
+            for augment in [augmentations.AutoAugment(), augmentations.RandAugment()]:
+                out = augment.distort(images[0])
+                tf.debugging.assert_shapes([(out, [32, 32, channels])])
+
+    def test_compiled_policy(self):
+        image = tf.cast(self.rand_images(1)[0], tf.uint8)
+
+        # Same result as applying the ops directly
+        apply_policy = augmentations.compile_policies([[('Equalize', 1.0, 5), ('Invert', 1.0, 3)]], tf.uint8,
+                                                      image.shape, 100., 250.)
+        tf.debugging.assert_equal(apply_policy(image), augmentations.invert(augmentations.equalize(image)))
+
+        # Cached per policy, dtype and shape
+        self.assertIs(augmentations.compile_policies([[('Equalize', 1.0, 5), ('Invert', 1.0, 3)]], tf.uint8,
+                                                     image.shape, 100., 250.), apply_policy)
+
+        for compiled in [False, True]:
+            augment = augmentations.AutoAugment(compiled=compiled)
+
+            # Graph size and trace time
+            start = time.time()
+            graph_fn = tf.function(augment.distort).get_concrete_function(tf.TensorSpec([32, 32, 3], tf.uint8))
+            trace_time = time.time() - start
+            graph_def = graph_fn.graph.as_graph_def()
+            num_nodes = len(graph_def.node)
+            num_library_nodes = sum(len(fn.node_def) for fn in graph_def.library.function)
+
+            # Repeated eager use
+            start = time.time()
+            for _ in range(100):
+                out = augment.distort(image)
+            eager_images_per_sec = 100 / (time.time() - start)
+            tf.debugging.assert_shapes([(out, [32, 32, 3])])
+            tf.debugging.assert_type(out, tf.uint8)
+
+            logging.info(f'compiled={compiled}: {num_nodes} graph nodes ({num_library_nodes} in library functions), '
+                         f'{trace_time:.2f}s trace time, {eager_images_per_sec:.1f} eager images/sec')
+
+    def test_fused_geometric(self):
+        # Smooth image, so nearest neighbor rounding differences stay small
+        x, y = tf.meshgrid(tf.range(64), tf.range(64))
+        image = tf.cast(tf.stack([x * 4, y * 4, (x + y) * 2], axis=-1), tf.uint8)
+        replace = [128] * 3
+
+        for ops in [[('ShearX', 0.2), ('Rotate', 20.)], [('TranslateX', 5.), ('ShearY', -0.1)],
+                    [('Rotate', -10.), ('TranslateY', -3.), ('ShearX', 0.1)]]:
+            sequential, matrix = image, tf.eye(3)
+            for name, arg in ops:
+                sequential = augmentations.NAME_TO_FUNC[name](sequential, arg, replace)
+                matrix = tf.matmul(matrix, augmentations.geometric_matrix(name, image, arg))
+            fused = augmentations.fused_transform(image, matrix, replace)
+
+            diff = tf.abs(tf.cast(fused, tf.int32) - tf.cast(sequential, tf.int32))
+            mismatch = tf.reduce_mean(tf.cast(diff > 8, tf.float32))
+            self.assertLess(mismatch, 0.05, f'{ops}: {mismatch:.3f} of the pixels differ')
+
+        # Benchmark on a geometric heavy policy
+        policies = [[('ShearX', 0.8, 6), ('Rotate', 0.8, 6)], [('TranslateY', 0.8, 6), ('ShearY', 0.8, 6)],
+                    [('Rotate', 0.8, 4), ('TranslateX', 0.8, 4), ('Equalize', 0.5, 0)]]
+        images = tf.cast(self.rand_images(64, imsize=224), tf.uint8)
+        for fuse_geometric in [False, True]:
+            apply_policy = augmentations.compile_policies(policies, tf.uint8, [224, 224, 3], 100., 250.,
+                                                          fuse_geometric)
+            ds = tf.data.Dataset.from_tensor_slices(images).repeat(4).map(apply_policy, tf.data.AUTOTUNE)
+            start = time.time()
+            for out in ds:
+                pass
+            tf.debugging.assert_shapes([(out, [224, 224, 3])])
+            logging.info(f'fuse_geometric={fuse_geometric}: {4 * 64 / (time.time() - start):.1f} images/sec')
+
+    def test_xla_ops_match_eager(self):
+        image = tf.cast(self.rand_images(1)[0], tf.uint8)
+        replace = [128] * 3
+
+        for name, args in [('AutoContrast', []), ('Equalize', []), ('Invert', []), ('Posterize', [4]),
+                           ('Solarize', [128]), ('SolarizeAdd', [64]), ('Color', [0.5]), ('Contrast', [1.5]),
+                           ('Brightness', [0.5]), ('Sharpness', [1.5]), ('Rotate', [30., replace]),
+                           ('ShearX', [0.3, replace]), ('ShearY', [-0.2, replace]), ('TranslateX', [10, replace]),
+                           ('TranslateY', [-7, replace])]:
+            xla_fn = tf.function(lambda x: xla_augmentations.NAME_TO_FUNC[name](x, *args), jit_compile=True)
+            out, expected = xla_fn(image), augmentations.NAME_TO_FUNC[name](image, *args)
+            if name in augmentations.GEOMETRIC_OPS:
+                # Float rounding may move a few nearest neighbor pixels
+                mismatch = tf.reduce_mean(tf.cast(out != expected, tf.float32))
+                self.assertLess(mismatch, 0.01, f'{name}: {mismatch:.3f} of the pixels differ')
+            elif name == 'Sharpness':
+                # XLA may reorder the float sums of the blur kernel, which rounds some pixels the other way
+                diff = tf.abs(tf.cast(out, tf.int32) - tf.cast(expected, tf.int32))
+                tf.debugging.assert_less_equal(diff, 1, message=name)
+            else:
+                tf.debugging.assert_equal(out, expected, message=name)
+
+        # Cutout at a fixed center
+        xla_fn = tf.function(lambda x: xla_augmentations.cutout_at(x, 5, 30, 4, replace), jit_compile=True)
+        out = xla_fn(image).numpy()
+        expected = image.numpy()
+        expected[1:9, 26:32] = 128
+        self.assertTrue((out == expected).all())
+        tf.debugging.assert_shapes([(xla_augmentations.cutout(image, 4, replace), [32, 32, 3])])
+
+    def test_xla_policies(self):
+        images = tf.cast(self.rand_images(64, imsize=224), tf.uint8)
+        for augment in [augmentations.AutoAugment(), xla_augmentations.AutoAugment(jit_compile=False),
+                        xla_augmentations.AutoAugment(), augmentations.RandAugment(),
+                        xla_augmentations.RandAugment()]:
+            out = augment.distort(images[0])
+            tf.debugging.assert_shapes([(out, [224, 224, 3])])
+            tf.debugging.assert_type(out, tf.uint8)
+
+            # Speed under tf.data
+            ds = tf.data.Dataset.from_tensor_slices(images).repeat(4).map(augment.distort, tf.data.AUTOTUNE)
+            start = time.time()
+            for _ in ds:
+                pass
+            logging.info(f'{type(augment).__module__}.{type(augment).__name__}'
+                         f'(jit_compile={getattr(augment, "jit_compile", False)}): '
+                         f'{4 * 64 / (time.time() - start):.1f} images/sec')
+
+        # Only fixed shapes
+        with self.assertRaises(ValueError):
+            tf.function(xla_augmentations.AutoAugment().distort).get_concrete_function(
+                tf.TensorSpec([None, None, 3], tf.uint8))
+
+        # The static shape ops are not fused
+        args = utils.parser.parse_args('--data-id=mnist --autoaugment --xla-augment --fuse-geometric'.split())
+        with self.assertRaises(ValueError):
+            utils.load_augment_configs(args)
+
+    def test_telemetry(self):
+        images = tf.cast(self.rand_images(64), tf.uint8)
+        policies = [[('Equalize', 1.0, 5), ('Rotate', 0.5, 3)], [('Invert', 1.0, 3)]]
+
+        for compiled, fuse_geometric in [(False, False), (True, False), (True, True)]:
+            augment_telemetry = telemetry.AugmentTelemetry(augmentations.NAME_TO_FUNC, len(policies), sample_rate=0.5)
+            augment = augmentations.AutoAugment('test', compiled=compiled, fuse_geometric=fuse_geometric,
+                                                telemetry=augment_telemetry)
+            augment.policies = policies
+            ds = tf.data.Dataset.from_tensor_slices(images).map(augment.distort, tf.data.AUTOTUNE)
+            for out in ds:
+                tf.debugging.assert_shapes([(out, [32, 32, 3])])
+
+            summary = augment_telemetry.summary()
+            logging.info(f'compiled={compiled}, fuse_geometric={fuse_geometric}: {summary}')
+            self.assertEqual(sum(summary['sub_policy_counts']), 64)
+            self.assertEqual(summary['ops']['Equalize']['count'], summary['sub_policy_counts'][0])
+            self.assertEqual(summary['ops']['Invert']['count'], summary['sub_policy_counts'][1])
+            self.assertLessEqual(summary['ops']['Rotate']['count'], summary['sub_policy_counts'][0])
+            self.assertGreater(summary['ops']['Equalize']['timed'], 0)
+            self.assertGreater(summary['ops']['Equalize']['mean_ms'], 0)
+
+        # JSON and TensorBoard export
+        log_dir = tempfile.mkdtemp()
+        callback = telemetry.TelemetryCallback(augment_telemetry, log_dir)
+        callback.on_epoch_end(0)
+        with open(os.path.join(log_dir, 'augment-telemetry.json')) as f:
+            self.assertEqual(json.load(f)['sub_policy_counts'], summary['sub_policy_counts'])
+        self.assertTrue(os.listdir(os.path.join(log_dir, 'augment')))
+
+        # Only the training views are counted
+        args = '--data-id=mnist --autoaugment --augment-telemetry'
+        train_augment_config, val_augment_config = utils.load_augment_configs(utils.parser.parse_args(args.split()))
+        val_augment_config.view_configs[1].augment(images[0])
+        self.assertEqual(sum(train_augment_config.telemetry.summary()['sub_policy_counts']), 0)
+        train_augment_config.view_configs[1].augment(images[0])
+        self.assertEqual(sum(train_augment_config.telemetry.summary()['sub_policy_counts']), 1)
+
+        # The batch augmentations are not instrumented
+        with self.assertRaises(ValueError):
+            utils.load_augment_configs(utils.parser.parse_args(f'{args} --batch-augment'.split()))
+
+    def test_batch_augment_format(self):
+        images = tf.cast(self.rand_images(16), tf.uint8)
+        for augment in [augmentations.BatchAutoAugment(), augmentations.BatchAutoAugment('simple'),
+                        augmentations.BatchRandAugment(), augmentations.BatchRandAugment(magnitude_std=0.5)]:
+            out = augment.distort(images)
+            tf.debugging.assert_shapes([(out, [16, 32, 32, 3])])
+            tf.debugging.assert_type(out, tf.uint8)
+
+            # Also under tf.data
+            ds = tf.data.Dataset.from_tensors(images).map(augment.distort)
+            out = next(iter(ds))
+            tf.debugging.assert_shapes([(out, [16, 32, 32, 3])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,20 @@
+import json
+import os
+import socket
+import tempfile
+import time
 import unittest
 
+import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 from absl import logging
 
+import benchmark
 import data
 import data.preprocess
 import utils
+from data import class_sampler, pixel_store, service, shard_cache, val_cache, view_bank
 
 
 class TestData(unittest.TestCase):
@@ -67,6 +75,391 @@ class TestData(unittest.TestCase):
         # No file_name
         assert 'file_name' not in inputs
 
+    def test_decode_once_throughput(self):
+        args = '--data-id=tf_flowers --bsz=32 --loss=supcon'
+        args = utils.parser.parse_args(args.split())
+        _ = utils.setup(args)
+
+        _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        train_augment_config, _ = utils.load_augment_configs(args)
+        input_ctx = tf.distribute.InputContext()
+
+        n_steps = 20
+        for decode_once in [False, True]:
+            ds = data.source_dataset(input_ctx, ds_info, args.data_id, 'train', args.cache, shuffle=True, repeat=True,
+                                     augment_config=train_augment_config, global_bsz=args.bsz,
+                                     decode_once=decode_once)
+            ds_iter = iter(ds)
+            inputs, _ = next(ds_iter)
+            tf.debugging.assert_shapes([
+                (inputs['image'], [32, 224, 224, 3]),
+                (inputs['image2'], [32, 224, 224, 3]),
+            ])
+
+            start = time.time()
+            for _ in range(n_steps):
+                next(ds_iter)
+            images_per_sec = n_steps * args.bsz / (time.time() - start)
+            logging.info(f'decode_once={decode_once}: {images_per_sec:.1f} images/sec')
+
+    def test_pixel_store(self):
+        args = '--data-id=mnist --bsz=32 --loss=supcon'
+        args = utils.parser.parse_args(args.split())
+        _ = utils.setup(args)
+
+        _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        train_augment_config, _ = utils.load_augment_configs(args)
+        input_ctx = tf.distribute.InputContext()
+
+        store_dir = tempfile.mkdtemp()
+        pixel_store.ensure_exported(store_dir, args.data_id, ['test'])
+        self.assertFalse(os.path.exists(pixel_store.split_dir(store_dir, args.data_id, 'test') + '.incomplete'))
+        arrays = pixel_store.load_arrays(pixel_store.split_dir(store_dir, args.data_id, 'test'))
+        self.assertEqual(arrays['image'].shape, (10000, 28, 28, 1))
+        self.assertEqual(arrays['label'].shape, (10000,))
+
+        n_steps = 20
+        for pixel_store_dir in [None, store_dir]:
+            ds = data.source_dataset(input_ctx, ds_info, args.data_id, 'test', args.cache, shuffle=True, repeat=True,
+                                     augment_config=train_augment_config, global_bsz=args.bsz,
+                                     pixel_store_dir=pixel_store_dir)
+            ds_iter = iter(ds)
+            inputs, targets = next(ds_iter)
+            tf.debugging.assert_shapes([
+                (inputs['image'], [32, 28, 28, 1]),
+                (targets['label'], [32]),
+            ])
+            tf.debugging.assert_type(inputs['image'], tf.uint8)
+            tf.debugging.assert_type(targets['label'], tf.int64)
+
+            start = time.time()
+            for _ in range(n_steps):
+                next(ds_iter)
+            images_per_sec = n_steps * args.bsz / (time.time() - start)
+            logging.info(f'pixel_store_dir={pixel_store_dir}: {images_per_sec:.1f} images/sec')
+
+    def test_resume_data_order(self):
+        arrays = {'label': tf.range(1000, dtype=tf.int64).numpy()}
+        input_ctx = tf.distribute.InputContext(num_input_pipelines=2, input_pipeline_id=1)
+
+        # Three epochs of the seeded order, each with its own order
+        ds = pixel_store.gather_dataset(arrays, input_ctx, shuffle=True, repeat=True, seed=7)
+        order = [x['label'] for x in ds.take(1500).as_numpy_iterator()]
+        self.assertEqual(sorted(order[:500]), list(range(1, 1000, 2)))
+        self.assertEqual(sorted(order[500:1000]), list(range(1, 1000, 2)))
+        self.assertNotEqual(order[:500], order[500:1000])
+
+        # Resuming mid epoch neither duplicates nor skips any example
+        for skip in [1, 300, 700, 1200]:
+            ds = pixel_store.gather_dataset(arrays, input_ctx, shuffle=True, repeat=True, seed=7, skip=skip)
+            resumed = [x['label'] for x in ds.take(1500 - skip).as_numpy_iterator()]
+            self.assertEqual(resumed, order[skip:])
+
+        # Same for the shuffle buffers of the other sources
+        ds = data._shuffle_and_repeat(tf.data.Dataset.range(100), 'train', shuffle=True, repeat=True, seed=7,
+                                      buffer_size=10, epoch_size=100)
+        order = list(ds.take(300).as_numpy_iterator())
+        for skip in [30, 250]:
+            ds = data._shuffle_and_repeat(tf.data.Dataset.range(100), 'train', shuffle=True, repeat=True, seed=7,
+                                          skip=skip, buffer_size=10, epoch_size=100)
+            self.assertEqual(list(ds.take(300 - skip).as_numpy_iterator()), order[skip:])
+
+    def test_shuffle_buffer_size(self):
+        _, ds_info = tfds.load('cifar10', try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        input_ctx = tf.distribute.InputContext(num_input_pipelines=4, input_pipeline_id=0)
+
+        # A large budget holds the whole share of the input pipeline
+        self.assertEqual(data.shuffle_buffer_size(ds_info, 'train', input_ctx, 1024), 50000 // 4)
+
+        # Otherwise the buffer scales with the budget
+        small = data.shuffle_buffer_size(ds_info, 'train', input_ctx, 8)
+        self.assertLess(small, 50000 // 4)
+        self.assertLessEqual(small * data.example_bytes(ds_info, 'train'), 8e6)
+
+        # But it never gets too small
+        self.assertEqual(data.shuffle_buffer_size(ds_info, 'train', input_ctx, 1, decoded=True),
+                         data.MIN_SHUFFLE_BUFFER)
+
+    def test_benchmark(self):
+        out = os.path.join(tempfile.mkdtemp(), 'benchmark.json')
+        cmd_args = benchmark.parser.parse_args(f'--data-ids mnist --threads 1 2 --num-images 256 --out {out}'.split())
+        results = benchmark.run(cmd_args)
+        self.assertEqual(len(results), 2 * 2 * len(benchmark.STAGES))
+        for result in results:
+            logging.info(f"{result['stage']}: {result['shuffle_buffer_mb']:.1f} MB shuffle buffer, "
+                         f"{result['first_element_sec']:.2f}s to first element")
+        with open(out) as f:
+            self.assertEqual(json.load(f), results)
+
+        # The benchmark's args have none of the training augment flags
+        utils.load_augment_configs(benchmark.parser.parse_args(['--autoaugment']))
+
+    def test_data_service(self):
+        args = '--data-id=mnist --bsz=32 --loss=supcon --autoaugment'
+        args = utils.parser.parse_args(args.split())
+        _ = utils.setup(args)
+
+        _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        train_augment_config, _ = utils.load_augment_configs(args)
+        input_ctx = tf.distribute.InputContext()
+        data_service = service.setup_service(num_workers=2)
+
+        n_steps = 20
+        for target in [None, data_service]:
+            ds = data.source_dataset(input_ctx, ds_info, args.data_id, 'test', args.cache, shuffle=True, repeat=True,
+                                     augment_config=train_augment_config, global_bsz=args.bsz, data_service=target)
+            ds_iter = iter(ds)
+            inputs, targets = next(ds_iter)
+            tf.debugging.assert_shapes([
+                (inputs['image'], [32, 28, 28, 1]),
+                (inputs['image2'], [32, 28, 28, 1]),
+                (targets['label'], [32]),
+            ])
+
+            start = time.time()
+            for _ in range(n_steps):
+                next(ds_iter)
+            images_per_sec = n_steps * args.bsz / (time.time() - start)
+            logging.info(f'data_service={target}: {images_per_sec:.1f} images/sec')
+
+        # The workers do not share the data seed, so they do not produce the same batches
+        ds = data.source_dataset(input_ctx, ds_info, args.data_id, 'test', args.cache, shuffle=True, repeat=True,
+                                 augment_config=train_augment_config, global_bsz=args.bsz, data_service=data_service,
+                                 seed=0)
+        (_, targets1), (_, targets2) = ds.take(2)
+        self.assertFalse(tf.reduce_all(targets1['label'] == targets2['label']))
+
+    def test_data_service_worker_address(self):
+        # Workers advertise an address the trainer can reach
+        self.assertEqual(service.worker_config('grpc://localhost:5050').worker_address, 'localhost:%port%')
+        self.assertEqual(service.worker_config('grpc://dispatcher:5050').worker_address,
+                         f'{socket.gethostname()}:%port%')
+        self.assertEqual(service.worker_config('dispatcher:5050', host='10.0.0.2').worker_address, '10.0.0.2:%port%')
+
+    def test_val_cache(self):
+        args = '--data-id=mnist --bsz=32 --loss=supcon --autoaugment'
+        args = utils.parser.parse_args(args.split())
+        _ = utils.setup(args)
+
+        _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        _, val_augment_config = utils.load_augment_configs(args)
+        input_ctx = tf.distribute.InputContext()
+        out_dir = os.path.join(tempfile.mkdtemp(), 'test')
+
+        # Memory and disk caches hold the same seeded views, and the seed does not leak into the rest of the run
+        tf.random.set_seed(2)
+        expected = tf.random.uniform([4])
+        tf.random.set_seed(2)
+        in_memory = val_cache.materialize(ds_info, args.data_id, 'test', val_augment_config, seed=1)
+        tf.debugging.assert_equal(tf.random.uniform([4]), expected)
+        on_disk = val_cache.materialize(ds_info, args.data_id, 'test', val_augment_config, seed=1, out_dir=out_dir)
+        for name in ['image', 'image2', 'label']:
+            self.assertEqual(in_memory[name].shape[0], 10000)
+            self.assertTrue((in_memory[name] == on_disk[name]).all(), name)
+
+        # Other seeds pick other autoaugment views
+        other_seed = val_cache.materialize(ds_info, args.data_id, 'test', val_augment_config, seed=2)
+        self.assertTrue((in_memory['image'] == other_seed['image']).all())
+        self.assertFalse((in_memory['image2'] == other_seed['image2']).all())
+
+        # Every pass sees the same batches
+        ds = val_cache.materialized_dataset(on_disk, input_ctx, val_augment_config, args.bsz)
+        first, second = ds.take(10000 // args.bsz), ds.skip(10000 // args.bsz).take(10000 // args.bsz)
+        start = time.time()
+        for (inputs1, targets1), (inputs2, _) in zip(first, second):
+            tf.debugging.assert_shapes([(inputs1['image2'], [32, 28, 28, 1]), (targets1['label'], [32])])
+            tf.debugging.assert_equal(inputs1['image2'], inputs2['image2'])
+        logging.info(f'{2 * 10000 / (time.time() - start):.1f} materialized images/sec')
+
+    def test_view_bank(self):
+        args = '--data-id=mnist --bsz=32 --loss=supcon --view-bank=4 --data-seed=0'
+        args = utils.parser.parse_args(args.split())
+        _ = utils.setup(args)
+
+        _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        train_augment_config, _ = utils.load_augment_configs(args)
+        input_ctx = tf.distribute.InputContext()
+        out_dir = os.path.join(tempfile.mkdtemp(), 'bank')
+        view_bank.ensure_exported(ds_info, args.data_id, 'test', train_augment_config.view_configs[0], 4, out_dir)
+        arrays = pixel_store.load_arrays(out_dir, view_bank.NAMES)
+        self.assertEqual(arrays['views'].shape, (10000, 4, 28, 28, 1))
+
+        # The two views of every example are distinct stored views
+        ds = data.source_dataset(input_ctx, ds_info, args.data_id, 'test', cache=None, shuffle=True, repeat=True,
+                                 augment_config=train_augment_config, global_bsz=args.bsz, seed=0,
+                                 view_bank_dir=out_dir)
+        start = time.time()
+        for inputs, targets in ds.take(100):
+            tf.debugging.assert_shapes([(inputs['image'], [32, 28, 28, 1]), (targets['label'], [32])])
+            self.assertFalse(tf.reduce_all(inputs['image'] == inputs['image2']))
+        logging.info(f'{2 * 100 * args.bsz / (time.time() - start):.1f} view bank images/sec')
+
+        # Resumed datasets pick the same views
+        ds_resumed = data.source_dataset(input_ctx, ds_info, args.data_id, 'test', cache=None, shuffle=True,
+                                         repeat=True, augment_config=train_augment_config, global_bsz=args.bsz,
+                                         seed=0, skip=5 * args.bsz, view_bank_dir=out_dir)
+        for (inputs1, _), (inputs2, _) in zip(ds.skip(5).take(5), ds_resumed.take(5)):
+            tf.debugging.assert_equal(inputs1['image2'], inputs2['image2'])
+
+        # Device augmented runs only center crop on the host
+        args.device_augment = True
+        with self.assertRaises(ValueError):
+            data.export_view_bank(args, ds_info, utils.load_augment_configs(args)[0])
+
+    def test_class_balanced(self):
+        args = '--data-id=cifar100 --bsz=64 --loss=supcon'
+        args = utils.parser.parse_args(args.split())
+        _ = utils.setup(args)
+
+        _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        train_augment_config, _ = utils.load_augment_configs(args)
+        input_ctx = tf.distribute.InputContext(num_input_pipelines=2, input_pipeline_id=0, num_replicas_in_sync=2)
+        store_dir = tempfile.mkdtemp()
+        pixel_store.ensure_exported(store_dir, args.data_id, ['test'])
+
+        # The shuffled streams of the other readers cannot keep the classes of a batch distinct
+        k, n_steps = 4, 20
+        with self.assertRaises(ValueError):
+            data.source_dataset(input_ctx, ds_info, args.data_id, 'test', args.cache, shuffle=True, repeat=True,
+                                augment_config=train_augment_config, global_bsz=args.bsz, class_balanced=k)
+
+        for pixel_store_dir, class_balanced in [(None, None), (store_dir, None), (store_dir, k)]:
+            ds = data.source_dataset(input_ctx, ds_info, args.data_id, 'test', args.cache, shuffle=True, repeat=True,
+                                     augment_config=train_augment_config, global_bsz=args.bsz,
+                                     pixel_store_dir=pixel_store_dir, class_balanced=class_balanced, seed=0)
+            positives = []
+            for _, targets in ds.take(n_steps):
+                labels = targets['label']
+                tf.debugging.assert_shapes([(labels, [32])])
+                if class_balanced:
+                    # Runs of K examples of distinct classes
+                    groups = tf.reshape(labels, [-1, k])
+                    tf.debugging.assert_equal(groups, tf.repeat(groups[:, :1], k, axis=1))
+                    self.assertEqual(len(set(groups[:, 0].numpy())), len(groups))
+                positives.append(class_sampler.positives_per_anchor(labels))
+            logging.info(f'pixel_store_dir={pixel_store_dir}, class_balanced={class_balanced}: '
+                         f'{tf.reduce_mean(positives):.2f} positives per anchor')
+
+    def test_class_sampler(self):
+        # 10 classes, one of them with fewer examples than k
+        labels = np.concatenate([np.repeat(np.arange(9), 20), [9, 9]])
+        input_ctx = tf.distribute.InputContext()
+        k, classes_per_batch = 4, 5
+        ds = class_sampler.sample_indices(labels, 10, input_ctx, classes_per_batch, k, seed=0)
+        for indices in ds.batch(classes_per_batch * k).take(50):
+            groups = tf.reshape(indices, [classes_per_batch, k]).numpy()
+            group_labels = labels[groups]
+            self.assertTrue((group_labels == group_labels[:, :1]).all())
+            self.assertEqual(len(set(group_labels[:, 0])), classes_per_batch)
+            for group, label in zip(groups, group_labels[:, 0]):
+                # Drawn without replacement, as far as the class has examples
+                self.assertEqual(len(set(group)), min(k, (labels == label).sum()))
+
+    def test_class_sampler_pipelines(self):
+        # Every pipeline takes its own slice of the step's classes
+        labels = np.repeat(np.arange(20), 10)
+        k, classes_per_batch, num_pipelines = 2, 4, 2
+        pipeline_classes = []
+        for pipeline_id in range(num_pipelines):
+            input_ctx = tf.distribute.InputContext(num_pipelines, pipeline_id, num_pipelines)
+            ds = class_sampler.sample_indices(labels, 20, input_ctx, classes_per_batch, k, seed=0)
+            steps = [set(labels[indices.numpy()]) for indices in ds.batch(classes_per_batch * k).take(20)]
+            pipeline_classes.append(steps)
+        for classes0, classes1 in zip(*pipeline_classes):
+            self.assertEqual(len(classes0), classes_per_batch)
+            self.assertFalse(classes0 & classes1)
+
+        # Separately seeded pipelines would draw the same classes
+        with self.assertRaises(ValueError):
+            class_sampler.sample_indices(labels, 20, input_ctx, classes_per_batch, k)
+
+    def test_shard_cache(self):
+        data_id, data_dir, local_dir = 'mnist', 'gs://aigagror/datasets', tempfile.mkdtemp()
+
+        # Cold and warm start
+        for _ in range(2):
+            start = time.time()
+            self.assertEqual(shard_cache.sync_dataset(data_id, data_dir, local_dir), local_dir)
+            logging.info(f'synced {data_id} in {time.time() - start:.2f}s')
+
+        # Local metadata and shards
+        _, ds_info = tfds.load(data_id, data_dir=local_dir, with_info=True)
+        self.assertEqual(ds_info.splits['train'].num_examples, 60000)
+
+        # Steady-state read throughput
+        for read_dir in [data_dir, local_dir]:
+            shard_cache.measure_read_throughput(data_id, read_dir)
+
+    def test_shard_cache_metadata_then_full(self):
+        data_id, data_dir, local_dir = 'mnist', 'gs://aigagror/datasets', tempfile.mkdtemp()
+
+        # A metadata only copy is completed by a full sync
+        shard_cache.sync_dataset(data_id, data_dir, local_dir, metadata_only=True)
+        shard_cache.sync_dataset(data_id, data_dir, local_dir)
+        self.assertEqual(len(list(tfds.load(data_id, split='test', data_dir=local_dir))), 10000)
+
+        # And a full copy does for a later metadata only sync, without being downgraded
+        shard_cache.sync_dataset(data_id, data_dir, local_dir, metadata_only=True)
+        self.assertFalse(shard_cache._read_manifest(local_dir, data_id)['metadata_only'])
+
+    def test_load_info(self):
+        data_id, data_dir, metadata_dir = 'cifar10', 'gs://aigagror/datasets', tempfile.mkdtemp()
+        _, ds_info = tfds.load(data_id, try_gcs=True, data_dir=data_dir, with_info=True)
+
+        # Cold start, then warm start
+        for _ in range(2):
+            start = time.time()
+            cached_info = shard_cache.load_info(data_id, data_dir, metadata_dir)
+            logging.info(f'loaded {data_id} info in {time.time() - start:.2f}s')
+            self.assertEqual(cached_info.features['image'].shape, ds_info.features['image'].shape)
+            self.assertEqual(cached_info.features['label'].num_classes, ds_info.features['label'].num_classes)
+            for split in ['train', 'test']:
+                self.assertEqual(cached_info.splits[split].num_examples, ds_info.splits[split].num_examples)
+
+    def test_cache_tiers(self):
+        args = '--data-id=mnist --bsz=32 --loss=supcon'
+        args = utils.parser.parse_args(args.split())
+        _ = utils.setup(args)
+
+        _, ds_info = tfds.load(args.data_id, try_gcs=True, data_dir='gs://aigagror/datasets', with_info=True)
+        train_augment_config, _ = utils.load_augment_configs(args)
+        input_ctx = tf.distribute.InputContext()
+        cache_dir = tempfile.mkdtemp()
+
+        for cache in [None] + data.CACHE_TIERS:
+            ds = data.source_dataset(input_ctx, ds_info, args.data_id, 'test', cache, shuffle=True, repeat=False,
+                                     augment_config=train_augment_config, global_bsz=args.bsz, cache_dir=cache_dir)
+
+            # The first epoch fills the cache
+            n_batches = sum(1 for _ in ds)
+            self.assertEqual(n_batches, 10000 // args.bsz)
+
+            start = time.time()
+            for inputs, _ in ds:
+                tf.debugging.assert_shapes([(inputs['image'], [32, 28, 28, 1])])
+            images_per_sec = n_batches * args.bsz / (time.time() - start)
+
+            # Footprint
+            if cache in ['decoded-disk', 'snapshot']:
+                tier_dir = os.path.join(cache_dir, cache)
+                footprint = sum(os.path.getsize(os.path.join(root, name))
+                                for root, _, names in os.walk(tier_dir) for name in names)
+            elif cache in ['encoded', 'decoded']:
+                # The in-memory tiers hold the encoded bytes or the images as decoded for the cache
+                ds_encoded = tfds.load(args.data_id, split='test', as_supervised=True, try_gcs=True,
+                                       decoders={'image': tfds.decode.SkipDecoding()},
+                                       data_dir='gs://aigagror/datasets')
+                if cache == 'encoded':
+                    footprint = sum(len(image) for image, _ in ds_encoded.as_numpy_iterator())
+                else:
+                    decode_fn = lambda image, label: data.preprocess.decode_and_resize(image, label, 28, 1)
+                    ds_decoded = ds_encoded.map(decode_fn, tf.data.AUTOTUNE)
+                    footprint = sum(image.nbytes for image, _, _ in ds_decoded.as_numpy_iterator())
+                    self.assertEqual(footprint, 10000 * data.example_bytes(ds_info, 'test', decoded=True))
+            else:
+                footprint = 0
+            logging.info(f'cache={cache}: {footprint / 1e6:.1f} MB, {images_per_sec:.1f} images/sec')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -68,6 +68,24 @@ class LayersTest(unittest.TestCase):
         prod = x * y
         tf.debugging.assert_greater_equal(prod, tf.zeros_like(prod))
 
+    def test_device_augment(self):
+        img = tf.io.decode_image(tf.io.read_file('images/imagenet-sample.jpg'))
+        img = tf.image.resize(img, [64, 64])
+        imgs = tf.repeat(tf.expand_dims(img, 0), 8, axis=0)
+
+        for crop in ['resized', 'pad', None]:
+            device_augment = custom_layers.DeviceAugment(crop)
+            aug_imgs = device_augment(imgs, training=True)
+            tf.debugging.assert_shapes([(aug_imgs, [8, 64, 64, 3])])
+            self.assertEqual(aug_imgs.dtype, imgs.dtype)
+            tf.debugging.assert_greater_equal(aug_imgs, 0.0)
+            tf.debugging.assert_less_equal(aug_imgs, 255.0)
+
+            # Identity in inference
+            tf.debugging.assert_equal(device_augment(imgs, training=False), imgs)
+
+        custom_layers.DeviceAugment(**custom_layers.DeviceAugment('pad', name='foo').get_config())
+
     def test_configs(self):
         identity_config = custom_layers.Identity(name='foo', dtype=tf.float32).get_config()
         custom_layers.Identity(**identity_config)
@@ -1,7 +1,14 @@
+import os
+import resource
+import subprocess
+import sys
+import time
 import unittest
 
 import tensorflow as tf
+from absl import logging
 
+from ops import checks
 from training import custom_losses
 
 
@@ -21,6 +28,30 @@ class LossesTest(unittest.TestCase):
     def rand_labels(self, n):
         return tf.random.uniform([n, 1], maxval=2, dtype=tf.int32)
 
+    def log_step_time(self, name, loss_fn, n, d=128, num_steps=5):
+        """Logs the forward and backward step time of `loss_fn` at batch `n`, and the peak memory if there is a GPU."""
+        y = tf.random.uniform([n, 1], maxval=100, dtype=tf.int32)
+        x = self.rand_feat_views(n, d)
+
+        @tf.function
+        def step(y, x):
+            with tf.GradientTape() as tape:
+                tape.watch(x)
+                loss = loss_fn(y, x)
+            return loss, tape.gradient(loss, x)
+
+        step(y, x)
+        devices = tf.config.list_logical_devices('GPU')
+        if devices:
+            tf.config.experimental.reset_memory_stats(devices[0].name)
+        start = time.time()
+        for _ in range(num_steps):
+            step(y, x)
+        peak = ''
+        if devices:
+            peak = f", {tf.config.experimental.get_memory_info(devices[0].name)['peak'] / 1e6:.1f} MB peak"
+        logging.info(f'{name}, batch {n}: {1000 * (time.time() - start) / num_steps:.1f} ms/step{peak}')
+
     # Error
     def test_y_true_greater_than_two_error(self):
         for loss in [custom_losses.SimCLR(0.1), custom_losses.SupCon(0.1), custom_losses.HierCon(0.1)]:
@@ -90,6 +121,157 @@ class LossesTest(unittest.TestCase):
             hiercon_loss = loss_fn(labels, x)
             tf.debugging.assert_near(ce_loss, hiercon_loss, atol=1e-2)
 
+    def test_fused_hiercon(self):
+        for LossClass in [custom_losses.HierCon, custom_losses.HierCon2]:
+            loss_fn, fused_loss_fn = LossClass(0.1), LossClass(0.1, fused=True)
+            # Up to several tiles of the fused losses
+            for n in [1, 4, 16, custom_losses.FUSED_TILE_SIZE + 5]:
+                y = self.rand_labels(n)
+                x = self.rand_feat_views(n, 32)
+                with tf.GradientTape(persistent=True) as tape:
+                    tape.watch(x)
+                    loss, fused_loss = loss_fn(y, x), fused_loss_fn(y, x)
+                tf.debugging.assert_near(loss, fused_loss, atol=1e-5, message=f'{LossClass}')
+                tf.debugging.assert_near(tape.gradient(loss, x), tape.gradient(fused_loss, x), atol=1e-5,
+                                         message=f'{LossClass}')
+
+            # Step time and peak memory at large batch
+            for fn in [loss_fn, fused_loss_fn]:
+                self.log_step_time(f'{LossClass.__name__}(fused={fn.fused})', fn, 4096)
+
+        # The other losses have no fused implementation
+        for LossClass in [custom_losses.SimCLR, custom_losses.SupCon]:
+            with self.assertRaises(ValueError):
+                LossClass(0.1, fused=True)
+
+    def test_tiled_losses(self):
+        for LossClass in [custom_losses.SimCLR, custom_losses.SupCon, custom_losses.HierCon, custom_losses.HierCon2]:
+            loss_fn = LossClass(0.1)
+            for n in [1, 5, 16]:
+                y = self.rand_labels(n)
+                x = self.rand_feat_views(n, 32)
+                for tile_size in [1, 3, 64]:
+                    tiled_loss_fn = LossClass(0.1, tile_size=tile_size)
+                    with tf.GradientTape(persistent=True) as tape:
+                        tape.watch(x)
+                        loss, tiled_loss = loss_fn(y, x), tiled_loss_fn(y, x)
+                    message = f'{LossClass} batch {n} tile {tile_size}'
+                    tf.debugging.assert_near(loss, tiled_loss, atol=1e-5, message=message)
+                    tf.debugging.assert_near(tape.gradient(loss, x), tape.gradient(tiled_loss, x), atol=1e-5,
+                                             message=message)
+
+            # Same queue scores as the dense path
+            n, d = 4, 32
+            ys, xs = [self.rand_labels(n) for _ in range(2)], [self.rand_feat_views(n, d) for _ in range(2)]
+            loss_fn = LossClass(0.1, queue_size=6, feat_dim=d)
+            tiled_loss_fn = LossClass(0.1, queue_size=6, feat_dim=d, tile_size=3)
+            for y, x in zip(ys, xs):
+                tf.debugging.assert_near(loss_fn(y, x), tiled_loss_fn(y, x), atol=1e-5, message=f'{LossClass}')
+            tf.debugging.assert_equal(loss_fn.queue_feats, tiled_loss_fn.queue_feats)
+
+        # Replicas score their local rows against the global batch
+        strategy = tf.distribute.MirroredStrategy(['CPU:0', 'CPU:1'])
+        global_y, global_x = self.rand_labels(8), self.rand_feat_views(8, 32)
+        loss = custom_losses.HierCon(0.1)(global_y, global_x)
+        with strategy.scope():
+            tiled_loss_fn = custom_losses.HierCon(0.1, tile_size=3, reduction=tf.keras.losses.Reduction.SUM)
+        y = strategy.experimental_distribute_values_from_function(
+            lambda ctx: global_y[4 * ctx.replica_id_in_sync_group:4 * ctx.replica_id_in_sync_group + 4])
+        x = strategy.experimental_distribute_values_from_function(
+            lambda ctx: global_x[4 * ctx.replica_id_in_sync_group:4 * ctx.replica_id_in_sync_group + 4])
+        tiled_losses = strategy.run(tf.function(tiled_loss_fn), args=(y, x))
+        tiled_loss = tf.add_n(strategy.experimental_local_results(tiled_losses)) / 8
+        tf.debugging.assert_near(loss, tiled_loss, atol=1e-5)
+
+        # Only losses with a group loss can be tiled
+        with self.assertRaises(ValueError):
+            custom_losses.ConLoss(0.1, tile_size=3)
+
+        # Step time and peak memory at large batch
+        for fn in [custom_losses.HierCon(0.1), custom_losses.HierCon(0.1, tile_size=1024)]:
+            self.log_step_time(f'HierCon(tile_size={fn.tile_size})', fn, 8192)
+
+    def test_feature_queue(self):
+        n, d = 4, 32
+        ys = [self.rand_labels(n) for _ in range(3)]
+        xs = [self.rand_feat_views(n, d) for _ in range(3)]
+        for LossClass in [custom_losses.SimCLR, custom_losses.SupCon, custom_losses.HierCon]:
+            loss_fn = LossClass(0.1, queue_size=6, queue_max_age=1, feat_dim=d)
+
+            # The empty queue does not change the loss
+            tf.debugging.assert_near(loss_fn(ys[0], xs[0]), LossClass(0.1)(ys[0], xs[0]), message=f'{LossClass}')
+            tf.debugging.assert_equal(loss_fn.queue_feats[:n], xs[0][:, 1])
+            tf.debugging.assert_equal(loss_fn.queue_labels[:n], tf.cast(ys[0][:, 0], tf.int64))
+
+            # The queue wraps around and scores the previous batch as extra columns
+            batch_sims, sims = loss_fn.process_y(ys[1], xs[1])
+            tf.debugging.assert_shapes([(batch_sims, [n, n + 6]), (sims, [n, n + 6])])
+            expected_sims = tf.matmul(xs[1][:, 0], xs[0][:, 1], transpose_b=True)
+            tf.debugging.assert_near(sims[:, n:n + n], expected_sims)
+            tf.debugging.assert_equal(sims[:, n + n:], tf.fill([n, 2], custom_losses.INVALID_SIM))
+            tf.debugging.assert_less_equal(batch_sims[:, n:], tf.ones_like(batch_sims[:, n:]))
+            tf.debugging.assert_equal(loss_fn.queue_feats[n:], xs[1][:2, 1])
+            tf.debugging.assert_equal(loss_fn.queue_feats[:2], xs[1][2:, 1])
+
+            # Batches older than queue_max_age steps are not scored
+            _, sims = loss_fn.process_y(ys[2], xs[2])
+            self.assertEqual(tf.reduce_sum(tf.cast(sims[:, n:] > custom_losses.INVALID_SIM, tf.int32)), n * n)
+
+            # Nothing is enqueued while disabled
+            queue_feats = tf.identity(loss_fn.queue_feats)
+            loss_fn.enqueue_enabled.assign(False)
+            loss_fn(ys[0], xs[0])
+            tf.debugging.assert_equal(loss_fn.queue_feats, queue_feats)
+
+        # Every replica keeps the same queue
+        strategy = tf.distribute.MirroredStrategy(['CPU:0', 'CPU:1'])
+        with strategy.scope():
+            loss_fn = custom_losses.SupCon(0.1, queue_size=8, feat_dim=d, reduction=tf.keras.losses.Reduction.SUM)
+        y = strategy.experimental_distribute_values_from_function(lambda ctx: ys[ctx.replica_id_in_sync_group])
+        x = strategy.experimental_distribute_values_from_function(lambda ctx: xs[ctx.replica_id_in_sync_group])
+        strategy.run(tf.function(loss_fn), args=(y, x))
+        queues = strategy.experimental_local_results(loss_fn.queue_feats)
+        for queue in queues:
+            tf.debugging.assert_equal(queue, tf.concat([xs[0][:, 1], xs[1][:, 1]], axis=0))
+
+    def test_checks_modes(self):
+        try:
+            # Failing assertions only raise in the checked modes, eagerly and when traced
+            for mode, every, raises in [('checked', 100, True), ('sampled', 1, True), ('fast', 100, False)]:
+                checks.set_mode(mode, every)
+                check_fn = lambda x: checks.check(tf.debugging.assert_non_positive, x)
+                for fn in [check_fn, tf.function(check_fn)]:
+                    if raises:
+                        with self.assertRaises(tf.errors.InvalidArgumentError):
+                            fn(tf.ones([2]))
+                    else:
+                        fn(tf.ones([2]))
+
+            # The sampled checks of a call share one draw
+            checks.set_mode('sampled', 2)
+            num_checked = tf.Variable(0)
+
+            def count_fn():
+                num_checked.assign_add(1)
+
+            def call_fn():
+                with checks.call_scope():
+                    for _ in range(5):
+                        checks.check(count_fn)
+
+            for fn in [call_fn, tf.function(call_fn)]:
+                for _ in range(20):
+                    num_checked.assign(0)
+                    fn()
+                    self.assertIn(int(num_checked.numpy()), [0, 5])
+
+            # Step time of every mode
+            for mode in checks.MODES:
+                checks.set_mode(mode)
+                self.log_step_time(f'HierCon, {mode} checks', custom_losses.HierCon(0.1), 1024, num_steps=10)
+        finally:
+            checks.set_mode('checked')
+
     # Test cross entropy correctness
     def test_zero_loss(self):
         for loss_fn in [custom_losses.SimCLR(0.1), custom_losses.SupCon(0.1)]:
@@ -125,6 +307,55 @@ class LossesTest(unittest.TestCase):
             for order in all_ids.values:
                 tf.debugging.assert_equal(ref_order, order)
 
+    def local_batch_sims_fns(self, strategy, global_bsz):
+        """The local label similarities of `ConLoss.process_y` and a full global matrix reference, with their inputs."""
+        def reference_batch_sims(y):
+            # Full global x global label similarities, sliced to the local rows
+            replica_context = tf.distribute.get_replica_context()
+            all_labels = replica_context.all_gather(y, axis=0)
+            global_bsz = tf.shape(all_labels)[0]
+            batch_sims = tf.cast(all_labels == tf.transpose(all_labels), tf.uint8)
+            batch_sims += tf.eye(global_bsz, dtype=tf.uint8)
+            batch_sims = tf.reshape(batch_sims, [replica_context.num_replicas_in_sync, tf.shape(y)[0], global_bsz])
+            return batch_sims[replica_context.replica_id_in_sync_group]
+
+        local_bsz = global_bsz // strategy.num_replicas_in_sync
+        ys = [tf.random.uniform([local_bsz, 1], maxval=10, dtype=tf.int32)
+              for _ in range(strategy.num_replicas_in_sync)]
+        xs = [self.rand_feat_views(local_bsz, 32) for _ in range(strategy.num_replicas_in_sync)]
+        y = strategy.experimental_distribute_values_from_function(lambda ctx: ys[ctx.replica_id_in_sync_group])
+        x = strategy.experimental_distribute_values_from_function(lambda ctx: xs[ctx.replica_id_in_sync_group])
+
+        local_fn = tf.function(lambda y, x: strategy.run(lambda y, x: custom_losses.ConLoss(0.1).process_y(y, x)[0],
+                                                         args=(y, x)))
+        reference_fn = tf.function(lambda y: strategy.run(reference_batch_sims, args=(y,)))
+        return local_fn, reference_fn, y, x
+
+    def test_local_batch_sims(self):
+        # One replica count per process. Collectives of different group sizes do not mix
+        strategy = tf.distribute.MirroredStrategy(['CPU:0', 'CPU:1'])
+        global_bsz = 64
+        local_fn, reference_fn, y, x = self.local_batch_sims_fns(strategy, global_bsz)
+        local_sims, reference_sims = local_fn(y, x), reference_fn(y)
+        for local, reference in zip(strategy.experimental_local_results(local_sims),
+                                    strategy.experimental_local_results(reference_sims)):
+            tf.debugging.assert_shapes([(local, [global_bsz // 2, global_bsz])])
+            tf.debugging.assert_equal(local, reference)
+
+    def test_local_batch_sims_step_time(self):
+        # One process per replica count and construction. Collectives of different group sizes do not mix, and the peak
+        # memory of a process never goes down
+        tests_dir = os.path.dirname(os.path.abspath(__file__))
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join([os.path.dirname(tests_dir), tests_dir])}
+        global_bsz = 4096
+        for num_replicas in [1, 2, 4, 8]:
+            for local in [True, False]:
+                code = (f'import test_losses; '
+                        f'test_losses.local_batch_sims_step_time({num_replicas}, {global_bsz}, {local})')
+                result = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True,
+                                        text=True)
+                logging.info(result.stdout.strip())
+
     def test_distribute_equivalent(self):
         for LossClass in [custom_losses.SimCLR, custom_losses.SupCon, custom_losses.HierCon]:
             strategy = tf.distribute.MirroredStrategy(['CPU:0', 'CPU:1'])
@@ -150,5 +381,30 @@ class LossesTest(unittest.TestCase):
             tf.debugging.assert_near(global_loss, distributed_loss, atol=1e-4, message=f'{LossClass}')
 
 
+def local_batch_sims_step_time(num_replicas, global_bsz, local, num_steps=10):
+    """Prints the step time and peak memory of the local rows or full matrix label similarities on CPU replicas.
+
+    Must run in a fresh process, since the logical CPU devices are set up here.
+    """
+    cpu = tf.config.list_physical_devices('CPU')[0]
+    tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * num_replicas)
+    strategy = tf.distribute.MirroredStrategy([f'CPU:{i}' for i in range(num_replicas)])
+    local_fn, reference_fn, y, x = LossesTest().local_batch_sims_fns(strategy, global_bsz)
+    fn, args = (local_fn, (y, x)) if local else (reference_fn, (y,))
+    rows = global_bsz // num_replicas if local else global_bsz
+
+    # Peak resident memory above the setup, in KB on Linux
+    setup_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn(*args)
+    start = time.time()
+    for _ in range(num_steps):
+        fn(*args)
+    step_ms = 1000 * (time.time() - start) / num_steps
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - setup_peak
+    print(f'{"local rows" if local else "full matrix"}, {num_replicas} replicas, global batch {global_bsz}: '
+          f'{step_ms:.2f} ms/step, {rows * global_bsz / 1e6:.2f} MB of label similarities per replica, '
+          f'{peak / 1e3:.1f} MB peak memory above setup')
+
+
 if __name__ == '__main__':
     unittest.main()
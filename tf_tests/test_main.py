@@ -1,3 +1,4 @@
+import tempfile
 import unittest
 
 import main
@@ -23,6 +24,58 @@ class TestMain(unittest.TestCase):
         args = utils.parser.parse_args(args.split())
         main.run(args)
 
+    def test_progressive_resizing(self):
+        args = '--data-id=mnist --backbone=affine ' \
+               '--bsz=2 --lr=1e-3 --loss=supcon ' \
+               '--epochs=2 --train-steps=1 --val-steps=1 ' \
+               '--res-scales 0.5 --res-epochs 1'
+        args = utils.parser.parse_args(args.split())
+        main.run(args)
+
+    def test_class_balanced(self):
+        args = '--data-id=mnist --backbone=affine ' \
+               '--bsz=8 --lr=1e-3 --loss=supcon ' \
+               '--epochs=1 --train-steps=2 --val-steps=1 ' \
+               f'--class-balanced 4 --pixel-store={tempfile.mkdtemp()}'
+        args = utils.parser.parse_args(args.split())
+        main.run(args)
+
+    def test_device_augment(self):
+        args = '--data-id=mnist --backbone=affine ' \
+               '--bsz=2 --lr=1e-3 --loss=supcon ' \
+               '--epochs=1 --train-steps=1 --val-steps=1 ' \
+               '--device-augment'
+        with self.assertRaises(ValueError):
+            utils.load_augment_configs(utils.parser.parse_args(f'{args} --autoaugment'.split()))
+        args = utils.parser.parse_args(args.split())
+        main.run(args)
+
+    def test_augment_telemetry(self):
+        args = '--data-id=mnist --backbone=affine ' \
+               '--bsz=2 --lr=1e-3 --loss=supcon ' \
+               '--epochs=1 --train-steps=1 --val-steps=1 ' \
+               '--augment-telemetry'
+        with self.assertRaises(ValueError):
+            utils.load_augment_configs(utils.parser.parse_args(args.split()))
+        args = utils.parser.parse_args(f'{args} --autoaugment'.split())
+        main.run(args)
+
+    def test_feature_queue(self):
+        args = '--data-id=mnist --backbone=affine ' \
+               '--bsz=2 --lr=1e-3 --loss=hiercon --feat-norm=l2 --proj-norm=l2 ' \
+               '--epochs=2 --train-steps=2 --val-steps=1 ' \
+               '--queue-size=8 --queue-max-age=4'
+        args = utils.parser.parse_args(args.split())
+        main.run(args)
+
+    def test_tiled_loss(self):
+        args = '--data-id=mnist --backbone=affine ' \
+               '--bsz=4 --lr=1e-3 --loss=supcon --feat-norm=l2 --proj-norm=l2 ' \
+               '--epochs=1 --train-steps=2 --val-steps=1 ' \
+               '--tile-size=3 --queue-size=8'
+        args = utils.parser.parse_args(args.split())
+        main.run(args)
+
     def test_distributed_ce_from_load(self):
         args = '--data-id=mnist --backbone=affine ' \
                '--bsz=2 --lr=1e-3 --loss=ce ' \
@@ -1,3 +1,4 @@
+import json
 import os
 import tempfile
 import unittest
@@ -6,7 +7,8 @@ import matplotlib.pyplot as plt
 import tensorflow as tf
 
 import utils
-from training import lr_schedule, get_lr_scheduler
+from training import lr_schedule, get_lr_scheduler, get_res_phases, save_data_state, load_data_state, \
+    get_optimizer, save_optimizer_state, load_optimizer_state, DATA_ORDER_ARGS, DATA_STATE_NAME
 
 
 class TestTraining(unittest.TestCase):
@@ -62,6 +64,82 @@ class TestTraining(unittest.TestCase):
         model.save(model_path)
         loaded_model = tf.keras.models.load_model(model_path, custom_objects=utils.all_custom_objects)
 
+    def test_res_phases(self):
+        args = '--epochs=90 --res-scales 0.5 0.75 --res-epochs 30 60'
+        args = utils.parser.parse_args(args.split())
+        self.assertEqual(get_res_phases(args), [(0, 30, 0.5), (30, 60, 0.75), (60, 90, None)])
+
+        # Resuming mid phase
+        args.init_epoch = 45
+        self.assertEqual(get_res_phases(args), [(45, 60, 0.75), (60, 90, None)])
+
+        # No progressive resizing
+        args = utils.parser.parse_args('--epochs=90 --init-epoch=10'.split())
+        self.assertEqual(get_res_phases(args), [(10, 90, None)])
+
+    def test_data_state(self):
+        out = tempfile.mkdtemp()
+        args = utils.parser.parse_args('--bsz=32 --data-seed=7'.split())
+        args.out = out
+        save_data_state(args)
+
+        # The seed is restored with the same data order settings
+        args = utils.parser.parse_args('--bsz=32 --load'.split())
+        args.out = out
+        self.assertTrue(load_data_state(args))
+        self.assertEqual(args.data_seed, 7)
+
+        # A new seed starts a new data order
+        args = utils.parser.parse_args('--bsz=32 --data-seed=8 --load'.split())
+        args.out = out
+        self.assertFalse(load_data_state(args))
+
+        # Other data order settings cannot resume the data order
+        args = utils.parser.parse_args('--bsz=64 --load'.split())
+        args.out = out
+        with self.assertRaises(ValueError):
+            load_data_state(args)
+
+    def test_optimizer_state(self):
+        out = tempfile.mkdtemp()
+        for optimizer in ['sgd', 'lamb']:
+            args = utils.parser.parse_args(f'--optimizer={optimizer} --load'.split())
+            args.out = out
+            save_optimizer_state(args)
+
+            # The saved optimizer wins over --optimizer
+            args = utils.parser.parse_args('--optimizer=adam --load'.split())
+            args.out = out
+            self.assertEqual(load_optimizer_state(args), optimizer)
+            self.assertEqual(args.optimizer, optimizer)
+
+        # Recompiled models and runs saved before the optimizer state keep --optimizer
+        args = utils.parser.parse_args('--optimizer=adam --load --recompile'.split())
+        args.out = out
+        self.assertIsNone(load_optimizer_state(args))
+        args = utils.parser.parse_args('--optimizer=adam --load'.split())
+        args.out = tempfile.mkdtemp()
+        self.assertIsNone(load_optimizer_state(args))
+        self.assertEqual(args.optimizer, 'adam')
+
+    def test_old_data_state(self):
+        for name, default in DATA_ORDER_ARGS.items():
+            self.assertEqual(utils.parser.get_default(name), default)
+
+        # Data states saved before an argument existed resume with its default
+        out = tempfile.mkdtemp()
+        with open(os.path.join(out, DATA_STATE_NAME), 'w') as f:
+            json.dump({'data_seed': 7, 'settings': {'bsz': 32, 'cache': None, 'pixel_store': False}}, f)
+        args = utils.parser.parse_args('--bsz=32 --load'.split())
+        args.out = out
+        self.assertTrue(load_data_state(args))
+        self.assertEqual(args.data_seed, 7)
+
+        args = utils.parser.parse_args('--bsz=32 --shuffle-mb=64 --load'.split())
+        args.out = out
+        with self.assertRaises(ValueError):
+            load_data_state(args)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,21 +1,46 @@
+import json
 import os
+import random
+import time
 
 import tensorflow as tf
-import tensorflow_addons as tfa
 from absl import logging
 from tensorflow.keras import callbacks, optimizers
 
 from training import custom_losses, lr_schedule
 
+DATA_STATE_NAME = 'data-state.json'
+OPTIMIZER_STATE_NAME = 'optimizer.json'
 
-def train(args, model, ds_train, ds_val):
+# Arguments that change the data order of a seed, with their command line defaults. A resumed run only replays the
+# data order if they are unchanged. Data states saved before an argument existed were read with its default
+DATA_ORDER_ARGS = {'bsz': None, 'shuffle_mb': 1024, 'read_cycle_length': 16, 'cache': None, 'shrink_decoded': False,
+                   'class_balanced': None, 'view_bank': None}
+
+
+def train(args, model, make_ds_train, ds_val, augment_telemetry=None):
+    """Trains the model on the datasets of `make_ds_train(res_scale, start_epoch)`.
+
+    With progressive resizing, every resolution phase gets its own training dataset. The model, optimizer and
+    callbacks carry over between phases.
+    """
     # Callbacks
-    cbks = get_callbacks(args)
+    contrast_loss = model.loss.get('contrast') if isinstance(model.loss, dict) else None
+    cbks = get_callbacks(args, augment_telemetry, contrast_loss)
+
+    # Save the data order and optimizer along with the model checkpoints
+    if not args.no_save:
+        save_data_state(args)
+        save_optimizer_state(args)
 
     try:
-        model.fit(ds_train, initial_epoch=args.init_epoch, epochs=args.epochs,
-                  validation_data=ds_val, validation_steps=args.val_steps, steps_per_epoch=args.train_steps,
-                  callbacks=cbks)
+        for start_epoch, end_epoch, res_scale in get_res_phases(args):
+            if res_scale is not None:
+                logging.info(f'training at {res_scale:.2f} resolution from epoch {start_epoch} to {end_epoch}')
+            ds_train = make_ds_train(res_scale, start_epoch)
+            model.fit(ds_train, initial_epoch=start_epoch, epochs=end_epoch,
+                      validation_data=ds_val, validation_steps=args.val_steps, steps_per_epoch=args.train_steps,
+                      callbacks=cbks)
     except KeyboardInterrupt:
         logging.info('keyboard interrupt caught. ending training early')
 
@@ -24,10 +49,96 @@ def train(args, model, ds_train, ds_val):
         model.save(os.path.join(args.out, 'model'))
 
 
-def get_callbacks(args):
+def get_res_phases(args):
+    """Returns the `(start epoch, end epoch, resolution scale)` phases of training from `args.init_epoch` on.
+
+    The scale is None for the full resolution.
+    """
+    res_scales, res_epochs = args.res_scales or [], args.res_epochs or []
+    if len(res_scales) != len(res_epochs):
+        raise ValueError(f'--res-scales {res_scales} and --res-epochs {res_epochs} must have the same length')
+
+    bounds = [0] + res_epochs + [args.epochs]
+    phases = []
+    for start_epoch, end_epoch, res_scale in zip(bounds[:-1], bounds[1:], res_scales + [None]):
+        start_epoch = max(start_epoch, args.init_epoch)
+        if start_epoch < end_epoch:
+            phases.append((start_epoch, end_epoch, res_scale))
+
+    # Always call fit at least once
+    return phases or [(args.init_epoch, args.epochs, None)]
+
+
+def data_order_settings(args):
+    settings = {name: getattr(args, name) for name in DATA_ORDER_ARGS}
+    settings['pixel_store'] = args.pixel_store is not None
+    return settings
+
+
+def save_data_state(args):
+    with tf.io.gfile.GFile(os.path.join(args.out, DATA_STATE_NAME), 'w') as f:
+        json.dump({'data_seed': args.data_seed, 'settings': data_order_settings(args)}, f)
+
+
+def load_data_state(args):
+    """Sets `args.data_seed`, restoring it from the previous run on `--load`.
+
+    Resuming with other data order settings than the previous run would duplicate or skip examples, so it is an
+    error. Returns whether the data order of the previous run can be replayed.
+    """
+    path = os.path.join(args.out, DATA_STATE_NAME)
+    restored = False
+    if args.load and tf.io.gfile.exists(path):
+        with tf.io.gfile.GFile(path) as f:
+            state = json.load(f)
+        previous = {**DATA_ORDER_ARGS, 'pixel_store': False, **state.get('settings', {})}
+        changed = {name: (previous[name], value) for name, value in data_order_settings(args).items()
+                   if previous[name] != value}
+        if changed:
+            raise ValueError(f'data order settings changed since the previous run (previous, now): {changed}. '
+                             f'resume with the previous settings')
+        if args.data_seed is None:
+            args.data_seed = state['data_seed']
+            logging.info(f'restored data seed {args.data_seed}')
+        restored = args.data_seed == state['data_seed']
+    elif args.load:
+        restored = args.data_seed is not None
+    if args.data_seed is None:
+        args.data_seed = random.randrange(2 ** 31)
+        logging.info(f'data seed {args.data_seed}')
+    return restored
+
+
+def get_resume_step(args, model, restored):
+    """Number of global training batches the loaded model has already been trained on."""
+    if not args.load:
+        return 0
+    if not restored:
+        logging.warning('no data state to restore. the data order will restart from scratch')
+        return 0
+
+    if args.recompile:
+        step = args.init_epoch * args.train_steps
+    else:
+        step = int(model.optimizer.iterations.numpy())
+    logging.info(f'resuming the training data at step {step}')
+    return step
+
+
+def get_callbacks(args, augment_telemetry=None, contrast_loss=None):
     cbks = [callbacks.TensorBoard(os.path.join(args.out, 'logs'), update_freq=args.update_freq, write_graph=False,
                                   profile_batch=args.profile_batch)]
 
+    # Export the augmentation telemetry?
+    if augment_telemetry is not None:
+        # Imported here so that the losses do not depend on the input pipeline
+        from data import telemetry
+        cbks.append(telemetry.TelemetryCallback(augment_telemetry, os.path.join(args.out, 'logs')))
+
+    # Keep the validation features out of the feature queue
+    if getattr(contrast_loss, 'queue_size', 0) > 0:
+        cbks.append(custom_losses.FeatureQueueCallback(contrast_loss))
+
     # Save work?
     if not args.no_save:
         cbks.append(callbacks.ModelCheckpoint(os.path.join(args.out, 'model'), verbose=1,
@@ -52,27 +163,64 @@ def compile_model(args, model):
     metrics = {'label': [acc_metric, ce_metric]}
 
     contrast_loss_dict = {
-        'supcon': custom_losses.SupCon(args.temp),
-        'hiercon': custom_losses.HierCon(args.temp),
-        'hiercon2': custom_losses.HierCon2(args.temp),
-        'simclr': custom_losses.SimCLR(args.temp),
-        'no-op': custom_losses.NoOp()
+        'supcon': custom_losses.SupCon,
+        'hiercon': custom_losses.HierCon,
+        'hiercon2': custom_losses.HierCon2,
+        'simclr': custom_losses.SimCLR,
     }
     if args.loss in contrast_loss_dict:
-        losses['contrast'] = contrast_loss_dict[args.loss]
-        if args.feat_norm is None:
-            logging.warning('optimizing over contrastive loss without any feature normalization')
+        # The feature queue holds projected features
+        feat_dim = model.get_layer('contrast').output_shape[-1] if args.queue_size else None
+        losses['contrast'] = contrast_loss_dict[args.loss](args.temp, args.fused_loss, args.queue_size,
+                                                           args.queue_max_age, feat_dim, args.tile_size)
+    elif args.loss == 'no-op':
+        if args.tile_size > 0:
+            raise ValueError('the no-op loss has no similarities to tile')
+        losses['contrast'] = custom_losses.NoOp()
+    if 'contrast' in losses and args.feat_norm is None:
+        logging.warning('optimizing over contrastive loss without any feature normalization')
 
     # Compile
     model.compile(opt, losses, metrics, steps_per_execution=args.steps_exec)
 
 
+def import_addons():
+    """Imports tensorflow_addons, which takes seconds, only when it is needed."""
+    start = time.time()
+    import tensorflow_addons as tfa
+    logging.info(f'imported tensorflow_addons in {time.time() - start:.2f}s')
+    return tfa
+
+
+def save_optimizer_state(args):
+    with tf.io.gfile.GFile(os.path.join(args.out, OPTIMIZER_STATE_NAME), 'w') as f:
+        json.dump({'optimizer': args.optimizer}, f)
+
+
+def load_optimizer_state(args):
+    """Sets `args.optimizer` to the optimizer the saved model was compiled with, unless it is recompiled.
+
+    Returns the optimizer name, or None if the previous run did not save it, in which case `--optimizer` has to match
+    the saved model.
+    """
+    path = os.path.join(args.out, OPTIMIZER_STATE_NAME)
+    if not args.load or args.recompile or not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path) as f:
+        optimizer = json.load(f)['optimizer']
+    if optimizer != args.optimizer:
+        logging.info(f'the saved model was compiled with {optimizer}, not --optimizer {args.optimizer}')
+        args.optimizer = optimizer
+    return optimizer
+
+
 def get_optimizer(args, lr_scheduler):
     if args.optimizer == 'sgd':
         opt = optimizers.SGD(lr_scheduler, momentum=0.9, nesterov=True)
     elif args.optimizer == 'adam':
         opt = optimizers.Adam(lr_scheduler)
     elif args.optimizer == 'lamb':
+        tfa = import_addons()
         opt = tfa.optimizers.LAMB(lr_scheduler, weight_decay_rate=args.weight_decay)
     else:
         raise Exception(f'unknown optimizer {args.optimizer}')
@@ -1,30 +1,201 @@
 import tensorflow as tf
 from tensorflow import nn
-from tensorflow.keras import losses
+from tensorflow.keras import callbacks, losses
+
+from ops import checks
+
+
+# Groups of the label similarities, i.e. the values of y_true
+NUM_GROUPS = 3
+
+# Similarity of empty and stale queue slots, which vanishes in any softmax
+INVALID_SIM = -1e9
+
+# Column tile size of the fused losses, which are tiled unless `tile_size` is set
+FUSED_TILE_SIZE = 1024
+
+
+def tiled_group_sums(y_true, feats1, col_labels, col_feats, col_valid, inst_cols, temp, tile_size):
+    """Per row sums of `exp`, sums and counts of the scaled similarities of `feats1` in every group, in column tiles.
+
+    Column j of row i is in group `(y_true[i] == col_labels[j]) + (inst_cols[i] == j)`, and invalid columns are in no
+    group. Only [N, tile_size] blocks of the similarities are ever materialized: the forward pass keeps a running row
+    max and rescales the running sums of exp, and the backward pass recomputes the blocks. Returns the sums of exp
+    relative to the row max, the sums of the similarities and the counts, all of shape [N, NUM_GROUPS], and the row
+    max of shape [N].
+    """
+    num_rows, num_cols = tf.shape(feats1)[0], tf.shape(col_feats)[0]
+    num_tiles = (num_cols + tile_size - 1) // tile_size
+    y_true = tf.cast(tf.reshape(y_true, [-1, 1]), tf.int64)
+    col_labels, inst_cols = tf.cast(col_labels, tf.int64), tf.cast(inst_cols, tf.int32)
+    lowest = feats1.dtype.min
+
+    def tile(feats1, col_feats, i):
+        """Scaled similarities, groups (-1 for invalid columns) and validity mask of column tile `i`."""
+        start = i * tile_size
+        tile_feats = col_feats[start:start + tile_size]
+        cols = start + tf.range(tf.shape(tile_feats)[0])
+        valid = col_valid[start:start + tile_size][None]
+        sims = tf.matmul(feats1, tile_feats, transpose_b=True) / temp
+        sims = tf.where(valid, sims, lowest)
+        groups = (tf.cast(y_true == col_labels[start:start + tile_size][None], tf.int32)
+                  + tf.cast(inst_cols[:, None] == cols[None], tf.int32))
+        groups = tf.where(valid, groups, -1)
+        return tile_feats, sims, groups, valid
+
+    @tf.custom_gradient
+    def forward(feats1, col_feats):
+        def body(i, row_max, sum_exp, sum_sims, counts):
+            _, sims, groups, _ = tile(feats1, col_feats, i)
+            new_max = tf.maximum(row_max, tf.reduce_max(sims, axis=1))
+            sum_exp *= tf.math.exp(row_max - new_max)[:, None]
+
+            # Reduce every element into the segment of its row and group. Negative ids are dropped
+            segment_ids = tf.where(groups >= 0, groups + NUM_GROUPS * tf.range(num_rows)[:, None], -1)
+            values = tf.stack([tf.math.exp(sims - new_max[:, None]), sims, tf.ones_like(sims)], axis=-1)
+            sums = tf.math.unsorted_segment_sum(values, segment_ids, num_rows * NUM_GROUPS)
+            sums = tf.reshape(sums, [num_rows, NUM_GROUPS, 3])
+            return i + 1, new_max, sum_exp + sums[..., 0], sum_sims + sums[..., 1], counts + sums[..., 2]
+
+        # One tile at a time. Tiles in flight in parallel would each hold their [N, tile_size] temporaries
+        zeros = tf.zeros([num_rows, NUM_GROUPS], feats1.dtype)
+        _, row_max, sum_exp, sum_sims, counts = tf.while_loop(
+            lambda i, *_: i < num_tiles, body, [0, tf.fill([num_rows], lowest), zeros, zeros, zeros],
+            parallel_iterations=1)
+
+        def grad(d_sum_exp, d_sum_sims, d_counts, d_row_max):
+            # The row max and counts are constants of the losses
+            d_sum_exp = tf.zeros_like(sum_exp) if d_sum_exp is None else d_sum_exp
+            d_sum_sims = tf.zeros_like(sum_sims) if d_sum_sims is None else d_sum_sims
+
+            def body(i, d_feats1, d_col_feats):
+                tile_feats, sims, groups, valid = tile(feats1, col_feats, i)
+                groups = tf.maximum(groups, 0)
+                d_sims = (tf.gather(d_sum_exp, groups, batch_dims=1) * tf.math.exp(sims - row_max[:, None])
+                          + tf.gather(d_sum_sims, groups, batch_dims=1))
+                d_sims = tf.where(valid, d_sims, tf.zeros_like(d_sims)) / temp
+                d_feats1 += tf.matmul(d_sims, tile_feats)
+                d_col_feats = d_col_feats.write(i, tf.matmul(d_sims, feats1, transpose_a=True))
+                return i + 1, d_feats1, d_col_feats
+
+            d_col_feats = tf.TensorArray(feats1.dtype, size=num_tiles, infer_shape=False,
+                                         element_shape=tf.TensorShape([None, feats1.shape[-1]]))
+            _, d_feats1, d_col_feats = tf.while_loop(lambda i, *_: i < num_tiles, body,
+                                                     [0, tf.zeros_like(feats1), d_col_feats], parallel_iterations=1)
+            return d_feats1, d_col_feats.concat()
+
+        return (sum_exp, sum_sims, counts, row_max), grad
+
+    return forward(feats1, col_feats)
+
+
+def partial_loss(log_sum_exp, sum_sims, counts):
+    """Mean negative log prob of a group of positives, i.e. the masked mean of `log_sum_exp - sims`."""
+    return tf.math.divide_no_nan(counts * log_sum_exp - sum_sims, counts)
 
 
 class ConLoss(losses.Loss):
-    def __init__(self, temp, **kwargs):
+    # Whether `fused` has a single pass implementation in the subclass
+    has_fused = False
+    # Whether the subclass has a `group_loss(sum_exp, sum_sims, counts)`, the per row loss from the `tiled_sums` of
+    # the similarities relative to the row max. Tiling needs it
+    has_group_loss = False
+
+    def __init__(self, temp, fused=False, queue_size=0, queue_max_age=None, feat_dim=None, tile_size=0, **kwargs):
         super().__init__(**kwargs)
         self.temp = temp
 
+        # Compute the hierarchical losses from the single pass `tiled_sums` instead of float masks? The similarity
+        # matrix is then streamed in tiles of `tile_size`, or else `FUSED_TILE_SIZE`
+        self.fused = fused
+        if fused and not self.has_fused:
+            raise ValueError(f'{type(self).__name__} has no fused implementation')
+
+        # FIFO of the projected second views and labels of recent global batches, scored as extra columns. Every
+        # replica enqueues the same all-gathered batches, so every replica keeps its own identical copy
+        self.queue_size = queue_size
+        self.queue_max_age = queue_max_age
+        self.feat_dim = feat_dim
+        if queue_size > 0:
+            if feat_dim is None:
+                raise ValueError('the feature queue needs the feature dimension')
+            local_var = lambda initial_value: tf.Variable(initial_value, trainable=False,
+                                                          synchronization=tf.VariableSynchronization.ON_READ,
+                                                          aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+            self.queue_feats = local_var(tf.zeros([queue_size, feat_dim]))
+            self.queue_labels = local_var(tf.zeros([queue_size], tf.int64))
+            # Step at which every slot was enqueued. -1 for empty slots
+            self.queue_steps = local_var(tf.fill([queue_size], tf.constant(-1, tf.int64)))
+            self.queue_pointer = local_var(tf.constant(0, tf.int64))
+            self.queue_step = local_var(tf.constant(0, tf.int64))
+
+            # Only training batches are enqueued. Toggled by `FeatureQueueCallback`
+            self.enqueue_enabled = tf.Variable(True, trainable=False)
+
+        # Stream the similarities in column tiles of this size instead of materializing them? (see `tiled_sums`)
+        self.tile_size = tile_size
+        if tile_size > 0 and not self.has_group_loss:
+            raise ValueError(f'{type(self).__name__} has no group loss to compute from tiles')
+
     def get_config(self):
-        return {"temp": self.temp}
+        return {"temp": self.temp, "fused": self.fused, "queue_size": self.queue_size,
+                "queue_max_age": self.queue_max_age, "feat_dim": self.feat_dim, "tile_size": self.tile_size}
+
+    def __call__(self, y_true, y_pred, sample_weight=None):
+        # The sampled checks of a call run or are skipped together
+        with checks.call_scope():
+            return super().__call__(y_true, y_pred, sample_weight)
+
+    def queue_valid(self):
+        """Mask of the filled queue slots that are at most `queue_max_age` steps old."""
+        valid = self.queue_steps >= 0
+        if self.queue_max_age is not None:
+            valid &= (self.queue_step - self.queue_steps) <= self.queue_max_age
+        return valid
+
+    def score_queue(self, y_true, feats1, batch_sims, sims):
+        """Appends the label similarities and predicted similarities of the queue to those of the batch."""
+        valid = self.queue_valid()[None]
+        queue_sims = tf.matmul(feats1, tf.cast(self.queue_feats, feats1.dtype), transpose_b=True)
+        queue_sims = tf.where(valid, queue_sims, tf.cast(INVALID_SIM, queue_sims.dtype))
+        queue_batch_sims = tf.cast((tf.cast(y_true, tf.int64) == self.queue_labels[None]) & valid, tf.uint8)
+        return tf.concat([batch_sims, queue_batch_sims], axis=1), tf.concat([sims, queue_sims], axis=1)
+
+    def enqueue(self, labels, feats):
+        """Replaces the oldest queue slots with the last `queue_size` of `labels` and `feats`."""
+        labels = tf.reshape(tf.cast(labels, tf.int64), [-1])[-self.queue_size:]
+        feats = tf.cast(tf.stop_gradient(feats), tf.float32)[-self.queue_size:]
+        num_new = tf.shape(labels, out_type=tf.int64)[0]
+        indices = ((self.queue_pointer + tf.range(num_new)) % self.queue_size)[:, None]
+
+        def enqueue_fn():
+            updates = [
+                self.queue_feats.assign(tf.tensor_scatter_nd_update(self.queue_feats, indices, feats)),
+                self.queue_labels.assign(tf.tensor_scatter_nd_update(self.queue_labels, indices, labels)),
+                self.queue_steps.assign(tf.tensor_scatter_nd_update(self.queue_steps, indices,
+                                                                    tf.fill([num_new], self.queue_step.read_value()))),
+            ]
+            with tf.control_dependencies(updates):
+                self.queue_pointer.assign((self.queue_pointer + num_new) % self.queue_size)
+                self.queue_step.assign_add(1)
+            return tf.constant(True)
+
+        return tf.cond(self.enqueue_enabled, enqueue_fn, lambda: tf.constant(False))
 
     def process_y(self, y_true, y_pred):
-        tf.debugging.assert_shapes([(y_true, (None, 1))])
+        checks.check(tf.debugging.assert_shapes, [(y_true, (None, 1))])
         replica_context = tf.distribute.get_replica_context()
         replica_id = replica_context.replica_id_in_sync_group
-        num_replicas = replica_context.num_replicas_in_sync
 
-        # Feat views
+        # Label similarities of only the local rows against the global batch. The instance pairs are on the
+        # diagonal of the global batch, i.e. at column replica_id * local_bsz + i of local row i
         all_labels = replica_context.all_gather(y_true, axis=0)
         local_bsz, global_bsz = tf.shape(y_true)[0], tf.shape(all_labels)[0]
-        batch_sims = tf.cast(all_labels == tf.transpose(all_labels), tf.uint8)
-        batch_sims += tf.eye(global_bsz, dtype=tf.uint8)
-        batch_sims = tf.reshape(batch_sims, [num_replicas, local_bsz, global_bsz])
-        batch_sims = batch_sims[replica_id]
+        batch_sims = tf.cast(y_true == tf.transpose(all_labels), tf.uint8)
+        inst_cols = tf.cast(replica_id, tf.int32) * local_bsz + tf.range(local_bsz)
+        batch_sims += tf.one_hot(inst_cols, global_bsz, dtype=tf.uint8)
 
+        # Feat views
         all_y_pred = replica_context.all_gather(y_pred, axis=0)
         local_feat_views = tf.transpose(y_pred, [1, 0, 2])
         global_feat_views = tf.transpose(all_y_pred, [1, 0, 2])
@@ -33,15 +204,67 @@ class ConLoss(losses.Loss):
         feats1, all_feats2 = local_feat_views[0], global_feat_views[1]
         sims = tf.matmul(feats1, all_feats2, transpose_b=True)
 
+        # Score against the queue too, then push the global batch into it
+        if self.queue_size > 0:
+            batch_sims, sims = self.score_queue(y_true, feats1, batch_sims, sims)
+            with tf.control_dependencies([batch_sims, sims]):
+                enqueued = self.enqueue(all_labels, all_feats2)
+            with tf.control_dependencies([enqueued]):
+                batch_sims, sims = tf.identity(batch_sims), tf.identity(sims)
+
         # Assert equal shapes
-        tf.debugging.assert_shapes([
+        checks.check(tf.debugging.assert_shapes, [
             (batch_sims, ['N', 'D']),
             (sims, ['N', 'D']),
         ])
 
         return batch_sims, sims
 
+    def tiled_sums(self, y_true, y_pred):
+        """`tiled_group_sums` of the local rows against the global batch and queue, without the full similarity
+        matrix.
+
+        Peak memory grows linearly with the global batch size for a fixed tile size.
+        """
+        checks.check(tf.debugging.assert_shapes, [(y_true, (None, 1))])
+        replica_context = tf.distribute.get_replica_context()
+        replica_id = replica_context.replica_id_in_sync_group
+
+        # The instance pairs are at column replica_id * local_bsz + i of local row i
+        all_labels = tf.reshape(replica_context.all_gather(y_true, axis=0), [-1])
+        all_y_pred = replica_context.all_gather(y_pred, axis=0)
+        local_bsz = tf.shape(y_true)[0]
+        inst_cols = tf.cast(replica_id, tf.int32) * local_bsz + tf.range(local_bsz)
+
+        # The queue is appended as extra columns without gradient, whose empty and stale slots are invalid
+        feats1, all_feats2 = tf.cast(y_pred[:, 0], tf.float32), tf.cast(all_y_pred[:, 1], tf.float32)
+        col_labels, col_feats = tf.cast(all_labels, tf.int64), all_feats2
+        col_valid = tf.ones([tf.shape(all_labels)[0]], tf.bool)
+        if self.queue_size > 0:
+            col_labels = tf.concat([col_labels, self.queue_labels.read_value()], axis=0)
+            col_feats = tf.concat([col_feats, tf.stop_gradient(self.queue_feats.read_value())], axis=0)
+            col_valid = tf.concat([col_valid, self.queue_valid()], axis=0)
+
+        sum_exp, sum_sims, counts, row_max = tiled_group_sums(y_true, feats1, col_labels, col_feats, col_valid,
+                                                              inst_cols, self.temp, self.tile_size or FUSED_TILE_SIZE)
+
+        # Push the global batch into the queue after it was scored
+        if self.queue_size > 0:
+            with tf.control_dependencies([sum_exp, sum_sims]):
+                enqueued = self.enqueue(all_labels, all_feats2)
+            with tf.control_dependencies([enqueued]):
+                sum_exp, sum_sims = tf.identity(sum_exp), tf.identity(sum_sims)
+
+        # Exactly one instance pair per row
+        checks.check(tf.debugging.assert_equal, counts[:, 2], tf.constant(1, counts.dtype))
+
+        # Sums of the similarities relative to the row max
+        sum_sims -= counts * tf.stop_gradient(row_max)[:, None]
+        dtype = y_pred.dtype
+        return tf.cast(sum_exp, dtype), tf.cast(sum_sims, dtype), tf.cast(counts, dtype)
+
     def assert_inputs(self, y_true, y_pred):
+        """Validates the label similarities. Run through `checks.check`."""
         inst_mask = tf.cast((y_true == 2), tf.uint8)
         n_inst = tf.reduce_sum(inst_mask, axis=1)
         tf.debugging.assert_equal(n_inst, tf.ones_like(n_inst))
@@ -61,10 +284,17 @@ class NoOp(losses.Loss):
 
 
 class SimCLR(ConLoss):
+    has_group_loss = True
+
+    def group_loss(self, sum_exp, sum_sims, counts):
+        return partial_loss(tf.math.log(tf.reduce_sum(sum_exp, axis=1)), sum_sims[:, 2], counts[:, 2])
 
     def call(self, y_true, y_pred):
+        if self.tile_size > 0:
+            return self.group_loss(*self.tiled_sums(y_true, y_pred))
+
         y_true, y_pred = self.process_y(y_true, y_pred)
-        self.assert_inputs(y_true, y_pred)
+        checks.check(self.assert_inputs, y_true, y_pred)
         dtype = y_pred.dtype
 
         # Masks
@@ -77,10 +307,18 @@ class SimCLR(ConLoss):
 
 
 class SupCon(ConLoss):
+    has_group_loss = True
+
+    def group_loss(self, sum_exp, sum_sims, counts):
+        lse = tf.math.log(tf.reduce_sum(sum_exp, axis=1))
+        return partial_loss(lse, sum_sims[:, 1] + sum_sims[:, 2], counts[:, 1] + counts[:, 2])
 
     def call(self, y_true, y_pred):
+        if self.tile_size > 0:
+            return self.group_loss(*self.tiled_sums(y_true, y_pred))
+
         y_true, y_pred = self.process_y(y_true, y_pred)
-        self.assert_inputs(y_true, y_pred)
+        checks.check(self.assert_inputs, y_true, y_pred)
         dtype = y_pred.dtype
 
         # Masks
@@ -94,10 +332,22 @@ class SupCon(ConLoss):
 
 
 class HierCon(ConLoss):
+    has_fused = True
+    has_group_loss = True
+
+    def group_loss(self, sum_exp, sum_sims, counts):
+        non_inst_lse = tf.math.log(sum_exp[:, 0] + sum_exp[:, 1] + 1e-5)
+        non_neg_lse = tf.math.log(sum_exp[:, 1] + sum_exp[:, 2] + 1e-5)
+        class_partial_loss = partial_loss(non_inst_lse, sum_sims[:, 1], counts[:, 1])
+        inst_partial_loss = partial_loss(non_neg_lse, sum_sims[:, 2], counts[:, 2])
+        return class_partial_loss + inst_partial_loss
 
     def call(self, y_true, y_pred):
+        if self.fused or self.tile_size > 0:
+            return self.group_loss(*self.tiled_sums(y_true, y_pred))
+
         y_true, y_pred = self.process_y(y_true, y_pred)
-        self.assert_inputs(y_true, y_pred)
+        checks.check(self.assert_inputs, y_true, y_pred)
         dtype = y_pred.dtype
 
         # Similarities
@@ -123,14 +373,14 @@ class HierCon(ConLoss):
 
         # Class partial positive pairs log prob
         class_partial_log_prob = proper_class_mask * non_inst_log_prob
-        tf.debugging.assert_less_equal(class_partial_log_prob, tf.zeros_like(class_partial_log_prob))
+        checks.check(tf.debugging.assert_non_positive, class_partial_log_prob)
         class_partial_log_prob = tf.math.reduce_sum(class_partial_log_prob, axis=1)
         class_partial_log_prob = tf.math.divide_no_nan(class_partial_log_prob, proper_class_sum)
         class_partial_loss = -class_partial_log_prob
 
         # Instance partial positive pairs log prob
         inst_partial_log_prob = inst_mask * non_neg_log_prob
-        tf.debugging.assert_less_equal(inst_partial_log_prob, tf.zeros_like(inst_partial_log_prob))
+        checks.check(tf.debugging.assert_non_positive, inst_partial_log_prob)
         inst_partial_log_prob = tf.math.reduce_sum(inst_partial_log_prob, axis=1)
         inst_partial_log_prob = tf.math.divide_no_nan(inst_partial_log_prob, inst_sum)
         inst_partial_loss = -inst_partial_log_prob
@@ -140,10 +390,22 @@ class HierCon(ConLoss):
 
 
 class HierCon2(ConLoss):
+    has_fused = True
+    has_group_loss = True
+
+    def group_loss(self, sum_exp, sum_sims, counts):
+        non_inst_lse = tf.math.log(sum_exp[:, 0] + sum_exp[:, 1] + 1e-5)
+        lse = tf.math.log(tf.reduce_sum(sum_exp, axis=1) + 1e-5)
+        class_partial_loss = partial_loss(non_inst_lse, sum_sims[:, 1], counts[:, 1])
+        inst_loss = partial_loss(lse, sum_sims[:, 2], counts[:, 2])
+        return class_partial_loss + inst_loss
 
     def call(self, y_true, y_pred):
+        if self.fused or self.tile_size > 0:
+            return self.group_loss(*self.tiled_sums(y_true, y_pred))
+
         y_true, y_pred = self.process_y(y_true, y_pred)
-        self.assert_inputs(y_true, y_pred)
+        checks.check(self.assert_inputs, y_true, y_pred)
         dtype = y_pred.dtype
 
         # Similarities
@@ -169,14 +431,14 @@ class HierCon2(ConLoss):
 
         # Class partial positive pairs log prob
         class_partial_log_prob = proper_class_mask * non_inst_log_prob
-        tf.debugging.assert_less_equal(class_partial_log_prob, tf.zeros_like(class_partial_log_prob))
+        checks.check(tf.debugging.assert_non_positive, class_partial_log_prob)
         class_partial_log_prob = tf.math.reduce_sum(class_partial_log_prob, axis=1)
         class_partial_log_prob = tf.math.divide_no_nan(class_partial_log_prob, proper_class_sum)
         class_partial_loss = -class_partial_log_prob
 
         # Instance positive pairs log prob
         inst_log_prob = inst_mask * log_prob
-        tf.debugging.assert_less_equal(inst_log_prob, tf.zeros_like(inst_log_prob))
+        checks.check(tf.debugging.assert_non_positive, inst_log_prob)
         inst_log_prob = tf.math.reduce_sum(inst_log_prob, axis=1)
         inst_log_prob = tf.math.divide_no_nan(inst_log_prob, inst_sum)
         inst_loss = -inst_log_prob
@@ -185,6 +447,20 @@ class HierCon2(ConLoss):
         return loss
 
 
+class FeatureQueueCallback(callbacks.Callback):
+    """Keeps the validation batches out of the feature queue of `loss`."""
+
+    def __init__(self, loss):
+        super().__init__()
+        self.loss = loss
+
+    def on_test_begin(self, logs=None):
+        self.loss.enqueue_enabled.assign(False)
+
+    def on_test_end(self, logs=None):
+        self.loss.enqueue_enabled.assign(True)
+
+
 custom_objects = {
     'NoOp': NoOp,
     'SimCLR': SimCLR,
@@ -1,22 +1,71 @@
 import argparse
 import os
 import shutil
+import tempfile
+import time
 
 import tensorflow as tf
 from absl import logging
 from tensorflow.keras import mixed_precision
 
-from data import augmentations
+from data import augmentations, telemetry, val_cache, xla_augmentations, CACHE_TIERS, DATA_IDS, SHUFFLE_MB, \
+    READ_CYCLE_LENGTH
 from models import custom_layers
+from ops import checks
 from training import custom_losses, lr_schedule
 
 parser = argparse.ArgumentParser()
 
 # Data
-parser.add_argument('--data-id', choices=['imagenet2012', 'tf_flowers', 'cifar10', 'cifar100', 'mnist'])
+parser.add_argument('--data-id', choices=DATA_IDS)
+parser.add_argument('--data-dir', type=str, default='gs://aigagror/datasets', help='TFDS data root')
+parser.add_argument('--local-data-dir', type=str, help='local TFDS data root (e.g. on tmpfs) to cache the shards in')
 parser.add_argument('--autoaugment', action='store_true')
-parser.add_argument('--cache', action='store_true')
+parser.add_argument('--fuse-geometric', action='store_true',
+                    help='resample runs of consecutive geometric autoaugment ops once instead of after every op')
+parser.add_argument('--xla-augment', action='store_true',
+                    help='autoaugment with the static shape ops, compiled with XLA for the fixed image size')
+parser.add_argument('--augment-telemetry', type=float, nargs='?', const=telemetry.SAMPLE_RATE, metavar='RATE',
+                    help='count the autoaugment ops and time a RATE fraction of them. '
+                         "exported to the run's logs every epoch")
+parser.add_argument('--batch-augment', action='store_true', help='augment whole batches instead of single images')
+parser.add_argument('--device-augment', action='store_true',
+                    help='crop, flip and color augment inside the model. the host only decodes and center crops')
+parser.add_argument('--cache', nargs='?', const='encoded', choices=CACHE_TIERS,
+                    help="cache tier. '--cache' alone caches the encoded bytes in memory")
+parser.add_argument('--shrink-decoded', action='store_true',
+                    help='shrink JPEGs in the decoded cache tiers to a shorter side of imsize + 32. smaller caches, '
+                         'but small random crops are upsampled from fewer pixels')
+parser.add_argument('--cache-dir', type=str, default=os.path.join(tempfile.gettempdir(), 'hiercon-cache'),
+                    help="local directory of the 'decoded-disk' and 'snapshot' cache tiers")
+parser.add_argument('--decode-once', action='store_true', help='decode each image once and crop all views from it')
+parser.add_argument('--pixel-store', type=str, help='directory of the memory-mapped pixel store (mnist and cifar only)')
+parser.add_argument('--data-service', type=str,
+                    help="'host:port' of a tf.data service dispatcher to preprocess on. "
+                         "with --data-service-workers and no address, a local dispatcher is started. "
+                         "its data order is random and not replayed on --load")
+parser.add_argument('--data-service-workers', type=int, help='number of local tf.data service worker processes')
+parser.add_argument('--data-service-worker-address', type=str,
+                    help='host name or IP of this host that the trainer reaches the local workers at. defaults to '
+                         "'localhost' for a local dispatcher and to the host name otherwise")
+parser.add_argument('--shuffle-mb', type=float, default=SHUFFLE_MB,
+                    help='memory budget of the shuffle buffer of every input pipeline in megabytes')
+parser.add_argument('--read-cycle-length', type=int, default=READ_CYCLE_LENGTH,
+                    help='number of shard files read in parallel by every input pipeline')
+parser.add_argument('--val-cache', choices=val_cache.MODES,
+                    help='augment the validation set once and keep it in memory or on disk')
+parser.add_argument('--val-seed', type=int, default=0, help='seed of the materialized validation set')
+parser.add_argument('--class-balanced', type=int, metavar='K',
+                    help='train on batches of bsz / K distinct classes with K examples each. '
+                         'only the --pixel-store reader supports it')
+parser.add_argument('--view-bank', type=int, metavar='K',
+                    help='augment every training image K times once and sample views from them')
+parser.add_argument('--view-bank-seed', type=int, default=0,
+                    help='seed of the view bank augmentations. banks are reused across runs with the same seed')
 parser.add_argument('--no-shuffle', action='store_false', dest='shuffle', default=True)
+parser.add_argument('--data-seed', type=int,
+                    help='seed of the data order. restored from the previous run on --load, which replays the current '
+                         'data epoch and so reads and discards up to one epoch of examples per input pipeline')
 
 # Model
 parser.add_argument('--backbone', choices=['small-resnet50v2', 'resnet50v2', 'resnet50', 'affine'])
@@ -28,6 +77,14 @@ parser.add_argument('--stop-gradient', action='store_true')
 # Loss objective
 parser.add_argument('--loss', choices=['ce', 'supcon', 'hiercon', 'hiercon2', 'simclr', 'no-op'], default='ce')
 parser.add_argument('--temp', type=float, default=0.1)
+parser.add_argument('--queue-size', type=int, default=0,
+                    help='number of recent projected features and labels the contrastive losses also score against')
+parser.add_argument('--queue-max-age', type=int, help='only score queued features of at most this many steps ago')
+parser.add_argument('--fused-loss', action='store_true',
+                    help='compute the hiercon losses in a single pass over column tiles of the similarities '
+                         '(1024 columns unless --tile-size) without float masks. only for hiercon and hiercon2')
+parser.add_argument('--tile-size', type=int, default=0,
+                    help='stream the contrastive similarities in column tiles of this size. 0 materializes them')
 parser.add_argument('--weight-decay', type=float, default=1e-4)
 
 # Training hyperparameters
@@ -45,6 +102,11 @@ parser.add_argument('--lr', type=float)
 parser.add_argument('--lr-decays', type=int, nargs='+', help='decays learning rate at the specified epochs')
 parser.add_argument('--cosine-decay', action='store_true')
 
+parser.add_argument('--res-scales', type=float, nargs='+',
+                    help='progressive resizing. trains at these fractions of the full resolution before --res-epochs')
+parser.add_argument('--res-epochs', type=int, nargs='+',
+                    help='epochs at which the resolution steps up to the next of --res-scales or the full resolution')
+
 parser.add_argument('--recompile', action='store_true')
 
 # Strategy
@@ -55,10 +117,15 @@ parser.add_argument('--policy', choices=['mixed_bfloat16', 'float32'], default='
 # Other
 parser.add_argument('--load', action='store_true')
 parser.add_argument('--tsne', action='store_true')
+parser.add_argument('--plot-model', action='store_true', help="save the model graph to 'out/model.png'")
 parser.add_argument('--base-dir', type=str, default='out/')
 parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info')
 parser.add_argument('--no-save', action='store_true', help='skip saving logs and model checkpoints')
 parser.add_argument('--profile-batch', type=int, nargs='*', default=0)
+parser.add_argument('--checks', choices=checks.MODES, default='checked',
+                    help='run the runtime assertions of the losses and layers always, on a sample of steps or never')
+parser.add_argument('--check-every', type=int, default=checks.CHECK_EVERY,
+                    help='average number of steps per check in sampled mode')
 
 # Tensorboard
 parser.add_argument('--update-freq', type=str, default='epoch', help='tensorboard metrics update frequency')
@@ -97,12 +164,33 @@ def setup(args):
     policy = mixed_precision.Policy(args.policy)
     mixed_precision.set_global_policy(policy)
 
+    # Runtime checks are read when the losses and layers are traced
+    checks.set_mode(args.checks, args.check_every)
+    logging.info(f'runtime checks: {args.checks}')
+
     # Dataset arguments
     args.views, args.with_batch_sims = ['image', 'image2'], True
 
     return strategy
 
 
+class StartupTimer():
+    def __init__(self, start_time):
+        self.last_time = start_time
+        self.laps = []
+
+    def lap(self, name):
+        now = time.time()
+        self.laps.append((name, now - self.last_time))
+        self.last_time = now
+
+    def log(self):
+        total = sum(seconds for _, seconds in self.laps)
+        breakdown = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.laps)
+        logging.info(f'startup took {total:.2f}s: {breakdown}')
+        return dict(self.laps)
+
+
 def prepare_tensorboard_dev_logs(args):
     # Copy log files to local disk
     log_dir = os.path.join(args.out, 'logs')
@@ -145,22 +233,58 @@ def set_epoch_steps(args, ds_info):
 
 
 def load_augment_configs(args):
+    if args.augment_telemetry is not None and not args.autoaugment:
+        raise ValueError('--augment-telemetry only counts the ops of --autoaugment')
+    augment_telemetry = None
     if args.autoaugment:
-        autoaugment = augmentations.AutoAugment()
+        if args.device_augment:
+            # The training views are augmented by the model, which only has crops, flips and color ops
+            raise ValueError('--autoaugment does not work with --device-augment')
+        if args.xla_augment:
+            # The static shape ops apply every geometric op on its own
+            if args.fuse_geometric:
+                raise ValueError('--fuse-geometric does not work with --xla-augment')
+            make_autoaugment = xla_augmentations.AutoAugment
+        else:
+            make_autoaugment = lambda: augmentations.AutoAugment(fuse_geometric=args.fuse_geometric)
+        autoaugment, val_autoaugment = make_autoaugment(), make_autoaugment()
+        if args.augment_telemetry is not None:
+            # Timestamps do not compile with XLA, and only the per image ops of the host are instrumented
+            if args.xla_augment:
+                raise ValueError('--augment-telemetry does not work with --xla-augment')
+            if args.batch_augment:
+                raise ValueError('--augment-telemetry only counts the per image augmentations of the host, '
+                                 'not those of --batch-augment')
+            augment_telemetry = telemetry.AugmentTelemetry(augmentations.NAME_TO_FUNC, len(autoaugment.policies),
+                                                           args.augment_telemetry)
+            autoaugment.telemetry = augment_telemetry
         augment_fn = lambda x: autoaugment.distort(tf.image.random_flip_left_right(x))
+        # The validation views are not counted as training cost
+        val_augment_fn = lambda x: val_autoaugment.distort(tf.image.random_flip_left_right(x))
+        batch_autoaugment = augmentations.BatchAutoAugment()
+        batch_augment_fn = lambda x: batch_autoaugment.distort(tf.image.random_flip_left_right(x))
     else:
-        augment_fn = tf.image.random_flip_left_right
+        augment_fn = val_augment_fn = tf.image.random_flip_left_right
+        batch_augment_fn = tf.image.random_flip_left_right
 
-    first_view_train_config = augmentations.ViewConfig(name='image', rand_crop=True, augment_fn=augment_fn)
-    second_view_train_config = augmentations.ViewConfig(name='image2', rand_crop=True, augment_fn=augment_fn)
+    if args.device_augment:
+        # The model augments the training views
+        first_view_train_config = augmentations.ViewConfig(name='image', rand_crop=False)
+        second_view_train_config = augmentations.ViewConfig(name='image2', rand_crop=False)
+    else:
+        first_view_train_config = augmentations.ViewConfig(name='image', rand_crop=True, augment_fn=augment_fn,
+                                                           batch_augment_fn=batch_augment_fn)
+        second_view_train_config = augmentations.ViewConfig(name='image2', rand_crop=True, augment_fn=augment_fn,
+                                                            batch_augment_fn=batch_augment_fn)
 
     first_view_val_config = augmentations.ViewConfig(name='image', rand_crop=False, augment_fn=None)
-    second_view_val_config = augmentations.ViewConfig(name='image2', rand_crop=True, augment_fn=augment_fn)
+    second_view_val_config = augmentations.ViewConfig(name='image2', rand_crop=True, augment_fn=val_augment_fn,
+                                                      batch_augment_fn=batch_augment_fn)
 
     view_train_configs = [first_view_train_config, second_view_train_config]
     view_val_configs = [first_view_val_config, second_view_val_config]
 
-    augment_train_config = augmentations.AugmentConfig(view_train_configs)
+    augment_train_config = augmentations.AugmentConfig(view_train_configs, augment_telemetry)
     augment_val_config = augmentations.AugmentConfig(view_val_configs)
 
     return augment_train_config, augment_val_config